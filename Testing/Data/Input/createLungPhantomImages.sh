@@ -0,0 +1,15 @@
+#!/bin/bash
+
+#Create synthetic lung phantoms (CT, ChestConventions label map and ground
+#truth particles) at growing resolutions, to test particles accuracy and
+#scaling beyond the 64^3 test images. The volumes are written slab by slab.
+phantom="python -m cip_python.particles.lung_phantom"
+
+for size in 128,128,110 256,256,220 512,512,600
+do
+name=lungphantom-${size//,/x}
+echo $name
+$phantom -o $name.nrrd -l ${name}_labelMap.nrrd --size $size \
+  --vessels ${name}_vesselParticles.vtk --airways ${name}_airwayParticles.vtk \
+  --fissures ${name}_fissureParticles.vtk
+done
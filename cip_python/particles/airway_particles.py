@@ -183,6 +183,8 @@ class AirwayParticles(ChestParticles):
         self.save_vtk(out_particles % 3)
         print "finished saving\#####n"
 
+        self.write_run_report()
+
         #Clean tmp Directory
         self.clean_tmp_dir()
 
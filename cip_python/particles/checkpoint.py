@@ -0,0 +1,119 @@
+import os
+import json
+import hashlib
+from cip_python.particles.scale_space_cache import hash_file
+
+class CheckpointManifest:
+    """Manifest of the completed stages of a particles pipeline, used to
+    resume an interrupted run.
+
+    Every stage is recorded with a key (a hash of its parameters and of the
+    contents of its input files) and with the hashes of its output files. A
+    stage can be skipped when it was recorded with the same key and its
+    outputs are still on disk, unchanged. The manifest is a JSON file that
+    is rewritten atomically after every recorded stage.
+
+    Parameters
+    ----------
+    file_name : string
+        Name of the JSON manifest file. It is created if it does not exist.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._stages = dict()
+        if os.path.exists(self.file_name):
+            f = open(self.file_name, 'r')
+            try:
+                self._stages = json.load(f)
+            except ValueError:
+                # Truncated manifest. Start from scratch.
+                self._stages = dict()
+            finally:
+                f.close()
+
+        # Hashes of the files seen by this instance, indexed by
+        # (file name, size, modification time)
+        self._file_hashes = dict()
+
+    def get_file_hash(self, file_name):
+        """Get the SHA-1 digest of a file, computed once per file version.
+        """
+        stat = os.stat(file_name)
+        file_id = (os.path.abspath(file_name), stat.st_size, stat.st_mtime)
+        if file_id not in self._file_hashes:
+            self._file_hashes[file_id] = hash_file(file_name)
+
+        return self._file_hashes[file_id]
+
+    def get_key(self, params, inputs):
+        """Get the key of a stage.
+
+        Parameters
+        ----------
+        params : string
+            Description of the parameters of the stage (e.g. command line)
+
+        inputs : list of strings
+            Input files of the stage
+
+        Returns
+        -------
+        key : string
+            Hexadecimal key of the stage
+        """
+        sha = hashlib.sha1()
+        sha.update(str(params))
+        for file_name in inputs:
+            sha.update(file_name)
+            if os.path.exists(file_name):
+                sha.update(self.get_file_hash(file_name))
+
+        return sha.hexdigest()
+
+    def is_valid(self, stage, key, outputs):
+        """Check whether a stage was completed with the given key and its
+        outputs are unchanged.
+
+        Parameters
+        ----------
+        stage : string
+            Name of the stage
+
+        key : string
+            Key of the stage (see 'get_key')
+
+        outputs : list of strings
+            Output files of the stage
+
+        Returns
+        -------
+        valid : bool
+        """
+        if stage not in self._stages or self._stages[stage]['key'] != key:
+            return False
+
+        recorded = self._stages[stage]['outputs']
+        for file_name in outputs:
+            if file_name not in recorded or \
+              os.path.exists(file_name) == False or \
+              self.get_file_hash(file_name) != recorded[file_name]:
+                return False
+
+        return True
+
+    def record(self, stage, key, outputs):
+        """Record a completed stage and save the manifest.
+        """
+        self._stages[stage] = {'key': key, 'outputs': dict(
+            [(file_name, self.get_file_hash(file_name)) \
+             for file_name in outputs if os.path.exists(file_name)])}
+        self.save()
+
+    def save(self):
+        tmp_file_name = self.file_name + ".tmp"
+        f = open(tmp_file_name, 'w')
+        try:
+            json.dump(self._stages, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(tmp_file_name, self.file_name)
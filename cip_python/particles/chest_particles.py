@@ -8,8 +8,28 @@
 import pdb
 import subprocess
 import os
+import copy
+import math
+import multiprocessing
+import shutil
+import numpy as np
+from scipy.spatial import cKDTree
 from subprocess import PIPE
-from cip_python.utils.read_nrrds_write_vtk import ReadNRRDsWriteVTK
+from cip_python.utils.read_nrrds_write_vtk import ReadNRRDsWriteVTK, \
+     NRRDsVTKWriter
+from cip_python.particles.preprocessing_engine import PreprocessingEngine
+from cip_python.particles.particle_probe import DERIVED_QUANTITIES, \
+     get_base_quantities, derive_quantities, ScaleSpaceProbe, \
+     get_stack_sigmas
+from cip_python.particles.nrrd_utils import read_particle_array, \
+     write_particle_array, get_space_directions, get_space_origin, \
+     set_space_geometry, world_to_index, get_particle_count
+from cip_python.particles.particle_merge import get_tile_ranges, \
+     deduplicate_particles
+from cip_python.particles.checkpoint import CheckpointManifest
+from cip_python.particles.run_report import RunReport, null_stage
+from cip_python.particles.seed_generator import SeedGenerator
+from cip_python.particles.resolution_pyramid import ResolutionPyramid
 
 class ChestParticles:
     """Base class for airway, vessel, and fissure particles classes.
@@ -80,6 +100,27 @@ class ChestParticles:
         # after execution
         self._clean_tmp_dir = False
 
+        # If set to true, the completed stages (preprocessing, puller passes
+        # and probing) are recorded in a checkpoint manifest in 'tmp_dir',
+        # and the stages whose parameters, inputs and outputs did not change
+        # since a previous (interrupted) run are skipped
+        self._resume = False
+        self._checkpoint = None
+
+        # If set, the wall time, CPU time, peak memory and disk I/O of every
+        # stage (and the particle and iteration counts of every puller pass)
+        # are written to this file at the end of the run (CSV if the name
+        # ends with '.csv', JSON otherwise)
+        self._run_report_file_name = None
+        self._run_report = None
+
+        # Optional ScaleSpaceCache instance. If set, the scale-space
+        # pre-blurrings are kept in this persistent cache (shared across runs
+        # and feature types) instead of being rebuilt in 'tmp_dir'. The
+        # entries used by a run are leased until the end of the run.
+        self._scale_space_cache = None
+        self._scale_space_keys = list()
+
         # Scale-particles filenames:
         # -------------------
         # Volume name that is going to be used for scale-space particles.
@@ -111,6 +152,42 @@ class ChestParticles:
         self._scale_samples = scale_samples
         self._iterations = 50
 
+        # Adaptive iteration control: if '_convergence_chunk' is set, every
+        # puller pass is run in chunks of that many iterations, each one
+        # starting from the particles of the previous chunk, and it stops
+        # (before '_iterations' iterations) once the relative change in the
+        # number of particles is below '_convergence_population_tol' and the
+        # median particle displacement is below '_convergence_displacement'
+        # times 'irad'. Chunks are rounded up to a multiple of the population
+        # control period, so that population control runs in every chunk.
+        self._convergence_chunk = None
+        self._convergence_population_tol = 0.01
+        self._convergence_displacement = 0.05
+
+        # Tiled execution: if '_tiles' is larger than 1, every puller pass is
+        # run on '_tiles' overlapping slabs (along the last axis) in a pool of
+        # '_tile_processes' processes (default is one per core). The slabs
+        # are extended by '_tile_halo' slices on each side (default is
+        # derived from the maximum scale), the particles are merged by slab
+        # ownership, particles closer than '_tile_merge_radius' times 'irad'
+        # across slab boundaries are removed and a global polishing pass of
+        # '_tile_polish_iterations' iterations is run on the merged particles.
+        # The slab directories are removed with the temporary files.
+        self._tiles = 1
+        self._tile_processes = None
+        self._tile_halo = None
+        self._tile_merge_radius = 0.5
+        self._tile_polish_iterations = 10
+        self._tile_dirs = list()
+
+        # Merge of particle sets (see 'merge_particles'): if '_merge_radius'
+        # is set (e.g. 0.5), particles closer than '_merge_radius' times
+        # 'irad' in space and '_merge_scale_radius' in log scale to an
+        # earlier merged particle are removed. By default (None) the sets are
+        # just concatenated.
+        self._merge_radius = None
+        self._merge_scale_radius = 0.25
+
         self._permissive = False # Allow volumes to have different 
                                  # shapes (false is safer)
 
@@ -131,6 +208,12 @@ class ChestParticles:
         self._nss = 1 # Number of samples along scale axis
         self._jit = 1 # Jittering to do for each point
         self._number_init_particles = 10000 #Number of initial particles (used with Rnadom and Halton)
+        # If set to true, the 'PerVoxel' mode seeds '_ppv' particles only in
+        # the voxels that pass the seed threshold at some scale, plus a
+        # Halton subset ('_seed_background_fraction') of the other voxels,
+        # and passes them to puller as initial particles (see SeedGenerator)
+        self._strength_seeding = False
+        self._seed_background_fraction = 0.
               
         # Optimizer params:
         # -----------------
@@ -150,6 +233,17 @@ class ChestParticles:
         self._min_intensity = -1024
         # Downsampling factor to enable multiresolution particles
         self._down_sample_rate = down_sample_rate
+        # Options: unu, numpy. With 'numpy', clamping, deconvolution and
+        # down-sampling are done in-process instead of through unu pipelines
+        self._preprocessing_engine = "unu"
+        # If set to true (and a mask is given), the input volume and mask are
+        # cropped to the bounding box of the mask, plus a margin covering the
+        # blurring and reconstruction kernels, before any preprocessing
+        self._crop_to_mask = False
+        # If set to true, '_sp_in_file_name' and '_sp_mask_file_name' already
+        # hold the preprocessed volume and mask (e.g. shared by several
+        # features, see MultiFeatureParticles) and preprocessing is skipped
+        self._preprocessed = False
 
         # Basic contrast Parameters
         # -------------------------
@@ -173,6 +267,23 @@ class ChestParticles:
         self._probing_quantities["hevec2"]=["hevec2",0]
         self._probing_quantities["hess"]=["hess",0]
       
+        # If set to true, the value, gradient and Hessian are probed once
+        # and every other quantity is derived from them, instead of running
+        # one gprobe per quantity
+        self._single_pass_probing = False
+
+        # Options: gprobe, numpy. With 'numpy', all the quantities that can be
+        # derived from the value, gradient and Hessian are probed in-process.
+        # The numpy engine is an approximation of gprobe: its stack samples
+        # the scales uniformly in log(1 + sigma) instead of teem's optimal
+        # sigma sampling ('-sso'), so values between the stack scales differ
+        # slightly (see 'get_stack_sigmas')
+        self._probing_engine = "gprobe"
+
+        # Options: ReadNRRDsWriteVTK, numpy. With 'numpy', the VTK file is
+        # written in-process (binary; XML with compression for '.vtp' files)
+        self._save_vtk_engine = "ReadNRRDsWriteVTK"
+
         self._advanced_probing = False
         if self._advanced_probing == True:
             self._probing_quantities["gvec"]=["gvec",0]
@@ -325,8 +436,47 @@ class ChestParticles:
         elif self._init_mode == "Particles":
             self._init_params = "-pi " + self._in_particles_file_name            
         elif self._init_mode == "PerVoxel":
-            self._init_params = " -ppv " + str(self._ppv) + " -nss " + \
-                str(self._nss) + " -jit " + str(self._jit)
+            if self._strength_seeding == True:
+                self._init_params = "-pi " + self.generate_seeds()
+            else:
+                self._init_params = " -ppv " + str(self._ppv) + " -nss " + \
+                    str(self._nss) + " -jit " + str(self._jit)
+
+    def generate_seeds(self):
+        """Write the strength-guided initial particles of the 'PerVoxel'
+        mode (see '_strength_seeding').
+
+        Returns
+        -------
+        seeds_file_name : string
+        """
+        seeds = os.path.join(self._tmp_dir, "seeds.nrrd")
+        mask_file_name = None
+        if self._use_mask == True and self._sp_mask_file_name is not None:
+            mask_file_name = self._sp_mask_file_name
+
+        params = " ".join([self._feature_type, str(self._seed_thresh),
+                           str(self._max_scale), str(self._scale_samples),
+                           str(self._ppv), str(self._seed_background_fraction)])
+        inputs = [self._sp_in_file_name]
+        if mask_file_name is not None:
+            inputs.append(mask_file_name)
+
+        if self.resume_stage(seeds, params, inputs, [seeds]) == True:
+            return seeds
+
+        with self.get_stage("seeding") as stage:
+            # The strength is tested on the (deconvolved) puller volume,
+            # at the scales of the scale-space stack
+            generator = SeedGenerator(self._feature_type, self._seed_thresh,
+                get_stack_sigmas(self._max_scale, self._scale_samples),
+                self._ppv, self._seed_background_fraction)
+            stage['particles'] = generator.execute(self._sp_in_file_name,
+                                                   seeds, mask_file_name)
+
+        self.checkpoint_stage(seeds, params, inputs, [seeds])
+
+        return seeds
 
     def set_misc_params(self):
         if self._verbose == 0:
@@ -371,9 +521,185 @@ class ChestParticles:
         #Save NRRD data to VTK
         self.save_vtk(outputParticles)
 
+        self.write_run_report()
+
         #Clean tmp Directory
         self.clean_tmp_dir()
 
+    def get_scale_space_dir(self, in_file_name=None):
+        """Get the directory holding the scale-space pre-blurrings of an
+        input volume. This is the temporary directory unless a scale-space
+        cache has been set, in which case it is the (leased) cache entry for
+        the input volume, kernels and scale sampling if it is complete, or
+        else the staging directory in which this run computes the blurrings
+        (see 'publish_scale_space_dir').
+
+        Parameters
+        ----------
+        in_file_name : string (optional)
+            Volume from which the blurrings are computed. Default is the
+            volume used for scale-space particles.
+
+        Returns
+        -------
+        scale_space_dir : string
+        """
+        if in_file_name is None:
+            in_file_name = self._sp_in_file_name
+
+        if self._scale_space_cache is None or \
+            os.path.exists(in_file_name) == False:
+            return self._tmp_dir
+
+        key = self.get_scale_space_key(in_file_name)
+        if key not in self._scale_space_keys:
+            self._scale_space_keys.append(key)
+        entry_dir = self._scale_space_cache.acquire(key, self._scale_samples)
+        if entry_dir is None:
+            entry_dir = self._scale_space_cache.get_staging_dir(key)
+
+        return entry_dir
+
+    def get_scale_space_key(self, in_file_name):
+        kernel_params = "%s %s -bsp bleed" % (self._recon_kernel_type,
+                                             self._blurring_kernel_type)
+        return self._scale_space_cache.get_key(in_file_name,
+                                               kernel_params,
+                                               self._scale_samples,
+                                               self._max_scale)
+
+    def publish_scale_space_dir(self, in_file_name=None):
+        """Move the pre-blurrings computed by this run into the scale-space
+        cache once they are complete, and evict least recently used entries.
+
+        Returns
+        -------
+        scale_space_dir : string
+            Directory now holding the blurrings (see 'get_scale_space_dir')
+        """
+        if in_file_name is None:
+            in_file_name = self._sp_in_file_name
+
+        key = self.get_scale_space_key(in_file_name)
+        scale_space_dir = self._scale_space_cache.publish(key,
+                                                          self._scale_samples)
+        self._scale_space_cache.evict()
+
+        return scale_space_dir
+
+    def release_scale_space_dirs(self):
+        """Release the cache entries (and remove the staging directories)
+        used by this run.
+        """
+        if self._scale_space_cache is not None:
+            for key in self._scale_space_keys:
+                self._scale_space_cache.release(key)
+        self._scale_space_keys = list()
+
+    def get_checkpoint(self):
+        """Get the checkpoint manifest of the temporary directory.
+        """
+        file_name = os.path.join(self._tmp_dir, "checkpoint.json")
+        if self._checkpoint is None or self._checkpoint.file_name != file_name:
+            self._checkpoint = CheckpointManifest(file_name)
+
+        return self._checkpoint
+
+    def resume_stage(self, stage, params, inputs, outputs):
+        """Check whether a stage can be skipped because it was completed by
+        a previous run with the same parameters and inputs. Always False
+        unless '_resume' is set.
+
+        Parameters
+        ----------
+        stage : string
+            Name of the stage
+
+        params : string
+            Parameters of the stage
+
+        inputs : list of strings
+            Input files of the stage
+
+        outputs : list of strings
+            Output files of the stage
+
+        Returns
+        -------
+        skip : bool
+        """
+        if self._resume == False:
+            return False
+
+        checkpoint = self.get_checkpoint()
+        if checkpoint.is_valid(stage, checkpoint.get_key(params, inputs),
+                               outputs) == False:
+            return False
+
+        if self._debug == True:
+            print "Skipping completed stage " + stage
+
+        return True
+
+    def checkpoint_stage(self, stage, params, inputs, outputs):
+        """Record a completed stage in the checkpoint manifest if '_resume'
+        is set. See 'resume_stage'.
+        """
+        if self._resume == False:
+            return
+
+        checkpoint = self.get_checkpoint()
+        checkpoint.record(stage, checkpoint.get_key(params, inputs), outputs)
+
+    def get_stage(self, name):
+        """Get a context manager that records a stage in the run report, or
+        does nothing if there is no run report file name.
+
+        Parameters
+        ----------
+        name : string
+            Name of the stage
+
+        Returns
+        -------
+        stage : context manager
+            Yields the record of the stage, to which extra values can be
+            added
+        """
+        if self._run_report_file_name is None:
+            return null_stage(name)
+
+        if self._run_report is None:
+            self._run_report = RunReport()
+
+        return self._run_report.stage(name)
+
+    def get_run_report_stages(self):
+        """Get the stage records of the run report (empty if there is no
+        report).
+        """
+        if self._run_report is None:
+            return list()
+
+        return self._run_report.get_stages()
+
+    def add_run_report_stages(self, stages, prefix=""):
+        """Add stage records from another run report (e.g. from another
+        process) to the run report. See 'RunReport.add_stages'.
+        """
+        if self._run_report_file_name is None:
+            return
+
+        if self._run_report is None:
+            self._run_report = RunReport()
+
+        self._run_report.add_stages(stages, prefix)
+
+    def write_run_report(self):
+        if self._run_report_file_name is not None and \
+          self._run_report is not None:
+            self._run_report.write(self._run_report_file_name)
+
     def execute_pass(self, output):
         #Check inputs files are in place
         if os.path.exists(self._sp_in_file_name) == False:
@@ -383,6 +709,46 @@ class ChestParticles:
             if os.path.exists(self._sp_mask_file_name) == False:
                 return False
 
+        params = " ".join([self._volParams, self._miscParams,
+                           self._info_params, self._energyParams,
+                           self._init_params, self._reconKernelParams,
+                           self._optimizerParams, str(self._iterations),
+                           str(self._single_scale), str(self._tiles),
+                           str(self._convergence_chunk),
+                           str(self._convergence_population_tol),
+                           str(self._convergence_displacement)])
+        inputs = [self._sp_in_file_name]
+        if self._use_mask == True and self._sp_mask_file_name is not None:
+            inputs.append(self._sp_mask_file_name)
+        if self._init_mode == "Particles":
+            inputs.append(self._in_particles_file_name)
+
+        if self.resume_stage(output, params, inputs, [output]) == True:
+            return
+
+        with self.get_stage(os.path.basename(output)) as stage:
+            if self._tiles > 1:
+                iterations = self.execute_tiled_pass(output)
+                # Zero polishing iterations is not a failure
+                if iterations is False:
+                    return False
+                stage['iterations'] = iterations
+            else:
+                stage['iterations'] = self.run_puller(output)
+
+            if os.path.exists(output):
+                stage['particles'] = get_particle_count(output)
+
+        self.checkpoint_stage(output, params, inputs, [output])
+
+    def run_puller(self, output):
+        """Run puller on the whole volume. See 'execute_pass'.
+
+        Returns
+        -------
+        iterations : int
+            Number of iterations run
+        """
         if self._single_scale == 1:
             tmp_command = "unu resample -i " + self._sp_in_file_name + \
                 " -s x1 x1 x1 -k dgauss:" + str(self._max_scale) + \
@@ -392,17 +758,18 @@ class ChestParticles:
                 print tmp_command
             subprocess.call(tmp_command, shell=True)
 
-        tmp_command = "puller -sscp " + self._tmp_dir + \
-            " -cbst true " + self._volParams + " " + self._miscParams + " " + \
-            self._info_params + " " +  self._energyParams + " " + \
-            self._init_params + " " + self._reconKernelParams + " " + \
-            self._optimizerParams + " -o " + output + " -maxi " + \
-            str(self._iterations)
+        scale_space_dir = self.get_scale_space_dir()
 
-        if self._debug == True:
-            print tmp_command
+        if self._convergence_chunk is None:
+            self.call_puller(scale_space_dir, self._init_params, output,
+                             self._iterations)
+            iterations = self._iterations
+        else:
+            iterations = self.run_puller_chunks(scale_space_dir, output)
 
-        subprocess.call(tmp_command, shell=True)
+        if self._scale_space_cache is not None and \
+          os.path.exists(self._sp_in_file_name):
+            self.publish_scale_space_dir()
         
         # Trick to add scale value
         if self._single_scale == 1:
@@ -414,7 +781,212 @@ class ChestParticles:
             if self._debug == True:
                 print tmp_command
             subprocess.call( tmp_command, shell=True )
-          
+
+        return iterations
+
+    def call_puller(self, scale_space_dir, init_params, output, iterations):
+        tmp_command = "puller -sscp " + scale_space_dir + \
+            " -cbst true " + self._volParams + " " + self._miscParams + " " + \
+            self._info_params + " " +  self._energyParams + " " + \
+            init_params + " " + self._reconKernelParams + " " + \
+            self._optimizerParams + " -o " + output + " -maxi " + \
+            str(iterations)
+
+        if self._debug == True:
+            print tmp_command
+
+        subprocess.call(tmp_command, shell=True)
+
+    def run_puller_chunks(self, scale_space_dir, output):
+        """Run puller in chunks of '_convergence_chunk' iterations until the
+        particle system has converged or '_iterations' iterations have been
+        run. See 'has_converged'.
+
+        Returns
+        -------
+        iterations : int
+            Number of iterations run
+        """
+        chunk_input = os.path.join(self._tmp_dir,
+                                   "chunk-" + os.path.basename(output))
+        init_params = self._init_params
+        previous = None
+        iterations = 0
+        # Puller only adds and removes particles every population control
+        # period: shorter chunks would never change the population
+        period = max(self._population_control_period, 1)
+        convergence_chunk = -(-self._convergence_chunk//period)*period
+        while iterations < self._iterations:
+            chunk = min(convergence_chunk, self._iterations - iterations)
+            self.call_puller(scale_space_dir, init_params, output, chunk)
+            iterations += chunk
+            if os.path.exists(output) == False:
+                break
+
+            particles = read_particle_array(output)
+            if previous is not None and \
+              has_converged(previous[:, 0:3], particles[:, 0:3],
+                            self._convergence_population_tol,
+                            self._convergence_displacement*self._irad):
+                break
+
+            # Next chunk starts from the current particles
+            previous = particles
+            shutil.copyfile(output, chunk_input)
+            init_params = "-pi " + chunk_input
+
+        if self._debug == True:
+            print "Puller pass stopped after %d iterations" % iterations
+
+        return iterations
+
+    def execute_tiled_pass(self, output):
+        """Run a puller pass on overlapping slabs of the volume in parallel,
+        merge the particles of every slab and polish them with a short pass
+        on the whole volume. See the '_tiles' parameters.
+
+        Parameters
+        ----------
+        output : string
+            File name of the output particles
+
+        Returns
+        -------
+        iterations : int
+            Number of iterations of the polishing pass (the iterations of
+            every slab are in the run report stages of the slabs), or False
+            if no slab produced particles
+        """
+        engine = PreprocessingEngine()
+        data, options = engine.read(self._sp_in_file_name)
+        assert 'space origin' in options, \
+          "Tiled execution requires a volume with a space origin"
+        directions = get_space_directions(options)
+        origin = get_space_origin(options)
+        size = data.shape[2]
+
+        mask = None
+        weights = None
+        if self._use_mask == True and self._sp_mask_file_name is not None:
+            mask, mask_options = engine.read(self._sp_mask_file_name)
+            weights = np.sum(mask > 0, axis=(0, 1))
+
+        # Random and Halton initial particles are split between the tiles by
+        # masked (or total) volume, to keep the density of the whole volume
+        init_weights = weights
+        if init_weights is None:
+            init_weights = np.ones(size)
+
+        # In 'Particles' mode, the tiles are balanced by number of particles
+        if self._init_mode == "Particles":
+            in_particles = read_particle_array(self._in_particles_file_name)
+            in_slices = world_to_index(in_particles[:, 0:3], options)[:, 2]
+            weights = np.bincount(np.clip(np.floor(in_slices + 0.5), 0,
+                                          size - 1).astype(int),
+                                  minlength=size)
+
+        halo = self._tile_halo
+        if halo is None:
+            # Support of the largest blurring plus the reconstruction kernel
+            halo = int(math.ceil(3*self._max_scale)) + 3
+
+        tiles = list()
+        for ii, (core_start, core_stop, start, stop) in \
+          enumerate(get_tile_ranges(size, self._tiles, halo, weights)):
+            tile = copy.copy(self)
+            tile._tiles = 1
+            tile._run_report = None
+            tile._tmp_dir = os.path.join(self._tmp_dir, "tile%03d" % ii)
+            if os.path.exists(tile._tmp_dir) == False:
+                os.makedirs(tile._tmp_dir)
+            if tile._tmp_dir not in self._tile_dirs:
+                self._tile_dirs.append(tile._tmp_dir)
+
+            if self._init_mode == "Particles":
+                sel = (in_slices >= start - 0.5) & (in_slices < stop - 0.5)
+                if np.any(sel) == False:
+                    continue
+                tile._in_particles_file_name = \
+                  os.path.join(tile._tmp_dir, "in-particles.nrrd")
+                write_particle_array(tile._in_particles_file_name,
+                                     in_particles[sel])
+            elif self._init_mode in ["Random", "Halton"]:
+                tile._number_init_particles = max(1, int(round(
+                    self._number_init_particles*\
+                    np.sum(init_weights[start:stop])/ \
+                    float(np.sum(init_weights)))))
+
+            tile_origin = origin + start*directions[2]
+            tile._sp_in_file_name = os.path.join(tile._tmp_dir,
+                                                 "ct-deconv.nrrd")
+            engine.write(tile._sp_in_file_name, data[:, :, start:stop],
+                         set_space_geometry(options, directions, tile_origin))
+            if mask is not None:
+                tile._sp_mask_file_name = os.path.join(tile._tmp_dir,
+                                                       "mask.nrrd")
+                engine.write(tile._sp_mask_file_name, mask[:, :, start:stop],
+                             set_space_geometry(mask_options, directions,
+                                                tile_origin))
+
+            tile.reset_params()
+            tile.build_params()
+            tiles.append((tile, os.path.join(tile._tmp_dir, "particles.nrrd"),
+                          core_start, core_stop))
+
+        pool = multiprocessing.Pool(self._tile_processes)
+        try:
+            results = pool.map(_execute_tile_pass,
+                               [(tile, tile_output) for tile, tile_output, \
+                                core_start, core_stop in tiles])
+        finally:
+            pool.close()
+            pool.join()
+
+        for (tile, tile_output, core_start, core_stop), (result, stages) in \
+          zip(tiles, results):
+            self.add_run_report_stages(stages,
+                                       os.path.basename(tile._tmp_dir) + "/")
+
+        # Keep the particles in the core of every tile. Particles close to a
+        # tile boundary may duplicate particles of the neighboring tile.
+        radius = self._tile_merge_radius*self._irad
+        seam_width = radius/np.linalg.norm(directions[2])
+        merged = list()
+        candidates = list()
+        for tile, tile_output, core_start, core_stop in tiles:
+            if os.path.exists(tile_output) == False:
+                continue
+            particles = read_particle_array(tile_output)
+            slices = world_to_index(particles[:, 0:3], options)[:, 2]
+            owned = (slices >= core_start - 0.5) & (slices < core_stop - 0.5)
+            merged.append(particles[owned])
+            candidates.append(
+                np.minimum(slices[owned] - core_start + 0.5,
+                           core_stop - 0.5 - slices[owned]) < seam_width)
+
+        if len(merged) == 0:
+            return False
+
+        merged = np.concatenate(merged)
+        keep = deduplicate_particles(merged[:, 0:3], radius,
+                                     np.concatenate(candidates))
+        merged_file_name = os.path.join(self._tmp_dir, "tiles-merged.nrrd")
+        write_particle_array(merged_file_name, merged[keep])
+
+        if self._tile_polish_iterations == 0:
+            write_particle_array(output, merged[keep])
+            return 0
+
+        # The polishing pass is part of the stage of this pass
+        polish = copy.copy(self)
+        polish._tiles = 1
+        polish._init_mode = "Particles"
+        polish._in_particles_file_name = merged_file_name
+        polish._iterations = self._tile_polish_iterations
+        polish.reset_params()
+        polish.build_params()
+        return polish.run_puller(output)
+
     def probe_points(self, in_volume, inputParticles, quantity,
                      normalizedDerivatives=0):
         output = os.path.join(self._tmp_dir, quantity+".nrrd")
@@ -446,7 +1018,7 @@ class ChestParticles:
                 'num_scales': self._scale_samples,
                 'max_scale': self._max_scale,
                 'scale_samples': self._scale_samples,
-                'path_name': os.path.join(self._tmp_dir,"V")
+                'path_name': os.path.join(self.get_scale_space_dir(in_volume),"V")
             }
 
             if normalizedDerivatives == 1:
@@ -456,7 +1028,8 @@ class ChestParticles:
           print tmp_command
 
         #print tmp_command
-        subprocess.call( tmp_command, shell=True )
+        with self.get_stage("probe " + quantity):
+            subprocess.call( tmp_command, shell=True )
 
     def probe_quantities(self, in_volume, in_particles):
         """
@@ -466,25 +1039,224 @@ class ChestParticles:
         
         in_particles : string
         """
+        params = " ".join([repr(sorted(self._probing_quantities.items())),
+                           self._probing_engine, str(self._single_pass_probing),
+                           str(self._single_scale), str(self._max_scale),
+                           str(self._scale_samples), self._recon_kernel_type])
+        outputs = [os.path.join(self._tmp_dir, quant + ".nrrd") \
+                   for quant in sorted(self._probing_quantities.keys())]
+        if self.resume_stage("probing", params, [in_volume, in_particles],
+                             outputs) == True:
+            return
+
+        with self.get_stage("probing"):
+            if self._probing_engine == "numpy":
+                self.probe_quantities_numpy(in_volume, in_particles)
+            elif self._single_pass_probing == True:
+                self.probe_quantities_single_pass(in_volume, in_particles)
+            else:
+                for quant in self._probing_quantities.keys():
+                    self.probe_points(in_volume, in_particles, quant, self._probing_quantities[quant][1])
+
+        self.checkpoint_stage("probing", params, [in_volume, in_particles],
+                              outputs)
+
+    def probe_quantities_numpy(self, in_volume, in_particles):
+        """Probe all the quantities with a vectorized NumPy probe of the
+        scale stack instead of gprobe. The quantity files are written to the
+        temporary directory, as 'probe_points' does.
+
+        Parameters
+        ----------
+        in_volume : string
+        
+        in_particles : string
+        """
+        quantities = [quant for quant in self._probing_quantities.keys() \
+                      if quant in DERIVED_QUANTITIES]
+
         for quant in self._probing_quantities.keys():
-            self.probe_points(in_volume, in_particles, quant, self._probing_quantities[quant][1])
+            if quant not in DERIVED_QUANTITIES:
+                self.probe_points(in_volume, in_particles, quant,
+                                  self._probing_quantities[quant][1])
+
+        if self._single_scale == 1:
+            scale_samples = 1
+        else:
+            scale_samples = self._scale_samples
+
+        probe = ScaleSpaceProbe(in_volume, self._max_scale, scale_samples,
+                                self.get_scale_space_dir(in_volume),
+                                self._recon_kernel_type)
+        normalized = dict([(quant, self._probing_quantities[quant][1] == 1) \
+                           for quant in quantities])
+        answers = probe.probe_quantities(in_particles, quantities, normalized,
+                                         self._single_scale == 1)
+
+        for quant in quantities:
+            write_particle_array(os.path.join(self._tmp_dir, quant + ".nrrd"),
+                                 answers[quant].astype(np.float32))
+
+    def probe_quantities_single_pass(self, in_volume, in_particles):
+        """Probe the value, gradient and Hessian once per particle and derive
+        all the other probing quantities from them. The quantity files are
+        written to the temporary directory, as 'probe_points' does.
+
+        Parameters
+        ----------
+        in_volume : string
+        
+        in_particles : string
+        """
+        quantities = [quant for quant in self._probing_quantities.keys() \
+                      if quant in DERIVED_QUANTITIES]
+
+        # Quantities that cannot be derived are probed on their own
+        for quant in self._probing_quantities.keys():
+            if quant not in DERIVED_QUANTITIES:
+                self.probe_points(in_volume, in_particles, quant,
+                                  self._probing_quantities[quant][1])
+
+        base = dict()
+        for quant in get_base_quantities(quantities):
+            self.probe_points(in_volume, in_particles, quant, 0)
+            base[quant] = read_particle_array(os.path.join(self._tmp_dir,
+                                                           quant + ".nrrd"))
+
+        if self._single_scale == 1:
+            sigma = None
+        else:
+            sigma = read_particle_array(in_particles)[:, 3]
+
+        normalized = dict([(quant, self._probing_quantities[quant][1] == 1) \
+                           for quant in quantities])
+        answers = derive_quantities(quantities, base.get('val'),
+                                    base.get('gvec'), base.get('hess'),
+                                    sigma, normalized)
+
+        for quant in quantities:
+            if quant in base and not normalized[quant]:
+                continue
+            write_particle_array(os.path.join(self._tmp_dir, quant + ".nrrd"),
+                                 answers[quant].astype(np.float32))
 
     def preprocessing(self):
+        if self._preprocessed == True:
+            return
+
+        with self.get_stage("preprocessing"):
+            in_file_name = self._in_file_name
+            mask_file_name = self._mask_file_name
+            if self._crop_to_mask == True and self._use_mask == True and \
+              self._mask_file_name is not None:
+                in_file_name, mask_file_name = self.crop_to_mask()
+
+            if self._preprocessing_engine == "numpy":
+                self.preprocessing_numpy(in_file_name, mask_file_name)
+            else:
+                self.preprocessing_unu(in_file_name, mask_file_name)
+
+    def crop_to_mask(self):
+        """Crop the input volume and mask to the bounding box of the mask,
+        extended by the support of the largest blurring and of the
+        reconstruction kernel. The cropped volumes keep their position in
+        world space, so the particles need no correction.
+
+        Returns
+        -------
+        in_file_name : string
+            Cropped input volume (the input volume itself if it has no space
+            origin, in which case no cropping is done)
+
+        mask_file_name : string
+            Cropped mask
+        """
+        engine = PreprocessingEngine()
+        if 'space origin' not in engine.read_header(self._in_file_name):
+            print "No space origin in the input volume. Skipping cropping."
+            return self._in_file_name, self._mask_file_name
+
+        cropped_vol = os.path.join(self._tmp_dir, "ct-crop.nrrd")
+        cropped_mask = os.path.join(self._tmp_dir, "mask-crop.nrrd")
+
+        margin = self.get_crop_margin()
+
+        params = "crop %d" % margin
+        inputs = [self._in_file_name, self._mask_file_name]
+        outputs = [cropped_vol, cropped_mask]
+        if self.resume_stage(cropped_vol, params, inputs, outputs) == False:
+            engine.crop_to_mask(self._in_file_name, self._mask_file_name,
+                                cropped_vol, cropped_mask, margin)
+            self.checkpoint_stage(cropped_vol, params, inputs, outputs)
+
+        return cropped_vol, cropped_mask
+
+    def get_crop_margin(self):
+        """Get the margin, in voxels of the input volume, kept around the
+        mask by 'crop_to_mask': the support of the largest blurring and of
+        the reconstruction kernel.
+        """
+        # Scales are in units of down-sampled voxels
+        return (int(math.ceil(3*self._max_scale)) + 3)* \
+          int(math.ceil(self._down_sample_rate))
+
+    def preprocessing_unu(self, in_file_name, mask_file_name):
         if self._down_sample_rate > 1:
             downsampled_vol = os.path.join(self._tmp_dir, "ct-down.nrrd")
-            self.down_sample(self._in_file_name,downsampled_vol,'cubic:0,0.5',self.down_sample_rate)
+            self.down_sample(in_file_name,downsampled_vol,'cubic:0,0.5',self._down_sample_rate)
             if self._use_mask == True:
                 downsampled_mask = os.path.join(self._tmp_dir, "mask-down.nrrd")
-                self.down_sample(self._mask_file_name,downsampled_mask,'cheap',self.down_sample_rate)
+                self.down_sample(mask_file_name,downsampled_mask,'cheap',self._down_sample_rate)
                 self._sp_mask_file_name = downsampled_mask
         else:
-            downsampled_vol = self._in_file_name
-            self._sp_mask_file_name = self._mask_file_name
+            downsampled_vol = in_file_name
+            self._sp_mask_file_name = mask_file_name
 
         deconvolved_vol = os.path.join(self._tmp_dir, "ct-deconv.nrrd")
         self.deconvolve(downsampled_vol,deconvolved_vol)
 
         self._sp_in_file_name = deconvolved_vol
+
+    def preprocessing_numpy(self, in_file_name, mask_file_name):
+        """Same as 'preprocessing_unu', but the input volume is read once
+        and down-sampled, clamped and deconvolved in memory. Only the
+        deconvolved volume (and the down-sampled mask) are written.
+        """
+        deconvolved_vol = os.path.join(self._tmp_dir, "ct-deconv.nrrd")
+        params = "preprocess %s %s %s %s" % (self._min_intensity,
+                                             self._max_intensity,
+                                             self.get_inverse_kernel_type(),
+                                             self._down_sample_rate)
+        if self.resume_stage(deconvolved_vol, params, [in_file_name],
+                             [deconvolved_vol]) == False:
+            PreprocessingEngine().preprocess(in_file_name,
+                                             deconvolved_vol,
+                                             self._min_intensity,
+                                             self._max_intensity,
+                                             self.get_inverse_kernel_type(),
+                                             self._down_sample_rate)
+            self.checkpoint_stage(deconvolved_vol, params,
+                                  [in_file_name], [deconvolved_vol])
+
+        if self._down_sample_rate > 1 and self._use_mask == True:
+            downsampled_mask = os.path.join(self._tmp_dir, "mask-down.nrrd")
+            self.down_sample(mask_file_name, downsampled_mask,
+                             'cheap', self._down_sample_rate)
+            self._sp_mask_file_name = downsampled_mask
+        else:
+            self._sp_mask_file_name = mask_file_name
+
+        self._sp_in_file_name = deconvolved_vol
+
+    def get_inverse_kernel_type(self):
+        """Get the kernel type matching the current inverse kernel
+        parameters, or None if they are not set (in which case the unu
+        deconvolution pipeline only converts the volume to float).
+        """
+        inverse_kernels = {"-k bspl3ai": "Bspline3", "-k bspl5ai": "Bspline5",
+                           "-k bspl7ai": "Bspline7", "-k c4hai": "C4"}
+
+        return inverse_kernels.get(self._inverse_kernel_params.strip(), None)
         
     def deconvolve(self, in_vol, out_vol):
         """
@@ -495,30 +1267,61 @@ class ChestParticles:
         out_vol : string
         
         """
-        tmp_command = "unu 3op clamp " + str(self._min_intensity) + " " + \
-            in_vol + " " + str(self._max_intensity)  + \
-            " | unu resample -s x1 x1 x1 " + self._inverse_kernel_params + \
-            " -t float -o " + out_vol
+        params = "deconvolve %s %s %s %s" % (self._min_intensity,
+                                             self._max_intensity,
+                                             self._inverse_kernel_params,
+                                             self._preprocessing_engine)
+        if self.resume_stage(out_vol, params, [in_vol], [out_vol]) == True:
+            return
+
+        if self._preprocessing_engine == "numpy":
+            PreprocessingEngine().deconvolve(in_vol, out_vol,
+                                             self._min_intensity,
+                                             self._max_intensity,
+                                             self.get_inverse_kernel_type())
+        else:
+            tmp_command = "unu 3op clamp " + str(self._min_intensity) + " " + \
+                in_vol + " " + str(self._max_intensity)  + \
+                " | unu resample -s x1 x1 x1 " + self._inverse_kernel_params + \
+                " -t float -o " + out_vol
 
-        if self._debug == True:
-            print tmp_command
+            if self._debug == True:
+                print tmp_command
+
+            subprocess.call( tmp_command, shell=True)
 
-        subprocess.call( tmp_command, shell=True)
+        self.checkpoint_stage(out_vol, params, [in_vol], [out_vol])
 
     def down_sample(self, inputVol, outputVol, kernel,down_rate):
-        tmp_command = \
-            "unu resample -s x%(rate)f x%(rate)f x%(rate)f -k %(kernel)s -i " \
-            + inputVol + " -o " + outputVol
+        # In-place resamplings cannot be checked against their input
+        params = "down_sample %s %s %s" % (kernel, down_rate,
+                                           self._preprocessing_engine)
+        checkpoint = inputVol != outputVol
+        if checkpoint == True and self.resume_stage(outputVol, params,
+                                                    [inputVol],
+                                                    [outputVol]) == True:
+            return
+
+        if self._preprocessing_engine == "numpy":
+            PreprocessingEngine().down_sample(inputVol, outputVol, kernel,
+                                              down_rate)
+        else:
+            tmp_command = \
+                "unu resample -s x%(rate)f x%(rate)f x%(rate)f -k %(kernel)s -i " \
+                + inputVol + " -o " + outputVol
 
-        #MAYBE WE HAVE TO DOWNSAMPLE THE MASK
-        val = 1.0/down_rate
-        tmp_command = tmp_command %  {'rate':val,'kernel':kernel}
+            #MAYBE WE HAVE TO DOWNSAMPLE THE MASK
+            val = 1.0/down_rate
+            tmp_command = tmp_command %  {'rate':val,'kernel':kernel}
 
-        if self._debug == True:
-            print tmp_command
+            if self._debug == True:
+                print tmp_command
 
-        #print tmp_command            
-        subprocess.call( tmp_command, shell=True)
+            #print tmp_command            
+            subprocess.call( tmp_command, shell=True)
+
+        if checkpoint == True:
+            self.checkpoint_stage(outputVol, params, [inputVol], [outputVol])
     
 
     def adjust_scale(self, in_particles):
@@ -543,7 +1346,10 @@ class ChestParticles:
         if self._down_sample_rate > 1:
             self.adjust_scale(in_particles)
 
-        reader_writer = ReadNRRDsWriteVTK(out_particles)
+        if self._save_vtk_engine == "numpy":
+            reader_writer = NRRDsVTKWriter(out_particles)
+        else:
+            reader_writer = ReadNRRDsWriteVTK(out_particles)
         reader_writer.add_file_name_array_name_pair(in_particles, "NA")
 
         for quant in self._probing_quantities.keys():
@@ -551,9 +1357,13 @@ class ChestParticles:
             vtk_tag=self._probing_quantities[quant][0]
             reader_writer.add_file_name_array_name_pair(file,vtk_tag)
 
-        reader_writer.execute()
+        with self.get_stage("save_vtk"):
+            reader_writer.execute()
 
     def clean_tmp_dir(self):
+        # End of the run: the scale-space cache entries can be evicted again
+        self.release_scale_space_dirs()
+
         if self._clean_tmp_dir == True:
             print "Cleaning tempoarary directory..."
             tmp_command = "/bin/rm " + os.path.join(self._tmp_dir, "*")
@@ -562,37 +1372,110 @@ class ChestParticles:
                 print tmp_command
             subprocess.call( tmp_command, shell=True )
 
+            for tile_dir in self._tile_dirs:
+                shutil.rmtree(tile_dir, ignore_errors=True)
+            self._tile_dirs = list()
+
     def merge_particles(self,input_list,output_merged):
-        particles = str()
-        for input_particles in input_list:
-            particles = particles + " " + str(input_particles)
-        tmp_command = "unu join -a 1 -i " + particles + " -o "+ output_merged
+        """Merge particle files (e.g. the outputs of the levels of a
+        multi-resolution run). Unless '_merge_radius' is None, near-duplicate
+        particles are removed: particles closer than '_merge_radius' times
+        'irad' in space and (for scale-space particles) than
+        '_merge_scale_radius' in log scale to a particle of an earlier input
+        (or earlier in the same input). See 'deduplicate_particles'.
+
+        Returns
+        -------
+        removed : int
+            Number of duplicates removed
+        """
+        with self.get_stage("merge") as stage:
+            if self._merge_radius is None:
+                particles = str()
+                for input_particles in input_list:
+                    particles = particles + " " + str(input_particles)
+                tmp_command = "unu join -a 1 -i " + particles + " -o "+ \
+                  output_merged
+
+                if self._debug == True:
+                    print tmp_command
+                subprocess.call(tmp_command, shell=True)
+                stage['removed'] = 0
+                return 0
+
+            merged = np.concatenate([read_particle_array(input_particles) \
+                                     for input_particles in input_list])
+            scales = None
+            if merged.shape[1] > 3 and self._merge_scale_radius is not None:
+                scales = np.log(np.maximum(merged[:, 3], 1e-6))
+            keep = deduplicate_particles(merged[:, 0:3],
+                                         self._merge_radius*self._irad,
+                                         scales=scales,
+                                         scale_radius=self._merge_scale_radius)
+            write_particle_array(output_merged, merged[keep])
+
+            removed = int(np.sum(keep == False))
+            stage['particles'] = int(np.sum(keep))
+            stage['removed'] = removed
+            if self._debug == True:
+                print "removed %d duplicate particles" % removed
 
-        if self._debug == True:
-            print tmp_command
-        subprocess.call(tmp_command, shell=True)
+        return removed
 
     def differential_mask (self, current_down_rate, previous_down_rate,
                            output_mask):
+        """Write the mask of the voxels, at 'current_down_rate', left to this
+        level by the coarser level at 'previous_down_rate'. See
+        'ResolutionPyramid.get_differential_mask', which defines the
+        differential mask for both the per-level and the pyramid paths of
+        the multi-resolution particles.
+        """
         if self._use_mask == True:
-            downsampled_mask_prev = os.path.join(self._tmp_dir, \
-                                         "mask-down-previous.nrrd")
-            #Down-sampling previous level
-            self.down_sample(self._mask_file_name, \
-                     downsampled_mask_prev, "cheap", previous_down_rate)
-            #Up-sampling previous level
-            self.down_sample(downsampled_mask_prev, \
-                     downsampled_mask_prev, "cheap", 1.0/previous_down_rate)
-            #Down-sampling current level    
-            self.down_sample(self._mask_file_name, \
-                     output_mask, "cheap",current_down_rate)
-            tmp_command = "unu 2op - %(current)s %(previous)s | unu 1op abs \
-                           -i - | unu 2op gt - 0 -o %(out)s"
-            tmp_command = tmp_command % {'current':output_mask,
-                                         'previous':downsampled_mask_prev,
-                                         'out':output_mask}
+            pyramid = ResolutionPyramid(self._mask_file_name)
+            pyramid.write_level_mask(output_mask, current_down_rate,
+                                     previous_down_rate)
 
-            if self._debug == True:
-                print tmp_command
-            subprocess.call(tmp_command, shell=True)
+def has_converged(previous, current, population_tol, displacement):
+    """Convergence test between two states of a particle system.
+
+    Parameters
+    ----------
+    previous : array, shape ( N, 3 )
+        Particle positions before the last iterations
+
+    current : array, shape ( M, 3 )
+        Particle positions after the last iterations
+
+    population_tol : float
+        Largest relative change in the number of particles
+
+    displacement : float
+        Largest median distance between a particle and the closest particle
+        of the previous state
+
+    Returns
+    -------
+    converged : bool
+    """
+    if previous.shape[0] == 0 or current.shape[0] == 0:
+        return previous.shape[0] == current.shape[0]
+
+    if abs(current.shape[0] - previous.shape[0]) > \
+      population_tol*previous.shape[0]:
+        return False
+
+    distances, indices = cKDTree(previous).query(current)
+
+    return np.median(distances) <= displacement
+
+def _execute_tile_pass(args):
+    """Run a puller pass for a tile of 'ChestParticles.execute_tiled_pass'.
+    Defined at module level so that it can be used by a process pool.
+    """
+    tile, output = args
+    try:
+        result = tile.execute_pass(output)
+    finally:
+        tile.release_scale_space_dirs()
 
+    return result, tile.get_run_report_stages()
@@ -192,6 +192,8 @@ class DiaphragmParticles(ChestParticles):
         self.save_vtk(out_particles % 3)
         print "finished saving\#####n"
 
+        self.write_run_report()
+
         #Clean tmp Directory
         self.clean_tmp_dir()
 
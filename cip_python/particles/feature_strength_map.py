@@ -9,7 +9,15 @@
 
 import subprocess
 import os
+import copy
+import shutil
+import multiprocessing
+import numpy as np
+import nrrd
+from scipy.ndimage import gaussian_filter
 from subprocess import PIPE
+from cip_python.particles.preprocessing_engine import PreprocessingEngine
+from cip_python.particles.nrrd_utils import get_space_directions
 
 class FeatureStrengthMap:
     """Class to compute a feature strenght map based on the hessian eigenvalues
@@ -49,6 +57,9 @@ class FeatureStrengthMap:
         # If set to true, the temporary directory will be wiped clean
         # after execution
         self._clean_tmp_dir = False
+        # Working directories of the scales created by 'execute', removed
+        # with the temporary files
+        self._scale_dirs = list()
 
         #
         # Particle system set up params
@@ -68,6 +79,17 @@ class FeatureStrengthMap:
         self._minIntensity     = -1024 #Limit the lowerc range of the input image
         self._downSamplingRate =  1    #Downsampling factor to enable multiresolution particles
 
+        # Options: vprobe, numpy. With 'numpy', the Hessian eigenvalues are
+        # computed in-process with Gaussian derivative filters, one z-slab
+        # of '_slab_size' slices (plus a halo) at a time, and the projection
+        # across scales is updated as each scale is computed
+        self._probing_engine = "vprobe"
+        self._slab_size = 32
+
+        # Number of processes running vprobe concurrently, one probe scale
+        # each. Default is one per core (at most one per scale).
+        self._processes = None
+
     def set_kernel_params(self):
         if self._reconKernelType == "Bspline3":
             #self._reconKernelParams="-k00 cubic:1,0 -k11 cubicd:1,0 -k22 cubicdd:1,0 -kssr hermite"
@@ -96,7 +118,38 @@ class FeatureStrengthMap:
         elif feature_type == "valley_surface":
             return "heval0"
 
+    def get_projection(self):
+        """Get the projection across scales and the clamping range of the
+        feature strength.
+
+        Returns
+        -------
+        project : function
+            numpy.minimum for ridges, numpy.maximum for valleys
+
+        clamp_range : tuple
+            Minimum and maximum feature strength
+        """
+        if self._feature_type == "ridge_line" or \
+          self._feature_type == "ridge_surface":
+            return np.minimum, (self._max_feature_strength, 0)
+
+        return np.maximum, (0, self._max_feature_strength)
+
+    def get_eigenvalue_index(self):
+        """Index of the feature strength eigenvalue in the eigenvalues
+        sorted in ascending order (heval0 is the largest eigenvalue).
+        """
+        feature_strength = \
+          self.get_feature_strength_from_feature_type(self._feature_type)
+
+        return {"heval0": 2, "heval1": 1, "heval2": 0}[feature_strength]
+
     def execute( self ):
+        if self._probing_engine == "numpy":
+            self.execute_numpy()
+            return
+
         if self._downSamplingRate > 1:
             downsampledVolume = os.path.join(self._tmp_dir,"ct-down.nrrd")
             self.down_sample(self._input_file_name,downsampledVolume)
@@ -108,43 +161,144 @@ class FeatureStrengthMap:
 
         inputVolume = deconvolvedVolume
 
-        #Probe scales
-        responseFiles = ""
+        #Probe scales concurrently, each one in its own directory (vprobe
+        #writes its blurrings in the working directory), and compute the
+        #maximum strength as the scale responses arrive
+        project, clamp_range = self.get_projection()
+        tasks = list()
         for ii in range(len(self._probe_scales)):
-            outputVolume = "kk-%d.nhdr" % ii
-            outputVolume = os.path.join(self._tmp_dir,outputVolume)
-            pS = self._probe_scales[ii]
-            self.probe_volume(inputVolume,outputVolume,pS,1)
-            responseFiles += outputVolume
-            responseFiles += " "
-
-        #Join scale responses and compute maximum strength
-        if self._feature_type == "ridge_line":
-            operator = "min"
-            clampRange = "%f - 0"
-        elif self._feature_type == "valley_line":
-            operator = "max"
-            clampRange = "0 - %f"
-        elif self._feature_type == "ridge_surface":
-            operator = "min"
-            clampRange = "%f - 0"
-        elif self._feature_type == "valley_surface":
-            operator = "max"
-            clampRange = "0 - %f"
-
-        clampRange = clampRange % self._max_feature_strength
-
-        tmpCommand = "unu join -i %(input)s -incr -a 0 -sp 1 | unu 3op clamp %(clamp_range)s | unu project -m %(operator)s -a 0 -o %(output)s"
-        tmpCommand = tmpCommand % {'input':responseFiles,'output':self._output_file_name,'operator':operator,'clamp_range':clampRange}
-        subprocess.call( tmpCommand, shell=True )
+            scale_dir = os.path.join(self._tmp_dir, "scale%d" % ii)
+            if os.path.exists(scale_dir) == False:
+                os.makedirs(scale_dir)
+            self._scale_dirs.append(scale_dir)
+            tasks.append((self, scale_dir, inputVolume,
+                          os.path.join(scale_dir, "kk-%d.nhdr" % ii),
+                          self._probe_scales[ii]))
+
+        processes = self._processes
+        if processes is None:
+            processes = min(len(tasks), multiprocessing.cpu_count())
 
-        #Trick to fix space directions: project wipes out this information
+        strength = None
+        pool = multiprocessing.Pool(processes)
+        try:
+            for outputVolume in pool.imap_unordered(_probe_scale, tasks):
+                response = nrrd.read(outputVolume)[0]
+                response = np.minimum(np.maximum(response, clamp_range[0]),
+                                      clamp_range[1]).astype(np.float32)
+                if strength is None:
+                    strength = response
+                else:
+                    strength = project(strength, response)
+        finally:
+            pool.close()
+            pool.join()
+
+        nrrd.write(self._output_file_name, strength)
+
+        #Trick to fix space directions: the projection wipes out this information
         tmpCommand = "unu 2op gt %(input)s -3000 | unu 2op x - %(output)s -w 0 -o %(output)s -t float"
         tmpCommand = tmpCommand % {'input':self._input_file_name,'output':self._output_file_name}
         subprocess.call( tmpCommand, shell=True )
 
         self.clean_tmp_dir()
 
+    def execute_numpy(self):
+        """Same as 'execute', but in-process. The input volume is clamped
+        (and down-sampled), and the feature strength is computed from the
+        scale-normalized Hessian of its Gaussian blurrings at the probe
+        scales. Only the output volume is written.
+        """
+        engine = PreprocessingEngine()
+        data, options = engine.read(self._input_file_name)
+        if self._downSamplingRate > 1:
+            data, options = engine.down_sample_data(data, options,
+                                                    'cubic:0,0.5',
+                                                    self._downSamplingRate)
+        data = engine.clamp(data, self._minIntensity, self._maxIntensity)
+
+        engine.write(self._output_file_name,
+                     self.compute_feature_strength(data, options), options)
+
+        self.clean_tmp_dir()
+
+    def compute_feature_strength(self, data, options, return_scale=False):
+        """Compute the feature strength map of a volume.
+
+        The volume is processed in z-slabs of '_slab_size' slices. Each slab
+        is extended by a halo covering the support of the largest Gaussian,
+        so the result does not depend on the slab size. For every probe
+        scale, the scale-normalized Hessian eigenvalues of the slab are
+        clamped and folded into a running minimum (ridges) or maximum
+        (valleys), so only one scale is held in memory at a time.
+
+        Parameters
+        ----------
+        data : array, shape ( X, Y, Z )
+            Clamped input volume
+
+        options : dict
+            NRRD header of data
+
+        return_scale : bool (optional)
+            Also return the probe scale at which the strength of every voxel
+            is reached. Default is False.
+
+        Returns
+        -------
+        strength : array, shape ( X, Y, Z )
+            Feature strength map (float32)
+
+        scale : array, shape ( X, Y, Z )
+            Probe scale of every voxel (float32). Only if 'return_scale' is
+            True.
+        """
+        project, clamp_range = self.get_projection()
+
+        # Derivatives with respect to world coordinates
+        to_world = np.linalg.inv(get_space_directions(options))
+        index = self.get_eigenvalue_index()
+
+        # Radius of the Gaussian kernels used by gaussian_filter
+        halo = int(4.0*max(self._probe_scales) + 0.5)
+
+        size = data.shape[2]
+        strength = np.empty(data.shape, dtype=np.float32)
+        if return_scale == True:
+            scale = np.empty(data.shape, dtype=np.float32)
+        for core_start in xrange(0, size, self._slab_size):
+            core_stop = min(size, core_start + self._slab_size)
+            start = max(0, core_start - halo)
+            stop = min(size, core_stop + halo)
+            slab = data[:, :, start:stop].astype(np.float32)
+
+            slab_strength = None
+            slab_scale = None
+            for sigma in self._probe_scales:
+                hess = get_hessian(slab, sigma)[:, :, core_start - start: \
+                                                core_stop - start]
+                hess = np.einsum('ij,...jk,lk->...il', to_world, hess,
+                                 to_world)*sigma**2
+                evals = np.linalg.eigvalsh(hess)[..., index]
+                evals = np.minimum(np.maximum(evals, clamp_range[0]),
+                                   clamp_range[1])
+                if slab_strength is None:
+                    slab_strength = evals
+                    slab_scale = np.full(evals.shape, sigma, dtype=np.float32)
+                else:
+                    projected = project(slab_strength, evals)
+                    slab_scale[projected != slab_strength] = sigma
+                    slab_strength = projected
+
+            strength[:, :, core_start:core_stop] = slab_strength
+            if return_scale == True:
+                scale[:, :, core_start:core_stop] = slab_scale
+
+        if return_scale == True:
+            return strength, scale
+
+        return strength
+
     def probe_volume( self, inputVolume,outputVolume, probe_scale, normalizedDerivatives=0 ):
 
         featureStrength= self.get_feature_strength_from_feature_type(self._feature_type)
@@ -205,3 +359,50 @@ class FeatureStrengthMap:
             print "Cleaning temporary directory..."
             tmpCommand = "/bin/rm " + os.path.join(self._tmp_dir,"*")
             subprocess.call( tmpCommand, shell=True )
+            for scale_dir in self._scale_dirs:
+                shutil.rmtree(scale_dir, ignore_errors=True)
+            self._scale_dirs = list()
+
+def _probe_scale(args):
+    """Probe the feature strength at one scale for
+    'FeatureStrengthMap.execute', in the working directory 'scale_dir'.
+    Defined at module level so that it can be used by a process pool.
+
+    Returns
+    -------
+    output_volume : string
+        File name of the scale response
+    """
+    fsm, scale_dir, input_volume, output_volume, probe_scale = args
+    fsm = copy.copy(fsm)
+    fsm._tmp_dir = scale_dir
+    fsm.probe_volume(input_volume, output_volume, probe_scale, 1)
+
+    return output_volume
+
+def get_hessian(data, sigma):
+    """Hessian of the Gaussian blurring of a volume, in index space, with
+    bleed (nearest) boundaries.
+
+    Parameters
+    ----------
+    data : array, shape ( X, Y, Z )
+
+    sigma : float
+        Standard deviation of the Gaussian, in samples
+
+    Returns
+    -------
+    hess : array, shape ( X, Y, Z, 3, 3 )
+    """
+    hess = np.empty(data.shape + (3, 3), dtype=data.dtype)
+    for ii in xrange(3):
+        for jj in xrange(ii, 3):
+            order = [0, 0, 0]
+            order[ii] += 1
+            order[jj] += 1
+            hess[..., ii, jj] = gaussian_filter(data, sigma, order=order,
+                                                mode='nearest')
+            hess[..., jj, ii] = hess[..., ii, jj]
+
+    return hess
@@ -81,23 +81,28 @@ class FissureParticles(ChestParticles):
  
     def execute(self):
         #Pre-processing
-        if self._down_sample_rate > 1:
-            downsampled_vol = os.path.join(self._tmp_dir, "ct-down.nrrd")
-            self.down_sample(self._in_file_name, downsampled_vol, \
-                             "cubic:0,0.5",self._down_sample_rate)
-            if self._use_mask == True:
-            	downsampled_mask = os.path.join(self._tmp_dir, \
-                                                "mask-down.nrrd")
-            	self.down_sample(self._mask_file_name, \
-                        downsampled_mask, "cheap",self._down_sample_rate)
-            	self._tmp_mask_file_name = downsampled_mask
-            
+        if self._preprocessed == True:
+            # Shared preprocessing (see MultiFeatureParticles)
+            deconvolved_vol = self._sp_in_file_name
+            self._tmp_mask_file_name = self._sp_mask_file_name
         else:
-            downsampled_vol = self._in_file_name
-            self._tmp_mask_file_name = self._mask_file_name
+            if self._down_sample_rate > 1:
+                downsampled_vol = os.path.join(self._tmp_dir, "ct-down.nrrd")
+                self.down_sample(self._in_file_name, downsampled_vol, \
+                                 "cubic:0,0.5",self._down_sample_rate)
+                if self._use_mask == True:
+                    downsampled_mask = os.path.join(self._tmp_dir, \
+                                                    "mask-down.nrrd")
+                    self.down_sample(self._mask_file_name, \
+                        downsampled_mask, "cheap",self._down_sample_rate)
+                    self._tmp_mask_file_name = downsampled_mask
+
+            else:
+                downsampled_vol = self._in_file_name
+                self._tmp_mask_file_name = self._mask_file_name
 
-        deconvolved_vol = os.path.join(self._tmp_dir, "ct-deconv.nrrd")
-        self.deconvolve(downsampled_vol, deconvolved_vol)
+            deconvolved_vol = os.path.join(self._tmp_dir, "ct-deconv.nrrd")
+            self.deconvolve(downsampled_vol, deconvolved_vol)
               
         #Setting member variables that will not change
         self._tmp_in_file_name = deconvolved_vol
@@ -200,6 +205,8 @@ class FissureParticles(ChestParticles):
             self.adjust_scale(out_particles % 3)
         self.save_vtk(out_particles % 3)
 
+        self.write_run_report()
+
         #Clean tmp Directory
         self.clean_tmp_dir()
 
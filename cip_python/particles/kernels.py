@@ -0,0 +1,177 @@
+import math
+import numpy as np
+from scipy.signal import lfilter
+
+class Kernel:
+    """Symmetric, piecewise polynomial reconstruction kernel.
+
+    Parameters
+    ----------
+    name : string
+        Name of the kernel
+
+    pieces : list of numpy.poly1d
+        The i-th polynomial gives the kernel value for |x| in [i, i+1). The
+        kernel is zero for |x| >= len(pieces).
+    """
+    def __init__(self, name, pieces):
+        self.name = name
+        self._pieces = pieces
+        self.support = len(pieces)
+
+    def evaluate(self, x, derivative=0):
+        """Evaluate the kernel (or one of its derivatives).
+
+        Parameters
+        ----------
+        x : array
+            Positions at which to evaluate the kernel
+
+        derivative : int (optional)
+            Order of the derivative. Default is 0.
+
+        Returns
+        -------
+        values : array, same shape as x
+        """
+        x = np.asarray(x, dtype=np.float64)
+        ax = np.abs(x)
+        values = np.zeros(x.shape)
+        for ii, piece in enumerate(self._pieces):
+            sel = (ax >= ii) & (ax < ii + 1)
+            values[sel] = piece.deriv(derivative)(ax[sel]) if derivative > 0 \
+              else piece(ax[sel])
+
+        # Odd derivatives of a symmetric kernel are antisymmetric
+        if derivative % 2 == 1:
+            values *= np.sign(x)
+
+        return values
+
+    def get_integer_samples(self):
+        """Get the kernel values at the integers 0, 1, ..., support-1.
+        """
+        return self.evaluate(np.arange(self.support))
+
+    def get_prefilter_poles(self):
+        """Get the poles of the recursive filter that inverts the
+        convolution with the integer samples of the kernel.
+
+        Returns
+        -------
+        poles : list of float
+            Real poles with magnitude smaller than one
+        """
+        samples = self.get_integer_samples()
+        # z^(n-1) times the symbol of the sampled kernel
+        coeffs = np.concatenate((samples[:0:-1], samples))
+        if coeffs.shape[0] == 1:
+            return []
+        roots = np.roots(coeffs)
+        poles = [r.real for r in roots if abs(r) < 1]
+        assert np.all(np.abs(np.imag(roots)) < 1e-10), \
+          "Complex prefilter poles are not supported"
+
+        return sorted(poles)
+
+def _bspline_pieces(degree):
+    """Piecewise polynomials of the centered B-spline of odd degree.
+    """
+    assert degree % 2 == 1, "Only odd degree B-splines are supported"
+    c = (degree + 1)/2
+    pieces = list()
+    for m in xrange(c):
+        piece = np.poly1d([0.])
+        for k in xrange(m + c + 1):
+            coeff = (-1)**k*math.factorial(degree + 1)/ \
+              (math.factorial(k)*math.factorial(degree + 1 - k))
+            piece = piece + coeff*np.poly1d([1., c - k])**degree
+        pieces.append(piece/float(math.factorial(degree)))
+
+    return pieces
+
+# C4 hexic kernel (teem's 'c4h'): C4 continuous, support 6, 4th order
+# accurate, non-interpolating
+_c4hexic_pieces = [
+    np.poly1d([1./16, -7./12, 19./16, 0., -23./16, 0., 69./80]),
+    np.poly1d([-3./32, 25./24, -147./32, 10., -341./32, 35./8, 3./160]),
+    np.poly1d([1./32, -61./120, 109./32, -12., 747./32, -189./8, 1539./160])]
+
+# Kernels indexed by the names used for '_recon_kernel_type'
+KERNELS = {
+    "Bspline3": Kernel("bspl3", _bspline_pieces(3)),
+    "Bspline5": Kernel("bspl5", _bspline_pieces(5)),
+    "Bspline7": Kernel("bspl7", _bspline_pieces(7)),
+    "C4": Kernel("c4h", _c4hexic_pieces)}
+
+def get_kernel(kernel_type):
+    """Get a reconstruction kernel by type ('Bspline3', 'Bspline5',
+    'Bspline7' or 'C4'). Unknown types default to 'C4', as in
+    ChestParticles.set_kernel_params.
+    """
+    if kernel_type in KERNELS:
+        return KERNELS[kernel_type]
+
+    return KERNELS["C4"]
+
+def prefilter(data, kernel):
+    """Compute the coefficients that, convolved with 'kernel', interpolate
+    the input samples. This is the in-memory counterpart of
+    'unu resample -s x1 x1 x1 -k <kernel>ai' with bleed boundaries.
+
+    Parameters
+    ----------
+    data : array
+        Input samples. Every axis is filtered.
+
+    kernel : Kernel
+        Reconstruction kernel
+
+    Returns
+    -------
+    coefficients : array, shape of data
+        Prefiltered data (float32 unless the input is float64)
+    """
+    dtype = np.float64 if data.dtype == np.float64 else np.float32
+
+    for axis in xrange(data.ndim):
+        data = prefilter_axis(data, kernel, axis)
+
+    return data.astype(dtype, copy=False)
+
+def prefilter_axis(data, kernel, axis):
+    """Prefilter data along a single axis. See 'prefilter'.
+    """
+    for z in kernel.get_prefilter_poles():
+        gain = (1. - z)*(1. - 1./z)
+        first = np.take(data, [0], axis=axis)
+
+        # Causal filter with the signal extended by its first sample
+        data = lfilter([1.], [1., -z], data, axis=axis,
+                       zi=first*z/(1. - z))[0]
+
+        # Anti-causal filter, run on the reversed signal
+        data = _reverse(data, axis)
+        last = np.take(data, [0], axis=axis)
+        data = lfilter([-z], [1., -z], data, axis=axis,
+                       zi=-last*z*z/(1. - z))[0]
+        data = _reverse(data, axis)*data.dtype.type(gain)
+
+    return data
+
+def _reverse(data, axis):
+    index = [slice(None)]*data.ndim
+    index[axis] = slice(None, None, -1)
+    return data[tuple(index)]
+
+def catmull_rom(x):
+    """Catmull-Rom cubic (teem's 'cubic:0,0.5'), support 4.
+    """
+    ax = np.abs(np.asarray(x, dtype=np.float64))
+    values = np.zeros(ax.shape)
+    sel = ax < 1
+    values[sel] = 1.5*ax[sel]**3 - 2.5*ax[sel]**2 + 1.
+    sel = (ax >= 1) & (ax < 2)
+    values[sel] = -0.5*ax[sel]**3 + 2.5*ax[sel]**2 - 4.*ax[sel] + 2.
+
+    return values
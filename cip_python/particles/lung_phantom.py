@@ -0,0 +1,535 @@
+#!/usr/bin/python
+
+import math
+from optparse import OptionParser
+import numpy as np
+from scipy.special import erf
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk
+from cip_python.particles.nrrd_utils import ChunkedNRRDWriter
+
+# Chest region and type values, as in Common/cipChestConventions.h. Label
+# map values are ( type << 8 ) + region.
+UNDEFINEDREGION = 0
+RIGHTSUPERIORLOBE = 4
+RIGHTMIDDLELOBE = 5
+RIGHTINFERIORLOBE = 6
+LEFTSUPERIORLOBE = 7
+LEFTINFERIORLOBE = 8
+AIRWAY = 2
+VESSEL = 3
+OBLIQUEFISSURE = 8
+HORIZONTALFISSURE = 9
+
+# Intensities (HU)
+AIR = -1000.
+PARENCHYMA = -850.
+SOFT_TISSUE = 40.
+AIRWAY_WALL = 0.
+FISSURE = -650.
+
+# Lungs: (center, semi-axes) of ellipsoids, in mm (LPS coordinates, the
+# volume is centered on the origin)
+RIGHT_LUNG = (np.array([-70., 0., 0.]), np.array([55., 80., 120.]))
+LEFT_LUNG = (np.array([70., 0., 0.]), np.array([50., 80., 115.]))
+
+# Oblique fissures: planes through the lungs from posterior-superior to
+# anterior-inferior. The superior lobes are on the negative side.
+OBLIQUE_NORMAL = np.array([0., 140., -160.])/np.sqrt(140.**2 + 160.**2)
+OBLIQUE_OFFSET = np.array([0., 0., -10.])
+
+# Height of the horizontal fissure of the right lung, which splits the
+# superior side of the oblique fissure into the superior and middle lobes
+HORIZONTAL_HEIGHT = 15.
+
+class LungPhantom:
+    """Synthetic CT-like chest volume with branching vessel and airway trees
+    of known radii and fissure-like sheets, with its label map and ground
+    truth particles.
+
+    The anatomy is defined in world coordinates (mm) over a fixed field of
+    view, so the phantom can be sampled at any size: the spacing is the
+    field of view divided by the size. Two ellipsoidal lungs in a soft tissue
+    body contain airway and vessel trees (radii decrease by 2^(-1/3) at
+    every bifurcation) and oblique and horizontal fissures that split them
+    into lobes. The image is blurred by a Gaussian point spread function
+    through its analytic partial volume profiles.
+
+    Volumes are rendered and written by slabs of slices, so memory use does
+    not depend on the number of slices.
+
+    Parameters
+    ----------
+    size : tuple of ints (optional)
+        Number of voxels along each axis. Default is ( 128, 128, 110 ).
+
+    field_of_view : tuple of floats (optional)
+        Extent of the volume along each axis, in mm. Default is ( 350, 350,
+        300 ).
+
+    airway_generations : int (optional)
+        Number of airway generations, from the trachea. Default is 7.
+
+    vessel_generations : int (optional)
+        Number of vessel generations. Default is 7.
+
+    psf : float (optional)
+        Standard deviation of the point spread function, in mm. Default is
+        0.6.
+
+    noise : float (optional)
+        Standard deviation of the additive Gaussian noise, in HU. Default is
+        0.
+
+    seed : int (optional)
+        Seed of the random branching angles and noise. Default is 0.
+
+    slab_size : int (optional)
+        Number of slices rendered at a time. Default is 16.
+    """
+    def __init__(self, size=(128, 128, 110), field_of_view=(350., 350., 300.),
+                 airway_generations=7, vessel_generations=7, psf=0.6,
+                 noise=0., seed=0, slab_size=16):
+        self._size = tuple(size)
+        self._field_of_view = np.array(field_of_view, dtype=np.float64)
+        self._airway_generations = airway_generations
+        self._vessel_generations = vessel_generations
+        self._psf = psf
+        self._noise = noise
+        self._seed = seed
+        self._slab_size = slab_size
+        self._fissure_width = 1.
+        self._min_radius = 0.4
+
+        self._spacing = self._field_of_view/np.array(self._size)
+        self._origin = -self._field_of_view/2. + self._spacing/2.
+
+        random_state = np.random.RandomState(self._seed)
+        self._airways = self.get_airway_tree(random_state)
+        self._vessels = self.get_vessel_tree(random_state)
+
+    def get_options(self):
+        """Get the NRRD header of the phantom volumes.
+        """
+        return {'space': 'left-posterior-superior',
+                'space directions': [['%.17g' % v for v in row] \
+                                     for row in np.diag(self._spacing)],
+                'space origin': ['%.17g' % v for v in self._origin]}
+
+    def get_airway_tree(self, random_state):
+        """Get the airway segments: the trachea, the main bronchi and a
+        tree from every main bronchus.
+
+        Returns
+        -------
+        segments : array, shape ( N, 8 )
+            Start point, end point, radius and generation of every segment
+        """
+        carina = np.array([0., 0., 50.])
+        segments = [np.concatenate((carina + [0, 0, 90], carina, [9., 0]))]
+        for lung, direction, length, radius in \
+          [(RIGHT_LUNG, [-0.6, 0.1, -0.4], 35., 7.),
+           (LEFT_LUNG, [0.7, 0.1, -0.5], 45., 6.)]:
+            direction = np.array(direction)/np.linalg.norm(direction)
+            segments += get_tree(carina, direction, radius, length, 1,
+                                 self._airway_generations, self._min_radius,
+                                 lung, random_state)
+
+        return np.array(segments)
+
+    def get_vessel_tree(self, random_state):
+        """Get the vessel segments: a tree from the hilum of every lung. See
+        'get_airway_tree'.
+        """
+        segments = list()
+        for lung, root, direction in \
+          [(RIGHT_LUNG, [-40., 10., 10.], [-0.5, 0.3, 0.2]),
+           (LEFT_LUNG, [40., 10., 10.], [0.5, 0.3, 0.2])]:
+            direction = np.array(direction)/np.linalg.norm(direction)
+            segments += get_tree(np.array(root), direction, 6., 30., 0,
+                                 self._vessel_generations, self._min_radius,
+                                 lung, random_state)
+
+        return np.array(segments)
+
+    def get_airway_wall_thickness(self, radius):
+        return np.maximum(0.2*radius, 0.5)
+
+    def render(self, start, stop):
+        """Render a slab of the phantom.
+
+        Parameters
+        ----------
+        start, stop : int
+            Slices of the slab
+
+        Returns
+        -------
+        ct : array, shape ( X, Y, stop - start )
+            int16 intensities
+
+        labels : array, shape ( X, Y, stop - start )
+            uint16 ChestConventions label map
+        """
+        coords = [self._origin[axis] + self._spacing[axis]* \
+                  np.arange(self._size[axis], dtype=np.float64) \
+                  for axis in xrange(3)]
+        coords[2] = coords[2][start:stop]
+        x = coords[0][:, np.newaxis, np.newaxis]
+        y = coords[1][np.newaxis, :, np.newaxis]
+        z = coords[2][np.newaxis, np.newaxis, :]
+        shape = (self._size[0], self._size[1], stop - start)
+
+        # Body and lungs
+        body = ((x/160.)**2 + (y/120.)**2 < 1)*np.ones(shape)
+        image = AIR + (SOFT_TISSUE - AIR)*body
+        regions = np.zeros(shape, dtype=np.uint16)
+        types = np.zeros(shape, dtype=np.uint16)
+        for lung, superior, inferior, middle in \
+          [(RIGHT_LUNG, RIGHTSUPERIORLOBE, RIGHTINFERIORLOBE, RIGHTMIDDLELOBE),
+           (LEFT_LUNG, LEFTSUPERIORLOBE, LEFTINFERIORLOBE, None)]:
+            center, axes = lung
+            radial = np.sqrt(((x - center[0])/axes[0])**2 + \
+                             ((y - center[1])/axes[1])**2 + \
+                             ((z - center[2])/axes[2])**2)
+            inside = radial < 1
+            # Approximate distance to the lung surface
+            fraction = self.get_profile((1 - radial)*axes.min())
+            image = image + (PARENCHYMA - image)*fraction
+
+            oblique = get_oblique_distance(x, y, z, lung)*np.ones(shape)
+            lobes = np.where(oblique < 0, superior, inferior)
+            sheets = [(oblique, OBLIQUEFISSURE, inside)]
+            if middle is not None:
+                horizontal = (z - HORIZONTAL_HEIGHT)*np.ones(shape)
+                lobes[(oblique < 0) & (horizontal < 0)] = middle
+                sheets.append((horizontal, HORIZONTALFISSURE,
+                               inside & (oblique < 0)))
+            regions[inside] = lobes[inside]
+
+            for distance, fissure_type, where in sheets:
+                profile = np.exp(-distance**2/ \
+                                 (2*(self._fissure_width**2 + self._psf**2)))
+                image = image + (FISSURE - PARENCHYMA)*profile*where* \
+                  (fraction > 0.5)
+                types[where & (np.abs(distance) <= \
+                               0.5*self._spacing.max())] = fissure_type
+
+        # Vessels, then airway walls and lumens on top
+        vessels = self.get_coverage(self._vessels, coords, 0.)
+        image = image + (SOFT_TISSUE - image)*vessels[0]
+        types[vessels[1]] = VESSEL
+
+        walls = self.get_coverage(self._airways, coords, 1.)
+        image = image + (AIRWAY_WALL - image)*walls[0]
+        lumens = self.get_coverage(self._airways, coords, 0.)
+        image = image + (AIR - image)*lumens[0]
+        types[walls[1]] = AIRWAY
+
+        if self._noise > 0:
+            random_state = np.random.RandomState([self._seed, start])
+            image = image + random_state.normal(0, self._noise, shape)
+
+        ct = np.round(np.clip(image, -1024, 3071)).astype(np.int16)
+        labels = (types << 8) + regions
+
+        return ct, labels
+
+    def get_profile(self, distance):
+        """Partial volume fraction of the inside of a boundary, at a signed
+        distance (positive inside) from it, blurred by the point spread
+        function.
+        """
+        return 0.5*(1 + erf(distance/(np.sqrt(2)*self._psf)))
+
+    def get_coverage(self, segments, coords, wall):
+        """Partial volume fraction and label mask of a set of tubes within a
+        slab.
+
+        Parameters
+        ----------
+        segments : array, shape ( N, 8 )
+
+        coords : list of arrays
+            World coordinates of the samples along each axis
+
+        wall : float
+            0 for the tubes themselves, 1 to add the airway wall thickness
+            to their radii
+
+        Returns
+        -------
+        fraction : array
+
+        mask : array of bool
+        """
+        shape = tuple([c.shape[0] for c in coords])
+        fraction = np.zeros(shape)
+        mask = np.zeros(shape, dtype=bool)
+        for segment in segments:
+            p0, p1, radius = segment[0:3], segment[3:6], segment[6]
+            radius += wall*self.get_airway_wall_thickness(radius)
+            margin = radius + 4*self._psf
+
+            # Bounding box of the segment within the slab
+            ranges = list()
+            for axis in xrange(3):
+                low = min(p0[axis], p1[axis]) - margin
+                high = max(p0[axis], p1[axis]) + margin
+                first, last = np.searchsorted(coords[axis], [low, high])
+                if first >= last:
+                    break
+                ranges.append((first, last))
+            if len(ranges) < 3:
+                continue
+
+            sub = [coords[axis][ranges[axis][0]:ranges[axis][1]] \
+                   for axis in xrange(3)]
+            points = [sub[0][:, np.newaxis, np.newaxis] - p0[0],
+                      sub[1][np.newaxis, :, np.newaxis] - p0[1],
+                      sub[2][np.newaxis, np.newaxis, :] - p0[2]]
+            axis_vector = p1 - p0
+            t = np.clip((points[0]*axis_vector[0] + points[1]*axis_vector[1] + \
+                         points[2]*axis_vector[2])/np.dot(axis_vector,
+                                                          axis_vector), 0, 1)
+            distance = np.sqrt((points[0] - t*axis_vector[0])**2 + \
+                               (points[1] - t*axis_vector[1])**2 + \
+                               (points[2] - t*axis_vector[2])**2)
+
+            block = tuple([slice(first, last) for first, last in ranges])
+            fraction[block] = np.maximum(fraction[block],
+                                         self.get_profile(radius - distance))
+            mask[block] |= distance < radius
+
+        return fraction, mask
+
+    def get_tube_particles(self, segments):
+        """Ground truth particles along the axes of a set of tubes.
+
+        Returns
+        -------
+        points : array, shape ( N, 3 )
+
+        arrays : dict
+            'scale' (expected particle scale, in voxels), 'radius' (mm),
+            'generation' and 'direction' (axis direction)
+        """
+        step = self._spacing.min()
+        root_generation = np.min(segments[:, 7])
+        points = list()
+        radii = list()
+        generations = list()
+        directions = list()
+        for segment in segments:
+            p0, p1 = segment[0:3], segment[3:6]
+            length = np.linalg.norm(p1 - p0)
+            # Sibling segments start at the end point of their parent: their
+            # first sample is skipped so that bifurcations are not duplicated
+            first = 0.
+            if segment[7] > root_generation:
+                first = step
+            t = np.arange(first, length, step)/length
+            points.append(p0 + t[:, np.newaxis]*(p1 - p0))
+            radii.append(np.full(t.shape[0], segment[6]))
+            generations.append(np.full(t.shape[0], segment[7]))
+            directions.append(np.tile((p1 - p0)/length, (t.shape[0], 1)))
+
+        radii = np.concatenate(radii)
+        # The scale-normalized response of a solid tube of radius r peaks
+        # at a scale of about r/sqrt(2)
+        return np.concatenate(points), \
+          {'scale': radii/(np.sqrt(2)*self._spacing.mean()), 'radius': radii,
+           'generation': np.concatenate(generations),
+           'direction': np.concatenate(directions)}
+
+    def get_fissure_particles(self):
+        """Ground truth particles on the fissures, on a grid of the minimum
+        spacing. See 'get_tube_particles'.
+
+        Returns
+        -------
+        points : array, shape ( N, 3 )
+
+        arrays : dict
+            'scale' (expected particle scale, in voxels), 'chest_type' and
+            'normal'
+        """
+        step = self._spacing.min()
+        grid = np.arange(-150., 150., step)
+        u, v = [g.ravel() for g in np.meshgrid(grid, grid, indexing='ij')]
+        tangent = np.cross(OBLIQUE_NORMAL, [1., 0., 0.])
+
+        points = list()
+        types = list()
+        normals = list()
+        for lung in [RIGHT_LUNG, LEFT_LUNG]:
+            center, axes = lung
+            oblique = center + OBLIQUE_OFFSET + u[:, np.newaxis]*[1., 0, 0] + \
+              v[:, np.newaxis]*tangent
+            sheets = [(oblique, OBLIQUEFISSURE, OBLIQUE_NORMAL)]
+            if lung is RIGHT_LUNG:
+                horizontal = np.column_stack(
+                    (center[0] + u, center[1] + v,
+                     np.full(u.shape[0], HORIZONTAL_HEIGHT)))
+                horizontal = horizontal[get_oblique_distance(
+                    horizontal[:, 0], horizontal[:, 1], horizontal[:, 2],
+                    lung) < 0]
+                sheets.append((horizontal, HORIZONTALFISSURE,
+                               np.array([0., 0., 1.])))
+
+            for sheet, fissure_type, normal in sheets:
+                radial = np.sum(((sheet - center)/axes)**2, axis=1)
+                sheet = sheet[radial < 1]
+                points.append(sheet)
+                types.append(np.full(sheet.shape[0], fissure_type))
+                normals.append(np.tile(normal, (sheet.shape[0], 1)))
+
+        points = np.concatenate(points)
+        return points, \
+          {'scale': np.full(points.shape[0], np.sqrt(self._fissure_width**2 + \
+                                                     self._psf**2)/ \
+                            self._spacing.mean()),
+           'chest_type': np.concatenate(types),
+           'normal': np.concatenate(normals)}
+
+    def execute(self, ct_file_name, label_map_file_name=None,
+                vessel_particles_file_name=None,
+                airway_particles_file_name=None,
+                fissure_particles_file_name=None):
+        """Write the phantom volume, and optionally its label map and ground
+        truth particles (VTK).
+        """
+        ct_writer = ChunkedNRRDWriter(ct_file_name, self._size, np.int16,
+                                      self.get_options())
+        label_writer = None
+        if label_map_file_name is not None:
+            label_writer = ChunkedNRRDWriter(label_map_file_name, self._size,
+                                             np.uint16, self.get_options())
+
+        for start in xrange(0, self._size[2], self._slab_size):
+            ct, labels = self.render(start, min(self._size[2],
+                                                start + self._slab_size))
+            ct_writer.write(ct)
+            if label_writer is not None:
+                label_writer.write(labels)
+
+        ct_writer.close()
+        if label_writer is not None:
+            label_writer.close()
+
+        # Orientation arrays named as in the particles of each structure
+        if vessel_particles_file_name is not None:
+            points, arrays = self.get_tube_particles(self._vessels)
+            arrays['hevec0'] = arrays.pop('direction')
+            write_particles_vtk(vessel_particles_file_name, points, arrays)
+        if airway_particles_file_name is not None:
+            points, arrays = self.get_tube_particles(self._airways)
+            arrays['hevec2'] = arrays.pop('direction')
+            write_particles_vtk(airway_particles_file_name, points, arrays)
+        if fissure_particles_file_name is not None:
+            points, arrays = self.get_fissure_particles()
+            arrays['hevec2'] = arrays.pop('normal')
+            write_particles_vtk(fissure_particles_file_name, points, arrays)
+
+def get_oblique_distance(x, y, z, lung):
+    """Signed distance to the oblique fissure of a lung (negative on the
+    side of the superior lobe).
+    """
+    origin = lung[0] + OBLIQUE_OFFSET
+    return (x - origin[0])*OBLIQUE_NORMAL[0] + \
+      (y - origin[1])*OBLIQUE_NORMAL[1] + (z - origin[2])*OBLIQUE_NORMAL[2]
+
+def get_tree(root, direction, radius, length, generation, generations,
+             min_radius, lung, random_state):
+    """Grow a bifurcating tree of segments within a lung. Child radii are
+    2^(-1/3) times the parent radius (Murray's law for symmetric
+    bifurcations), child lengths 0.75 times the parent length, and the
+    branching angles are random between 25 and 40 degrees. Branches that
+    leave the lung are not added.
+
+    Returns
+    -------
+    segments : list of arrays
+        Start point, end point, radius and generation of every segment
+    """
+    segments = list()
+    stack = [(root, direction, radius, length, generation)]
+    center, axes = lung
+    while len(stack) > 0:
+        start, direction, radius, length, generation = stack.pop()
+        end = start + length*direction
+        if np.sum(((end - center)/axes)**2) >= 1:
+            continue
+        segments.append(np.concatenate((start, end, [radius, generation])))
+
+        child_radius = radius*2**(-1/3.)
+        if generation + 1 >= generations or child_radius < min_radius:
+            continue
+
+        # Children in a random plane through the parent axis
+        normal = np.cross(direction, random_state.normal(size=3))
+        normal /= np.linalg.norm(normal)
+        for sign in [1, -1]:
+            angle = sign*math.radians(random_state.uniform(25, 40))
+            child = direction*math.cos(angle) + \
+              np.cross(normal, direction)*math.sin(angle)
+            stack.append((end, child, child_radius, 0.75*length,
+                          generation + 1))
+
+    return segments
+
+def write_particles_vtk(file_name, points, arrays):
+    """Write points with point data arrays as VTK poly data.
+
+    Parameters
+    ----------
+    file_name : string
+
+    points : array, shape ( N, 3 )
+
+    arrays : dict
+        Arrays of shape ( N ) or ( N, C ), by name
+    """
+    poly_data = vtk.vtkPolyData()
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_to_vtk(np.ascontiguousarray(points,
+                                                         dtype=np.float32),
+                                    deep=1))
+    poly_data.SetPoints(vtk_points)
+    for name, array in arrays.items():
+        vtk_array = numpy_to_vtk(np.ascontiguousarray(array,
+                                                      dtype=np.float32),
+                                 deep=1)
+        vtk_array.SetName(name)
+        poly_data.GetPointData().AddArray(vtk_array)
+
+    writer = vtk.vtkPolyDataWriter()
+    writer.SetFileName(file_name)
+    writer.SetFileTypeToBinary()
+    writer.SetInputData(poly_data)
+    writer.Write()
+
+if __name__ == "__main__":
+    parser = OptionParser(description='Synthetic lung phantom generator')
+    parser.add_option("-o", help='output CT volume', dest="output_ct")
+    parser.add_option("-l", help='output label map', dest="output_lm",
+                      default=None)
+    parser.add_option("--size", help='comma-separated size (default \
+                      128,128,110)', dest="size", default="128,128,110")
+    parser.add_option("--vessels", help='output ground truth vessel \
+                      particles (vtk format)', dest="vessels", default=None)
+    parser.add_option("--airways", help='output ground truth airway \
+                      particles (vtk format)', dest="airways", default=None)
+    parser.add_option("--fissures", help='output ground truth fissure \
+                      particles (vtk format)', dest="fissures", default=None)
+    parser.add_option("--noise", help='noise standard deviation in HU \
+                      (default 0)', dest="noise", default=0.)
+    parser.add_option("--seed", help='random seed (default 0)', dest="seed",
+                      default=0)
+
+    (op, args) = parser.parse_args()
+
+    phantom = LungPhantom([int(s) for s in op.size.split(',')],
+                          noise=float(op.noise), seed=int(op.seed))
+    phantom.execute(op.output_ct, op.output_lm, op.vessels, op.airways,
+                    op.fissures)
@@ -0,0 +1,250 @@
+import os
+import multiprocessing
+from optparse import OptionParser
+from cip_python.particles.preprocessing_engine import PreprocessingEngine
+
+class MultiFeatureParticles:
+    """Run the particles of several features (e.g. airways, vessels and
+    fissures) of the same CT in one invocation, sharing their preprocessing.
+
+    The preprocessing of every feature is split into its products: the crop
+    to the mask, the down-sampled volume and mask, and the clamped and
+    deconvolved volume. Features that need the same product (same input,
+    down-sampling rate, intensity range, inverse kernel and engine) share
+    it, so every distinct product is computed once. Crops are shared by all
+    the features with the same volume and mask, with the largest margin.
+    The puller passes, probing and VTK output of all the features are then
+    run concurrently in a process pool.
+
+    Only features whose 'execute' relies on 'preprocessing' (or honors
+    '_preprocessed', as FissureParticles) benefit from the sharing.
+    Multi-resolution features preprocess every level on their own and are
+    not accepted. Pool workers cannot start pools of their own, so tiled
+    features ('_tiles' larger than 1) are run one after the other in this
+    process, after the pool of the other features.
+
+    Parameters
+    ----------
+    features : list of ChestParticles
+        Configured particles of every feature (e.g. VesselParticles,
+        AirwayParticles, FissureParticles). Every feature must have its own
+        temporary directory.
+
+    tmp_dir : string
+        Directory in which the shared preprocessing products are stored
+
+    processes : int (optional)
+        Number of features run at a time. Default is one process per
+        feature.
+    """
+    def __init__(self, features, tmp_dir, processes=None):
+        for particles in features:
+            assert hasattr(particles, '_multi_res_levels') == False, \
+              "Multi-resolution features cannot share preprocessing"
+        tmp_dirs = [particles._tmp_dir for particles in features]
+        assert len(set(tmp_dirs)) == len(tmp_dirs) and \
+          tmp_dir not in tmp_dirs, \
+          "Every feature needs its own temporary directory"
+
+        self._features = features
+        self._tmp_dir = tmp_dir
+        self._processes = processes
+        if os.path.exists(self._tmp_dir) == False:
+            os.makedirs(self._tmp_dir)
+
+        # Shared products (file names), indexed by the key of their inputs
+        # and parameters
+        self._products = dict()
+
+    def get_product(self, key, prefix):
+        """Get the file name of a shared product, and whether it still has to
+        be computed.
+
+        Parameters
+        ----------
+        key : tuple
+            Inputs and parameters of the product
+
+        prefix : string
+            Prefix of the file name (e.g. 'ct-down')
+
+        Returns
+        -------
+        file_name : string
+
+        new : bool
+            True if the product was not computed yet
+        """
+        if key in self._products:
+            return self._products[key], False
+
+        file_name = os.path.join(self._tmp_dir, "%s-%d.nrrd" % \
+                                 (prefix, len(self._products)))
+        self._products[key] = file_name
+
+        return file_name, True
+
+    def crop(self):
+        """Crop the volume and mask of the features that crop to their mask,
+        once per volume and mask, with the largest margin of the features.
+
+        Returns
+        -------
+        inputs : list of tuples
+            (volume, mask) file names from which every feature is
+            preprocessed
+        """
+        margins = dict()
+        for particles in self._features:
+            if self.uses_crop(particles):
+                key = (particles._in_file_name, particles._mask_file_name)
+                margins[key] = max(margins.get(key, 0),
+                                   particles.get_crop_margin())
+
+        crops = dict()
+        engine = PreprocessingEngine()
+        for (in_file_name, mask_file_name), margin in margins.items():
+            if 'space origin' not in engine.read_header(in_file_name):
+                continue
+            key = ('crop', in_file_name, mask_file_name)
+            cropped_vol, new = self.get_product(key, "ct-crop")
+            cropped_mask = cropped_vol.replace("ct-crop", "mask-crop")
+            if new == True:
+                engine.crop_to_mask(in_file_name, mask_file_name,
+                                    cropped_vol, cropped_mask, margin)
+            crops[(in_file_name, mask_file_name)] = (cropped_vol,
+                                                     cropped_mask)
+
+        inputs = list()
+        for particles in self._features:
+            key = (particles._in_file_name, particles._mask_file_name)
+            if self.uses_crop(particles) and key in crops:
+                inputs.append(crops[key])
+            else:
+                inputs.append(key)
+
+        return inputs
+
+    def uses_crop(self, particles):
+        return particles._crop_to_mask == True and \
+          particles._use_mask == True and particles._mask_file_name is not None
+
+    def preprocess(self):
+        """Compute the shared preprocessing products and point every feature
+        to them ('_sp_in_file_name', '_sp_mask_file_name').
+        """
+        for particles, (in_file_name, mask_file_name) in \
+          zip(self._features, self.crop()):
+            rate = particles._down_sample_rate
+            engine = particles._preprocessing_engine
+            downsampled_vol = in_file_name
+            if rate > 1:
+                key = ('down', in_file_name, rate, engine)
+                downsampled_vol, new = self.get_product(key, "ct-down")
+                if new == True:
+                    particles.down_sample(in_file_name, downsampled_vol,
+                                          'cubic:0,0.5', rate)
+
+            sp_mask_file_name = mask_file_name
+            if rate > 1 and particles._use_mask == True and \
+              mask_file_name is not None:
+                key = ('down', mask_file_name, rate, engine)
+                sp_mask_file_name, new = self.get_product(key, "mask-down")
+                if new == True:
+                    particles.down_sample(mask_file_name, sp_mask_file_name,
+                                          'cheap', rate)
+
+            key = ('deconvolve', downsampled_vol, particles._min_intensity,
+                   particles._max_intensity,
+                   particles._inverse_kernel_params, engine)
+            deconvolved_vol, new = self.get_product(key, "ct-deconv")
+            if new == True:
+                particles.deconvolve(downsampled_vol, deconvolved_vol)
+
+            particles._sp_in_file_name = deconvolved_vol
+            particles._sp_mask_file_name = sp_mask_file_name
+            particles._preprocessed = True
+
+    def execute(self):
+        """Preprocess and run all the features.
+
+        Returns
+        -------
+        out_particles : list of strings
+            Output particles file name of every feature
+        """
+        self.preprocess()
+
+        # Tiled passes use their own process pool
+        pooled = [particles for particles in self._features \
+                  if particles._tiles <= 1]
+        serial = [particles for particles in self._features \
+                  if particles._tiles > 1]
+
+        if len(pooled) > 0:
+            processes = self._processes
+            if processes is None:
+                processes = len(pooled)
+            pool = multiprocessing.Pool(processes)
+            try:
+                pool.map(_execute_feature, pooled)
+            finally:
+                pool.close()
+                pool.join()
+
+        map(_execute_feature, serial)
+
+        return [particles._out_particles_file_name \
+                for particles in self._features]
+
+def _execute_feature(particles):
+    """Run the particles of one feature of 'MultiFeatureParticles.execute'.
+    Defined at module level so that it can be used by a process pool.
+    """
+    particles.execute()
+
+if __name__ == "__main__":
+    from cip_python.particles.airway_particles import AirwayParticles
+    from cip_python.particles.vessel_particles import VesselParticles
+    from cip_python.particles.fissure_particles import FissureParticles
+
+    parser = OptionParser(description='Airway, vessel and fissure particles \
+                          of a CT, sharing the preprocessing')
+    parser.add_option("-i", help='input CT scan', dest="input_ct")
+    parser.add_option("-m", help='input mask for seeding', dest="input_mask",
+                      default=None)
+    parser.add_option("-t", help='tmp directory. Every feature uses a \
+                      sub-directory', dest="tmp_dir")
+    parser.add_option("--airways", help='output airway particles (vtk \
+                      format)', dest="airways", default=None)
+    parser.add_option("--vessels", help='output vessel particles (vtk \
+                      format)', dest="vessels", default=None)
+    parser.add_option("--fissures", help='output fissure particles (vtk \
+                      format)', dest="fissures", default=None)
+    parser.add_option("-e", help='preprocessing engine: unu or numpy \
+                      (default unu)', dest="engine", default="unu")
+    parser.add_option("-p", help='number of features run at a time \
+                      (default all)', dest="processes", default=None)
+
+    (op, args) = parser.parse_args()
+
+    classes = [("airways", AirwayParticles, op.airways),
+               ("vessels", VesselParticles, op.vessels),
+               ("fissures", FissureParticles, op.fissures)]
+    features = list()
+    for name, feature_class, out_file_name in classes:
+        if out_file_name is None:
+            continue
+        feature_tmp_dir = os.path.join(op.tmp_dir, name)
+        if os.path.exists(feature_tmp_dir) == False:
+            os.makedirs(feature_tmp_dir)
+        particles = feature_class(op.input_ct, out_file_name,
+                                  feature_tmp_dir, op.input_mask)
+        particles._preprocessing_engine = op.engine
+        features.append(particles)
+
+    processes = None
+    if op.processes is not None:
+        processes = int(op.processes)
+    MultiFeatureParticles(features, os.path.join(op.tmp_dir, "shared"),
+                          processes).execute()
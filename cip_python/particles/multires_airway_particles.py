@@ -9,8 +9,11 @@
 import os
 import pdb
 import math
+import copy
+import multiprocessing
 from optparse import OptionParser
 from cip_python.particles.chest_particles import ChestParticles
+from cip_python.particles.resolution_pyramid import ResolutionPyramid
 
 class MultiResAirwayParticles(ChestParticles):
     """Class for multiresolution airway-specific particles sampling
@@ -55,16 +58,25 @@ class MultiResAirwayParticles(ChestParticles):
     multi_res_levels : int (optional)
         Number of multi-resolution levels for the image decomposition. Default is 2.
 
+    level_processes : int (optional)
+        Number of processes used to run the resolution levels concurrently.
+        Each level works in its own sub-directory of 'tmp_dir'. Default is
+        one process per level.
+
     """
     def __init__(self, in_file_name, out_particles_file_name, tmp_dir,
                  mask_file_name=None, max_scale=8., live_thresh=45.,
-                 seed_thresh=45., scale_samples=5, multi_res_levels=2):
+                 seed_thresh=45., scale_samples=5, multi_res_levels=2,
+                 level_processes=None):
         ChestParticles.__init__(self, feature_type="valley_line",
                             in_file_name=in_file_name,
                             out_particles_file_name=out_particles_file_name,
                             tmp_dir=tmp_dir, mask_file_name=mask_file_name,
                             max_scale=max_scale, scale_samples=scale_samples)
         self._multi_res_levels = multi_res_levels
+        self._level_processes = level_processes
+        self._use_mask_pyramid = True
+        self._level_mask_ready = False
         self._max_intensity = -400
         self._min_intensity = -1100
         self._live_thresh = live_thresh
@@ -75,23 +87,55 @@ class MultiResAirwayParticles(ChestParticles):
         max_scale_per_level = int(math.ceil(self._max_scale / 2**(self._multi_res_levels-1)))
         max_scale = self._max_scale
         mask_file_name = self._mask_file_name
-        #Run particles for each level
-        output_particles_list = list()
+        #Run particles for each level, each one in its own directory
+        levels = list()
         for res_level in range(self._multi_res_levels,0,-1):
-            self._down_sample_rate = 2**(res_level-1)
-            self._max_scale = max_scale_per_level
-            particles_per_level=self.execute_airway_level( res_level )
+            level_particles = copy.copy(self)
+            level_particles._down_sample_rate = 2**(res_level-1)
+            level_particles._max_scale = max_scale_per_level
+            level_particles._tmp_dir = self.get_level_dir(res_level)
+            level_particles._run_report = None
+            if os.path.exists(level_particles._tmp_dir) == False:
+                os.makedirs(level_particles._tmp_dir)
+            levels.append((level_particles, res_level))
+
+        if self._use_mask_pyramid == True:
+            with self.get_stage("mask pyramid"):
+                self.build_level_masks(levels)
+
+        with self.get_stage("levels"):
+            if self._tiles > 1:
+                # Tiled passes use their own process pool
+                results = map(_execute_airway_level, levels)
+            else:
+                if self._level_processes is None:
+                    processes = len(levels)
+                else:
+                    processes = self._level_processes
+                pool = multiprocessing.Pool(processes)
+                try:
+                    results = pool.map(_execute_airway_level, levels)
+                finally:
+                    pool.close()
+                    pool.join()
+
+        output_particles_list = list()
+        for (level_particles, res_level), (particles_per_level, stages) in \
+          zip(levels, results):
             output_particles_list.append(particles_per_level)
+            self.add_run_report_stages(stages, "level%d/" % res_level)
 
-        #Merge particles and run final step for uniform redistribution along all the scales
+        #Run final step for uniform redistribution along all the scales
         merged_particles = os.path.join(self._tmp_dir, "merged-particles.nrrd")
-        self.merge_particles(output_particles_list,merged_particles)
 
         #Fix max scale & downsampling rate and perform final point redistribution
         #Deconvolution is not necessary because is in the cache from the last pass in the
         #resolution pyramid
         self._max_scale = max_scale
-        self._tmp_in_file_name = os.path.join(self._tmp_dir, "ct-deconv.nrrd")
+        self._down_sample_rate = 1
+        self._tmp_in_file_name = os.path.join(self.get_level_dir(1),
+                                              "ct-deconv.nrrd")
+        self._sp_in_file_name = self._tmp_in_file_name
 
         self._init_mode = "Particles"
         self._in_particles_file_name = merged_particles
@@ -107,6 +151,10 @@ class MultiResAirwayParticles(ChestParticles):
         self._use_strength = True
             
         self._iterations = 50
+
+        # Merge the levels. If '_merge_radius' is set, the duplicates are
+        # judged with the interaction radius of the final pass
+        self.merge_particles(output_particles_list,merged_particles)
             
         # Build parameters and run
         self.reset_params()
@@ -123,9 +171,38 @@ class MultiResAirwayParticles(ChestParticles):
         self.save_vtk(merged_particles)
         print "finished saving\#####n"
   
+        self.write_run_report()
+
         #Clean tmp Directory
         self.clean_tmp_dir()
 
+    def build_level_masks(self, levels):
+        """Compute the masks of all the resolution levels at once, in memory,
+        and write them to the level directories as 'mask-down.nrrd'. The
+        masks are then reused by the levels instead of being computed by
+        every level from the original mask with 'down_sample' and
+        'differential_mask', which give the same masks.
+        """
+        if self._use_mask == False or self._mask_file_name is None or \
+          self._multi_res_levels < 2:
+            return
+
+        pyramid = ResolutionPyramid(self._mask_file_name)
+        for level_particles, res_level in levels:
+            rate = level_particles._down_sample_rate
+            out_file_name = os.path.join(level_particles._tmp_dir,
+                                         "mask-down.nrrd")
+            if res_level == self._multi_res_levels:
+                pyramid.write_level_mask(out_file_name, rate)
+            else:
+                pyramid.write_level_mask(out_file_name, rate, 2*rate)
+            level_particles._level_mask_ready = True
+
+    def get_level_dir(self, level):
+        """Get the working directory of a resolution level.
+        """
+        return os.path.join(self._tmp_dir, "level%d" % level)
+
     def execute_airway_level (self,level):
         #Pre-processing
         if self._down_sample_rate > 1:
@@ -135,7 +212,10 @@ class MultiResAirwayParticles(ChestParticles):
             if self._use_mask == True:
                 downsampled_mask = os.path.join(self._tmp_dir, \
                                                 "mask-down.nrrd")
-                if level == self._multi_res_levels:
+                if self._level_mask_ready == True:
+                    #Already computed by the resolution pyramid
+                    pass
+                elif level == self._multi_res_levels:
                     #First level of pyramid. Just downsample the original mask
                     self.down_sample(self._mask_file_name, \
                                  downsampled_mask, "cheap",self._down_sample_rate)
@@ -145,16 +225,20 @@ class MultiResAirwayParticles(ChestParticles):
                     self.differential_mask(self._down_sample_rate,2*self._down_sample_rate,downsampled_mask)
             
                 self._tmp_mask_file_name = downsampled_mask
+                self._sp_mask_file_name = downsampled_mask
         
         else:
             downsampled_vol = self._in_file_name
             if self._multi_res_levels > 1:
                 downsampled_mask = os.path.join(self._tmp_dir, \
                                             "mask-down.nrrd")
-                self.differential_mask(self._down_sample_rate,2*self._down_sample_rate,downsampled_mask)
+                if self._level_mask_ready == False:
+                    self.differential_mask(self._down_sample_rate,2*self._down_sample_rate,downsampled_mask)
                 self._tmp_mask_file_name = downsampled_mask
+                self._sp_mask_file_name = downsampled_mask
             else:
                 self._tmp_mask_file_name = self._mask_file_name
+                self._sp_mask_file_name = self._mask_file_name
 
         deconvolved_vol = os.path.join(self._tmp_dir, "ct-deconv.nrrd")
         self.deconvolve(downsampled_vol, deconvolved_vol)
@@ -167,6 +251,7 @@ class MultiResAirwayParticles(ChestParticles):
         print "level "+str(level)+"seed th: "+str(self._seed_thresh)+"live th: "+str(self._live_thresh)
         #Setting member variables that will not change
         self._tmp_in_file_name = deconvolved_vol
+        self._sp_in_file_name = deconvolved_vol
                   
         # Temporary nrrd particles points
         out_particles = os.path.join(self._tmp_dir, "pass%d-l%d.nrrd")
@@ -252,6 +337,23 @@ class MultiResAirwayParticles(ChestParticles):
                   
         return out_particles % (3,level)
 
+def _execute_airway_level(args):
+    """Run one resolution level of 'MultiResAirwayParticles.execute'.
+    Defined at module level so that it can be used by a process pool.
+
+    Returns
+    -------
+    out_particles : string
+        File name of the particles of the level
+
+    stages : list of dicts
+        Run report records of the level
+    """
+    particles, level = args
+    out_particles = particles.execute_airway_level(level)
+
+    return out_particles, particles.get_run_report_stages()
+
 if __name__ == "__main__":
     desc = """Multi-resolution scale-space particles for airway segmentation."""
     
@@ -279,7 +381,11 @@ if __name__ == "__main__":
     parser.add_option('--max_scale',  help='Max scale to consider',
                       dest='max_scale', metavar='<float>', default=10.)
     parser.add_option('--levels',  help='Number of resolution levels to use',
-                      dest='levels', metavar='<int>', default=2)            
+                      dest='levels', metavar='<int>', default=2)
+    parser.add_option('--processes',
+                      help='Number of processes used to run the resolution \
+                      levels concurrently (default is one per level)',
+                      dest='processes', metavar='<int>', default=None)            
 
     (options, args) = parser.parse_args()
 
@@ -288,10 +394,15 @@ if __name__ == "__main__":
     if options.out_file is None:
         raise ValueError("Must specify an output file")
 
+    level_processes = None
+    if options.processes is not None:
+        level_processes = int(options.processes)
+
     particles = MultiResAirwayParticles(options.ct_file, options.out_file,
                                         options.tmp_dir, options.mask_file,
                                         live_thresh=float(options.live_thresh),
                                         seed_thresh=float(options.seed_thresh),
                                         max_scale=float(options.max_scale),
-                                        multi_res_levels=int(options.levels))
+                                        multi_res_levels=int(options.levels),
+                                        level_processes=level_processes)
     particles.execute()
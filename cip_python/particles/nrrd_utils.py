@@ -0,0 +1,218 @@
+import numpy as np
+import nrrd
+
+def get_space_directions(options):
+    """Get the space directions of a 3D volume read with 'nrrd.read'.
+
+    Parameters
+    ----------
+    options : dict
+        NRRD header as returned by 'nrrd.read'
+
+    Returns
+    -------
+    directions : array, shape ( 3, 3 )
+        The i-th row is the world-space step between two samples along the
+        i-th axis. Defaults to the 'spacings' field (or unit spacing) when
+        there are no space directions.
+    """
+    if 'space directions' in options:
+        directions = [v for v in options['space directions'] \
+                      if v is not None and v != 'none']
+        return np.array(directions, dtype=np.float64)
+
+    spacings = options.get('spacings', [1., 1., 1.])
+    return np.diag(np.array(spacings, dtype=np.float64))
+
+def get_space_origin(options):
+    """Get the space origin of a volume read with 'nrrd.read'. Defaults to
+    zero when the header has none.
+    """
+    if 'space origin' in options:
+        return np.array(options['space origin'], dtype=np.float64)
+
+    return np.zeros(3)
+
+def get_centerings(options):
+    """Get the centering ('cell' or 'node') of each axis. Teem assumes cell
+    centering when the header does not say otherwise.
+    """
+    centerings = options.get('centerings', ['cell']*3)
+    return [c if c in ['cell', 'node'] else 'cell' for c in centerings]
+
+def set_space_geometry(options, directions, origin):
+    """Return a copy of a NRRD header with new space directions and origin.
+
+    Parameters
+    ----------
+    options : dict
+        NRRD header as returned by 'nrrd.read'
+
+    directions : array, shape ( 3, 3 )
+        Space directions, one row per axis
+
+    origin : array, shape ( 3 )
+        Space origin
+
+    Returns
+    -------
+    options : dict
+        Updated header, ready for 'nrrd.write'
+    """
+    out = dict(options)
+    for key in ['sizes', 'type', 'endian', 'dimension', 'encoding',
+                'data file', 'content', 'spacings', 'space dimension']:
+        out.pop(key, None)
+
+    if 'space' not in out:
+        out['space dimension'] = 3
+    out['space directions'] = [['%.17g' % v for v in row] \
+                               for row in directions]
+    out['space origin'] = ['%.17g' % v for v in origin]
+
+    return out
+
+def get_index_to_world(options):
+    """Get the affine map from (x, y, z) sample index to world coordinates.
+
+    Returns
+    -------
+    directions : array, shape ( 3, 3 )
+        Space directions, one row per axis
+
+    origin : array, shape ( 3 )
+        World coordinates of the sample with index ( 0, 0, 0 )
+    """
+    return get_space_directions(options), get_space_origin(options)
+
+def world_to_index(points, options):
+    """Map world coordinates to continuous sample indices.
+
+    Parameters
+    ----------
+    points : array, shape ( N, 3 )
+        World coordinates
+
+    options : dict
+        NRRD header of the volume
+
+    Returns
+    -------
+    indices : array, shape ( N, 3 )
+    """
+    directions, origin = get_index_to_world(options)
+    return np.linalg.solve(directions.T, (points - origin).T).T
+
+def read_particle_array(file_name):
+    """Read a per-particle NRRD array (puller output or probed quantity).
+
+    Parameters
+    ----------
+    file_name : string
+        NRRD file with one column per particle (sizes 'C N') or a single
+        axis of N scalars
+
+    Returns
+    -------
+    array : array, shape ( N, C )
+    """
+    data, options = nrrd.read(file_name)
+    if data.ndim == 1:
+        return data[:, np.newaxis]
+
+    return data.T
+
+def write_particle_array(file_name, array, encoding='raw'):
+    """Write a per-particle array in the layout read by ReadNRRDsWriteVTK
+    (sizes 'C N').
+
+    Parameters
+    ----------
+    file_name : string
+
+    array : array, shape ( N, C ) or ( N )
+    """
+    array = np.asarray(array)
+    if array.ndim == 1:
+        array = array[:, np.newaxis]
+
+    nrrd.write(file_name, np.asfortranarray(array.T), {'encoding': encoding})
+
+def get_particle_count(file_name):
+    """Get the number of particles in a per-particle NRRD file, reading
+    only its header.
+    """
+    f = open(file_name, 'rb')
+    try:
+        header = nrrd.read_header(f)
+    finally:
+        f.close()
+
+    return int(header['sizes'][-1])
+
+# NRRD names of the numpy (little endian) types
+NRRD_TYPES = {'i1': 'signed char', 'u1': 'unsigned char', 'i2': 'short',
+              'u2': 'unsigned short', 'i4': 'int', 'u4': 'unsigned int',
+              'i8': 'long long int', 'u8': 'unsigned long long int',
+              'f4': 'float', 'f8': 'double'}
+
+class ChunkedNRRDWriter:
+    """Writer of a 3D volume (raw encoding) slab by slab along the last
+    axis, so that the whole volume never has to be held in memory.
+
+    Parameters
+    ----------
+    file_name : string
+
+    shape : tuple of ints
+        Size of the volume ( X, Y, Z )
+
+    dtype : numpy type
+
+    options : dict
+        NRRD header with the geometry of the volume (space directions and
+        origin, and optionally space)
+    """
+    def __init__(self, file_name, shape, dtype, options):
+        self._shape = tuple(shape)
+        self._dtype = np.dtype(dtype).newbyteorder('<')
+        self._slices = 0
+
+        directions = get_space_directions(options)
+        origin = get_space_origin(options)
+        header = ["NRRD0004",
+                  "type: " + NRRD_TYPES[self._dtype.str[1:]],
+                  "dimension: 3"]
+        if 'space' in options:
+            header.append("space: " + options['space'])
+        else:
+            header.append("space dimension: 3")
+        header += ["sizes: %d %d %d" % self._shape,
+                   "space directions: " + " ".join(
+                       ["(%.17g,%.17g,%.17g)" % tuple(row) \
+                        for row in directions]),
+                   "kinds: domain domain domain",
+                   "endian: little",
+                   "encoding: raw",
+                   "space origin: (%.17g,%.17g,%.17g)" % tuple(origin)]
+
+        self._file = open(file_name, 'wb')
+        self._file.write("\n".join(header) + "\n\n")
+
+    def write(self, data):
+        """Append a slab of slices.
+
+        Parameters
+        ----------
+        data : array, shape ( X, Y, N )
+        """
+        assert data.shape[0:2] == self._shape[0:2] and \
+          self._slices + data.shape[2] <= self._shape[2], \
+          "Slab does not fit in the volume"
+        self._file.write(np.asarray(data, dtype=self._dtype).tostring(
+            order='F'))
+        self._slices += data.shape[2]
+
+    def close(self):
+        self._file.close()
+        assert self._slices == self._shape[2], "Incomplete volume"
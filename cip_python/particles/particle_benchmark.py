@@ -0,0 +1,482 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import json
+import platform
+import resource
+import multiprocessing
+from optparse import OptionParser
+import numpy as np
+import vtk
+from cip_python.particles.preprocessing_engine import PreprocessingEngine
+from cip_python.particles.vessel_particles import VesselParticles
+from cip_python.particles.airway_particles import AirwayParticles
+from cip_python.particles.fissure_particles import FissureParticles
+from cip_python.particles.feature_strength_map import FeatureStrengthMap
+from cip_python.particles.run_report import RunReport
+from cip_python.particles.lung_phantom import LungPhantom
+from cip_python.particles.particle_metrics import ParticleMetrics
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+data_dir = os.path.join(this_dir, '..', '..', 'Testing', 'Data', 'Input')
+
+# Fields of a benchmark record compared against the baseline, with whether
+# larger values are worse
+BASELINE_FIELDS = [('wall_time', True), ('max_rss', True),
+                   ('particles_per_second', False),
+                   ('voxels_per_second', False), ('dice', False)]
+
+class ParticleBenchmark:
+    """Throughput benchmark of the particles tools.
+
+    VesselParticles, AirwayParticles and FeatureStrengthMap are run on the
+    bundled test volumes. VesselParticles, AirwayParticles,
+    FissureParticles and FeatureStrengthMap are run on tube and plane
+    phantoms of growing size, and VesselParticles and AirwayParticles on
+    lung phantoms (see 'LungPhantom'), whose output is also scored against
+    the ground truth particles (Dice coefficient).
+
+    Every case is run in its own process, so that its peak memory is
+    measured on its own, and gives a record with the wall time, the run
+    report stages, the number of output particles, the throughput
+    (particles or voxels per second) and the peak resident set size of the
+    case process and of its largest child (puller, unu, ...).
+
+    Parameters
+    ----------
+    tmp_dir : string
+        Directory in which the phantoms and the temporary files of every
+        case are written
+
+    sizes : list of ints (optional)
+        Sizes (voxels along each axis) of the phantoms. Default is [64].
+
+    cases : list of strings (optional)
+        Only run the cases whose name starts with one of these prefixes.
+        Default is all the cases.
+
+    numpy_engines : bool (optional)
+        Use the in-process ('numpy') preprocessing, probing and VTK writing
+        engines. Default is False.
+    """
+    def __init__(self, tmp_dir, sizes=None, cases=None, numpy_engines=False):
+        self._tmp_dir = tmp_dir
+        self._sizes = sizes
+        if self._sizes is None:
+            self._sizes = [64]
+        self._cases = cases
+        self._numpy_engines = numpy_engines
+
+    def get_cases(self):
+        """Get the benchmark cases.
+
+        Returns
+        -------
+        cases : list of dicts
+            'name', 'tool' (vessel, airway, fissure or strength), 'phantom'
+            (tube, airway_tube, plane, lung or None), 'size' (phantom size),
+            'input' and 'mask' (file names of the bundled volumes)
+        """
+        cases = [
+            {'name': 'vessel', 'tool': 'vessel', 'phantom': None,
+             'input': os.path.join(data_dir, 'vessel.nrrd'),
+             'mask': os.path.join(data_dir, 'vessel_vesselSeedsMask.nrrd')},
+            {'name': 'airway', 'tool': 'airway', 'phantom': None,
+             'input': os.path.join(data_dir, 'airway.nrrd'),
+             'mask': os.path.join(data_dir, 'airwaygauss_mask.nrrd')},
+            {'name': 'strength', 'tool': 'strength', 'phantom': None,
+             'input': os.path.join(data_dir, 'vessel.nrrd'), 'mask': None}]
+
+        for size in self._sizes:
+            cases += [
+                {'name': 'vessel-tube-%d' % size, 'tool': 'vessel',
+                 'phantom': 'tube', 'size': size},
+                {'name': 'airway-tube-%d' % size, 'tool': 'airway',
+                 'phantom': 'airway_tube', 'size': size},
+                {'name': 'fissure-plane-%d' % size, 'tool': 'fissure',
+                 'phantom': 'plane', 'size': size},
+                {'name': 'strength-tube-%d' % size, 'tool': 'strength',
+                 'phantom': 'tube', 'size': size},
+                {'name': 'vessel-lung-%d' % size, 'tool': 'vessel',
+                 'phantom': 'lung', 'size': size},
+                {'name': 'airway-lung-%d' % size, 'tool': 'airway',
+                 'phantom': 'lung', 'size': size}]
+
+        if self._cases is not None:
+            cases = [case for case in cases \
+                     if any([case['name'].startswith(prefix) \
+                             for prefix in self._cases])]
+
+        return cases
+
+    def execute(self):
+        """Run all the cases, each one in a new process.
+
+        Returns
+        -------
+        records : list of dicts
+            Benchmark record of every case (see 'run_case')
+        """
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            records = pool.map(_run_case,
+                               [(self, case) for case in self.get_cases()],
+                               chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        return records
+
+    def get_phantom(self, case):
+        """Write the phantom of a case (if not there yet) and get its input
+        volume and mask file names. Lung phantoms also get the ground truth
+        particles of the tool of the case (see 'get_reference').
+        """
+        in_file_name = os.path.join(self._tmp_dir, "%s-%d.nrrd" % \
+                                    (case['phantom'], case['size']))
+        mask_file_name = os.path.join(self._tmp_dir, "%s-%d-mask.nrrd" % \
+                                      (case['phantom'], case['size']))
+        if case['phantom'] == 'lung':
+            reference = self.get_reference(case)
+            if os.path.exists(in_file_name) == False or \
+              os.path.exists(mask_file_name) == False or \
+              os.path.exists(reference) == False:
+                # Same field of view aspect ratio as the default phantom
+                # (and same seed, so the volume of every tool is the same)
+                phantom = LungPhantom((case['size'], case['size'],
+                                       int(round(case['size']*300/350.))))
+                references = {'vessel': None, 'airway': None}
+                references[case['tool']] = reference
+                phantom.execute(in_file_name, mask_file_name,
+                                references['vessel'], references['airway'])
+            return in_file_name, mask_file_name
+
+        if os.path.exists(in_file_name) == False or \
+          os.path.exists(mask_file_name) == False:
+            if case['phantom'] == 'tube':
+                data, mask, options = make_tube_phantom(case['size'])
+            elif case['phantom'] == 'airway_tube':
+                data, mask, options = make_tube_phantom(case['size'],
+                                                        inside=-1000.,
+                                                        outside=-500.)
+            else:
+                data, mask, options = make_plane_phantom(case['size'])
+            engine = PreprocessingEngine()
+            engine.write(in_file_name, data, options)
+            engine.write(mask_file_name, mask, options)
+
+        return in_file_name, mask_file_name
+
+    def get_reference(self, case):
+        """Get the file name of the ground truth particles of a lung phantom
+        case.
+        """
+        return os.path.join(self._tmp_dir, "%s-%d-%s.vtk" % \
+                            (case['phantom'], case['size'], case['tool']))
+
+    def run_case(self, case):
+        """Run a benchmark case in this process.
+
+        Returns
+        -------
+        record : dict
+            'case', 'tool', 'date', 'host', 'voxels', 'wall_time',
+            'stages' (run report), 'particles' and 'particles_per_second'
+            (particle tools), 'voxels_per_second', 'max_rss' (bytes),
+            'children_max_rss' (bytes) and 'dice' (lung phantoms)
+        """
+        case_dir = os.path.join(self._tmp_dir, case['name'])
+        if os.path.exists(case_dir) == False:
+            os.makedirs(case_dir)
+
+        if case['phantom'] is None:
+            in_file_name, mask_file_name = case['input'], case['mask']
+        else:
+            in_file_name, mask_file_name = self.get_phantom(case)
+        voxels = int(np.prod(PreprocessingEngine().read_header(
+            in_file_name)['sizes']))
+
+        report = RunReport()
+        if case['tool'] == 'strength':
+            tool = FeatureStrengthMap("ridge_line", in_file_name,
+                                      os.path.join(case_dir, "strength.nrrd"),
+                                      case_dir)
+            if self._numpy_engines == True:
+                tool._probing_engine = "numpy"
+        else:
+            tool_class = {'vessel': VesselParticles,
+                          'airway': AirwayParticles,
+                          'fissure': FissureParticles}[case['tool']]
+            tool = tool_class(in_file_name,
+                              os.path.join(case_dir, "particles.vtk"),
+                              case_dir, mask_file_name)
+            tool._run_report_file_name = os.path.join(case_dir,
+                                                      "report.json")
+            tool._run_report = report
+            if self._numpy_engines == True:
+                tool._preprocessing_engine = "numpy"
+                tool._probing_engine = "numpy"
+                tool._save_vtk_engine = "numpy"
+
+        with report.stage("total") as total:
+            tool.execute()
+
+        record = {'case': case['name'], 'tool': case['tool'],
+                  'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  'host': platform.node(), 'voxels': voxels,
+                  'wall_time': total['wall_time'],
+                  'stages': report.get_stages()}
+
+        # The last stage with a particle count is the last puller pass
+        counts = [stage['particles'] for stage in report.get_stages() \
+                  if 'particles' in stage]
+        if len(counts) > 0 and total['wall_time'] > 0:
+            record['particles'] = counts[-1]
+            record['particles_per_second'] = counts[-1]/total['wall_time']
+        if total['wall_time'] > 0:
+            record['voxels_per_second'] = voxels/total['wall_time']
+
+        out_particles = os.path.join(case_dir, "particles.vtk")
+        if case['phantom'] == 'lung' and os.path.exists(out_particles):
+            record['dice'] = ParticleMetrics(
+                read_poly_data(self.get_reference(case)),
+                read_poly_data(out_particles),
+                case['tool']).get_particles_dice()
+
+        # ru_maxrss is in kilobytes on Linux
+        record['max_rss'] = \
+          resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+        record['children_max_rss'] = \
+          resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*1024
+
+        return record
+
+def _run_case(args):
+    """Run a case of 'ParticleBenchmark.execute'. Defined at module level so
+    that it can be used by a process pool.
+    """
+    benchmark, case = args
+    return benchmark.run_case(case)
+
+def read_poly_data(file_name):
+    reader = vtk.vtkPolyDataReader()
+    reader.SetFileName(file_name)
+    reader.Update()
+
+    return reader.GetOutput()
+
+def make_tube_phantom(size, radius=2., inside=100., outside=-900.):
+    """Straight tube with a Gaussian intensity profile, along a diagonal of a
+    cubic volume with 1 mm isotropic voxels.
+
+    Parameters
+    ----------
+    size : int
+        Number of voxels along each axis
+
+    radius : float (optional)
+        Standard deviation of the Gaussian profile, in voxels
+
+    inside : float (optional)
+        Intensity at the center of the tube
+
+    outside : float (optional)
+        Intensity away from the tube
+
+    Returns
+    -------
+    data : array, shape ( size, size, size )
+        int16 volume
+
+    mask : array, shape ( size, size, size )
+        uint16 mask of the voxels within 3 radii of the tube axis
+
+    options : dict
+        NRRD header
+    """
+    axis = np.array([1., 1., 2.])/np.sqrt(6.)
+    center = (size - 1)/2.
+    distance = np.empty((size, size, size), dtype=np.float32)
+    x, y = np.meshgrid(np.arange(size) - center, np.arange(size) - center,
+                       indexing='ij')
+    for z in xrange(size):
+        # Distance to the axis through the center of the volume
+        along = x*axis[0] + y*axis[1] + (z - center)*axis[2]
+        distance[:, :, z] = np.sqrt(np.maximum(x**2 + y**2 + \
+                                               (z - center)**2 - along**2, 0))
+
+    return _make_phantom(distance, radius, inside, outside)
+
+def make_plane_phantom(size, thickness=1., inside=-600., outside=-900.):
+    """Oblique sheet with a Gaussian intensity profile (as a fissure) through
+    the center of a cubic volume. See 'make_tube_phantom'.
+
+    Parameters
+    ----------
+    thickness : float (optional)
+        Standard deviation of the Gaussian profile, in voxels
+    """
+    normal = np.array([1., 2., 3.])/np.sqrt(14.)
+    center = (size - 1)/2.
+    distance = np.empty((size, size, size), dtype=np.float32)
+    x, y = np.meshgrid(np.arange(size) - center, np.arange(size) - center,
+                       indexing='ij')
+    for z in xrange(size):
+        distance[:, :, z] = np.abs(x*normal[0] + y*normal[1] + \
+                                   (z - center)*normal[2])
+
+    return _make_phantom(distance, thickness, inside, outside)
+
+def _make_phantom(distance, width, inside, outside):
+    data = (outside + (inside - outside)* \
+            np.exp(-distance**2/(2*width**2))).astype(np.int16)
+    mask = (distance < 3*width).astype(np.uint16)
+    options = {'space': 'left-posterior-superior',
+               'space directions': [['1', '0', '0'], ['0', '1', '0'],
+                                    ['0', '0', '1']],
+               'space origin': ['0', '0', '0']}
+
+    return data, mask, options
+
+def read_history(file_name):
+    """Read the benchmark records of a JSON-lines history file.
+
+    Returns
+    -------
+    records : list of dicts
+    """
+    records = list()
+    f = open(file_name, 'r')
+    try:
+        for line in f:
+            if line.strip() != "":
+                records.append(json.loads(line))
+    finally:
+        f.close()
+
+    return records
+
+def append_history(file_name, records):
+    """Append benchmark records to a JSON-lines history file, one record per
+    line.
+    """
+    f = open(file_name, 'a')
+    try:
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+    finally:
+        f.close()
+
+def read_baseline(file_name):
+    """Read a baseline file: a JSON object with the reference record of
+    every case, indexed by case name.
+    """
+    f = open(file_name, 'r')
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def write_baseline(file_name, records):
+    baseline = dict([(record['case'], record) for record in records])
+    f = open(file_name, 'w')
+    try:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+
+def compare_to_baseline(records, baseline, tolerance=0.2):
+    """Flag the records that are worse than their baseline by more than a
+    relative tolerance, in any of the 'BASELINE_FIELDS'.
+
+    Parameters
+    ----------
+    records : list of dicts
+        Benchmark records
+
+    baseline : dict
+        Baseline records, indexed by case name
+
+    tolerance : float (optional)
+        Relative tolerance. Default is 0.2 (20%).
+
+    Returns
+    -------
+    regressions : list of strings
+        Description of every regression
+    """
+    regressions = list()
+    for record in records:
+        if record['case'] not in baseline:
+            continue
+        reference = baseline[record['case']]
+        for field, larger_is_worse in BASELINE_FIELDS:
+            if field not in record or field not in reference or \
+              reference[field] <= 0:
+                continue
+            ratio = record[field]/float(reference[field])
+            if (larger_is_worse == True and ratio > 1 + tolerance) or \
+              (larger_is_worse == False and ratio < 1/(1. + tolerance)):
+                regressions.append("%s: %s %g (baseline %g)" % \
+                  (record['case'], field, record[field], reference[field]))
+
+    return regressions
+
+if __name__ == "__main__":
+    parser = OptionParser(description='Particles throughput benchmark')
+    parser.add_option("-t", help='tmp directory', dest="tmp_dir")
+    parser.add_option("--sizes", help='comma-separated phantom sizes \
+                      (default 64)', dest="sizes", default="64")
+    parser.add_option("--cases", help='comma-separated prefixes of the cases \
+                      to run (default all)', dest="cases", default=None)
+    parser.add_option("--numpy", help='use the in-process engines',
+                      dest="numpy_engines", action="store_true",
+                      default=False)
+    parser.add_option("--history", help='JSON-lines file to which the \
+                      records are appended', dest="history", default=None)
+    parser.add_option("--baseline", help='baseline JSON file to compare \
+                      against', dest="baseline", default=None)
+    parser.add_option("--save-baseline", help='write the records to the \
+                      baseline file instead of comparing against it',
+                      dest="save_baseline", action="store_true",
+                      default=False)
+    parser.add_option("--tolerance", help='relative tolerance of the \
+                      baseline comparison (default 0.2)', dest="tolerance",
+                      default=0.2)
+
+    (op, args) = parser.parse_args()
+
+    cases = None
+    if op.cases is not None:
+        cases = op.cases.split(',')
+    if os.path.exists(op.tmp_dir) == False:
+        os.makedirs(op.tmp_dir)
+
+    benchmark = ParticleBenchmark(op.tmp_dir,
+                                  [int(s) for s in op.sizes.split(',')],
+                                  cases, op.numpy_engines)
+    records = benchmark.execute()
+
+    for record in records:
+        print "%(case)s: %(wall_time).2f s" % record + \
+          ", %.0f particles/s" % record.get('particles_per_second', 0) + \
+          ", %.1f MB" % (max(record['max_rss'],
+                             record['children_max_rss'])/2.**20)
+
+    if op.history is not None:
+        append_history(op.history, records)
+
+    if op.baseline is not None:
+        if op.save_baseline == True:
+            write_baseline(op.baseline, records)
+        else:
+            regressions = compare_to_baseline(records,
+                                              read_baseline(op.baseline),
+                                              float(op.tolerance))
+            for regression in regressions:
+                print "Regression: " + regression
+            if len(regressions) > 0:
+                sys.exit(1)
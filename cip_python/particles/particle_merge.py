@@ -0,0 +1,119 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+def get_tile_ranges(size, tiles, halo, weights=None):
+    """Split the slices of a volume into contiguous tiles (slabs) with
+    overlapping halos.
+
+    Parameters
+    ----------
+    size : int
+        Number of slices along the tiled axis
+
+    tiles : int
+        Number of tiles
+
+    halo : int
+        Number of slices added on each side of a tile, so that the particles
+        close to the tile boundaries see the same image data (and neighbors)
+        as in an untiled run
+
+    weights : array, shape ( size ) (optional)
+        Work per slice (typically the number of mask voxels). If given, the
+        tiles span the slices with non-zero weight only and are chosen so
+        that every tile gets about the same total weight. Otherwise all the
+        slices are split evenly.
+
+    Returns
+    -------
+    ranges : list of tuples
+        (core_start, core_stop, start, stop) for every non-empty tile. The
+        slices [core_start, core_stop) are owned by the tile, [start, stop)
+        is the region (core plus halo) on which the tile is processed.
+    """
+    if weights is None:
+        weights = np.ones(size)
+    weights = np.asarray(weights, dtype=np.float64)
+
+    nonzero = np.nonzero(weights)[0]
+    if nonzero.shape[0] == 0:
+        return []
+    first = nonzero[0]
+    last = nonzero[-1] + 1
+
+    cumulative = np.cumsum(weights[first:last])
+    targets = cumulative[-1]*np.arange(1, tiles)/float(tiles)
+    cuts = first + np.searchsorted(cumulative, targets) + 1
+    bounds = np.unique(np.concatenate(([first], cuts, [last])))
+
+    ranges = list()
+    for core_start, core_stop in zip(bounds[:-1], bounds[1:]):
+        ranges.append((int(core_start), int(core_stop),
+                       int(max(0, core_start - halo)),
+                       int(min(size, core_stop + halo))))
+
+    return ranges
+
+def deduplicate_particles(points, radius, candidates=None, scales=None,
+                          scale_radius=None):
+    """Remove near-duplicate particles: of every pair of particles closer
+    than 'radius', the later one is removed, unless the earlier one was
+    itself removed (so in a chain A-B-C with A and C apart, A and C are
+    kept). Pairs are found with a single KD-tree query.
+
+    Parameters
+    ----------
+    points : array, shape ( N, 3 )
+        Particle positions
+
+    radius : float
+        Minimum distance between two particles
+
+    candidates : array, shape ( N ) (optional)
+        Boolean mask of the particles that may be duplicates (for instance,
+        the ones close to a tile boundary). Other particles are always kept
+        and not compared. Default is all the particles.
+
+    scales : array, shape ( N ) (optional)
+        Scale of the particles. If given, two particles are only duplicates
+        if they are also closer than 'scale_radius' in scale.
+
+    scale_radius : float (optional)
+        Minimum scale difference between two particles at the same position.
+        Required with 'scales'.
+
+    Returns
+    -------
+    keep : array, shape ( N )
+        Boolean mask of the particles to keep
+    """
+    keep = np.ones(points.shape[0], dtype=bool)
+    if candidates is None:
+        candidates = np.ones(points.shape[0], dtype=bool)
+
+    ids = np.nonzero(candidates)[0]
+    if ids.shape[0] < 2:
+        return keep
+
+    coordinates = points[ids]
+    pairs = cKDTree(coordinates).query_pairs(radius, output_type='ndarray')
+    if pairs.shape[0] == 0:
+        return keep
+
+    # query_pairs includes the pairs at exactly 'radius'
+    differences = coordinates[pairs[:, 0]] - coordinates[pairs[:, 1]]
+    duplicates = np.sum(differences**2, axis=1) < radius**2
+    if scales is not None:
+        duplicates &= np.abs(scales[ids[pairs[:, 0]]] - \
+                             scales[ids[pairs[:, 1]]]) < scale_radius
+
+    # The pairs are ordered (i < j): keep the earlier particle, unless it
+    # was itself removed. Sorted by first particle, the fate of every first
+    # particle is known by the time its pairs are visited.
+    pairs = ids[pairs[duplicates]]
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+    for first, second in pairs:
+        if keep[first] == True:
+            keep[second] = False
+
+    return keep
@@ -1,13 +1,18 @@
 
 import subprocess
+import multiprocessing
+from optparse import OptionParser
 import numpy as np
+import pandas as pd
 from numpy import linalg as LA
 from numpy import sum, sqrt
 import tempfile, shutil
 import vtk
 from vtk.util.numpy_support import vtk_to_numpy
+from scipy.spatial import cKDTree
 import pdb
 from cip_python.particles.vessel_particles import VesselParticles
+from cip_python.utils.particle_store import read_poly_data
 
 class ParticleMetrics:
     """Handles computation of metrics used to compare two particles data sets.
@@ -28,14 +33,6 @@ class ParticleMetrics:
         self._ref_particles = ref_particles
         self._orientation_vec = None
 
-        self._ref_locator = vtk.vtkPointLocator()
-        self._ref_locator.SetDataSet(self._ref_particles)
-        self._ref_locator.BuildLocator()
-
-        self._test_locator = vtk.vtkPointLocator()
-        self._test_locator.SetDataSet(self._test_particles)
-        self._test_locator.BuildLocator()
-
         self._dist_thresh = None
         self._angle_thresh = None
         self._scale_fraction_thresh = None
@@ -43,16 +40,39 @@ class ParticleMetrics:
         if particle_type is not None:
             assert particle_type == 'vessel' or particle_type == 'airway' or \
               particle_type == 'fissure', "Unrecognized particle type"
-            if particle_type is 'vessel':
+            if particle_type == 'vessel':
                 self._orientation_vec = 'hevec0'
-            elif particle_type is 'airway':
+            elif particle_type == 'airway':
                 self._orientation_vec = 'hevec2'
             else:
-                self._orientation_vec = 'hevec1'
+                # Normal of the (bright) fissure sheet: the eigenvector of
+                # the most negative Hessian eigenvalue
+                self._orientation_vec = 'hevec2'
         else:
             raise ValueError('Must specify a particle type')
+
+        # Positions, scales and orientation vectors are read once, and
+        # nearest neighbors are found with KD-trees
+        self._ref_arrays = get_particle_arrays(self._ref_particles,
+                                               self._orientation_vec)
+        self._ref_tree = cKDTree(self._ref_arrays[0])
+        self.set_test_particles(test_particles)
         
         self._initialize_thresholds()        
+
+    def set_test_particles(self, test_particles):
+        """Set the particles data set to be evaluated. The reference data,
+        its KD-tree and the thresholds are kept, so that several test data
+        sets can be compared to the same reference at the cost of one.
+
+        Parameters
+        ----------
+        test_particles : vtkPolyData
+        """
+        self._test_particles = test_particles
+        self._test_arrays = get_particle_arrays(self._test_particles,
+                                                self._orientation_vec)
+        self._test_tree = cKDTree(self._test_arrays[0])
         
     def get_particles_dice(self):
         """Computest the Dice coefficient between the ref and test particles
@@ -65,98 +85,75 @@ class ParticleMetrics:
             number between 0 and 1, with 1 indicating perfect agreement and 0
             indicating no agreement.
         """
-        TP = 0
-        FP = 0
-        FN = 0
-        
-        # Compute TP and FP. Loop over all the test particles, and if a match 
-        # is found amoung the ref particles, increment TP. If no matc is 
-        # found, increment FP.
-        num_test_particles = self._test_particles.GetNumberOfPoints()
-        for t in xrange(num_test_particles):
-            test_pt = self._test_particles.GetPoint(t)
-            test_scale = self._test_particles.GetPointData().\
-              GetArray('scale').GetValue(t)
-
-            test_vec = np.zeros(3)
-            test_vec[0] = self._test_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(t, 0)
-            test_vec[1] = self._test_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(t, 1)
-            test_vec[2] = self._test_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(t, 2)
-
-            id_list = vtk.vtkIdList()
-            self._ref_locator.FindClosestNPoints(1, test_pt, id_list)
-            ref_id = id_list.GetId(0)
-            
-            dist = LA.norm(np.array(test_pt) - \
-                           np.array(self._ref_particles.GetPoint(ref_id)))
-                           
-            ref_scale = self._ref_particles.GetPointData().\
-              GetArray('scale').GetValue(ref_id)
-            scale_fraction = np.min([ref_scale, test_scale])/\
-              np.max([ref_scale, test_scale])
-
-            ref_vec = np.zeros(3)
-            ref_vec[0] = self._ref_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(ref_id, 0)
-            ref_vec[1] = self._ref_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(ref_id, 1)
-            ref_vec[2] = self._ref_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(ref_id, 2)
-            angle = np.arccos(np.clip(np.dot(ref_vec, test_vec)/\
-                                LA.norm(ref_vec)/LA.norm(test_vec), -1, 1))
-
-            if dist <= self._dist_thresh and angle <= self._angle_thresh and \
-              scale_fraction >= self._scale_fraction_thresh:
-                TP += 1
-            else:
-                FP += 1
-                
-        # Compute FN
-        num_ref_particles = self._ref_particles.GetNumberOfPoints()
-        for r in xrange(num_ref_particles):
-            ref_pt = self._ref_particles.GetPoint(r)
-            ref_scale = self._ref_particles.GetPointData().\
-              GetArray('scale').GetValue(r)
-            ref_vec = np.zeros(3)              
-            ref_vec[0] = self._ref_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(r, 0)
-            ref_vec[1] = self._ref_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(r, 1)
-            ref_vec[2] = self._ref_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(r, 2)
-
-            id_list = vtk.vtkIdList()
-            self._test_locator.FindClosestNPoints(1, ref_pt, id_list)
-            test_id = id_list.GetId(0)
-            
-            dist = LA.norm(np.array(ref_pt) - \
-                           np.array(self._test_particles.GetPoint(test_id)))
-                           
-            test_scale = self._test_particles.GetPointData().\
-              GetArray('scale').GetValue(test_id)
-            scale_fraction = np.min([ref_scale, test_scale])/\
-              np.max([ref_scale, test_scale])
-
-            test_vec = np.zeros(3)
-            test_vec[0] = self._test_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(test_id, 0)
-            test_vec[1] = self._test_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(test_id, 1)
-            test_vec[2] = self._test_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(test_id, 2)
-            angle = np.arccos(np.clip(np.dot(ref_vec, test_vec)/\
-                                LA.norm(ref_vec)/LA.norm(test_vec), -1, 1))
-
-            if dist > self._dist_thresh or angle > self._angle_thresh or \
-              scale_fraction < self._scale_fraction_thresh:
-                FN += 1
+        TP, FP, FN = self.get_particles_counts()
 
         dice = 2.*TP/((FP + TP) + (TP + FN))
         return dice
-            
+
+    def get_particles_counts(self):
+        """Count the true positive, false positive and false negative
+        particles of the test data set.
+
+        Returns
+        -------
+        TP : int
+            Number of test particles matched by their closest ref particle
+
+        FP : int
+            Number of test particles not matched by their closest ref
+            particle
+
+        FN : int
+            Number of ref particles not matched by their closest test
+            particle
+        """
+        # Compute TP and FP. A test particle is a TP if its closest ref
+        # particle matches it, a FP otherwise.
+        test_matches = self._get_matches(self._test_arrays, self._ref_tree,
+                                         self._ref_arrays)
+        TP = np.sum(test_matches)
+        FP = test_matches.shape[0] - TP
+
+        # Compute FN: ref particles whose closest test particle does not
+        # match them
+        ref_matches = self._get_matches(self._ref_arrays, self._test_tree,
+                                        self._test_arrays)
+        FN = ref_matches.shape[0] - np.sum(ref_matches)
+
+        return int(TP), int(FP), int(FN)
+
+    def _get_matches(self, arrays, other_tree, other_arrays):
+        """Find, for every particle, whether its closest particle in the other
+        data set is within the distance, angle and scale thresholds.
+
+        Parameters
+        ----------
+        arrays : tuple
+            Points, scales and orientation vectors of the particles (see
+            'get_particle_arrays')
+
+        other_tree : cKDTree
+            Tree of the points of the other data set
+
+        other_arrays : tuple
+            Points, scales and orientation vectors of the other data set
+
+        Returns
+        -------
+        matches : array of bool, shape ( N )
+        """
+        points, scales, vecs = arrays
+        other_points, other_scales, other_vecs = other_arrays
+        dists, ids = other_tree.query(points)
+
+        angles, scale_fractions = get_pair_metrics(vecs, scales,
+                                                   other_vecs[ids],
+                                                   other_scales[ids])
+
+        return (dists <= self._dist_thresh) & \
+          (angles <= self._angle_thresh) & \
+          (scale_fractions >= self._scale_fraction_thresh)
+
     def _initialize_thresholds(self):
         """Use the reference particles data set to figure out the appropriate 
         thresholds for distance, scale, and angle. For each particle in the
@@ -165,48 +162,163 @@ class ParticleMetrics:
         particles are used for determining thresholds. After aggregating all
         pairwise relationships, the 99.9th percentile is used as the threshold.
         """
-        dists = []
-        angles = []
-        scale_fractions = []
-        
-        num_ref_particles = self._ref_particles.GetNumberOfPoints()
-        for r in xrange(num_ref_particles):
-            ref_pt = self._ref_particles.GetPoint(r)
-            ref_scale = self._ref_particles.GetPointData().\
-              GetArray('scale').GetValue(r)
-            ref_vec = np.zeros(3)              
-            ref_vec[0] = self._ref_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(r, 0)
-            ref_vec[1] = self._ref_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(r, 1)
-            ref_vec[2] = self._ref_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(r, 2)
-
-            id_list = vtk.vtkIdList()
-            self._ref_locator.FindClosestNPoints(2, ref_pt, id_list)
-            adj_id = id_list.GetId(1)
-            
-            dist = LA.norm(np.array(ref_pt) - \
-                           np.array(self._ref_particles.GetPoint(adj_id)))
-            dists.append(dist)
-                           
-            adj_scale = self._ref_particles.GetPointData().\
-              GetArray('scale').GetValue(adj_id)
-            scale_fraction = np.min([ref_scale, adj_scale])/\
-              np.max([ref_scale, adj_scale])
-            scale_fractions.append(scale_fraction)
-              
-            adj_vec = np.zeros(3)
-            adj_vec[0] = self._ref_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(adj_id, 0)
-            adj_vec[1] = self._ref_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(adj_id, 1)
-            adj_vec[2] = self._ref_particles.GetPointData().\
-              GetArray(self._orientation_vec).GetComponent(adj_id, 2)
-            angle = np.arccos(np.clip(np.dot(ref_vec, adj_vec)/\
-                                      LA.norm(ref_vec)/LA.norm(adj_vec), -1, 1))
-            angles.append(angle)
-            
+        points, scales, vecs = self._ref_arrays
+        # The closest particle to every particle (other than itself)
+        dists, ids = self._ref_tree.query(points, k=2)
+        dists = dists[:, 1]
+        adj_ids = ids[:, 1]
+
+        angles, scale_fractions = get_pair_metrics(vecs, scales,
+                                                   vecs[adj_ids],
+                                                   scales[adj_ids])
+
         self._dist_thresh = np.percentile(dists, 99.9)
         self._angle_thresh = np.percentile(angles, 99.9)
-        self._scale_fraction_thresh = np.percentile(scale_fractions, 0.01)     
+        self._scale_fraction_thresh = np.percentile(scale_fractions, 0.01)
+
+def get_particle_arrays(particles, orientation_vec):
+    """Get the positions, scales and orientation vectors of a particles data
+    set as arrays.
+
+    Parameters
+    ----------
+    particles : vtkPolyData
+
+    orientation_vec : string
+        Name of the orientation vector array (e.g. 'hevec0')
+
+    Returns
+    -------
+    points : array, shape ( N, 3 )
+
+    scales : array, shape ( N )
+
+    vecs : array, shape ( N, 3 )
+    """
+    point_data = particles.GetPointData()
+    points = vtk_to_numpy(particles.GetPoints().GetData()).astype(np.float64)
+    scales = vtk_to_numpy(point_data.GetArray('scale')).astype(np.float64)
+    vecs = vtk_to_numpy(point_data.GetArray(orientation_vec)).\
+      astype(np.float64).reshape(-1, 3)
+
+    return points, scales.ravel(), vecs
+
+def get_pair_metrics(vecs, scales, other_vecs, other_scales):
+    """Compute the angle between the orientation vectors and the ratio of the
+    smallest to the largest scale of pairs of particles.
+
+    Returns
+    -------
+    angles : array, shape ( N )
+        Angles in radians
+
+    scale_fractions : array, shape ( N )
+    """
+    cosines = np.sum(vecs*other_vecs, axis=1)/ \
+      LA.norm(vecs, axis=1)/LA.norm(other_vecs, axis=1)
+    angles = np.arccos(np.clip(cosines, -1, 1))
+    scale_fractions = np.minimum(scales, other_scales)/ \
+      np.maximum(scales, other_scales)
+
+    return angles, scale_fractions
+
+def compare_particle_sets(pairs, particle_type, processes=None):
+    """Compare many test particles data sets with their references (e.g.
+    the outputs of several versions of an algorithm on a cohort) in a
+    process pool.
+
+    The pairs are grouped by reference, and every group is compared in one
+    task, so that the reference is read, and its KD-tree and thresholds are
+    computed, only once.
+
+    Parameters
+    ----------
+    pairs : list of tuples
+        ( reference, test ) particles file names (VTK, '.vtk' or '.vtp')
+
+    particle_type : string
+        Either 'vessel', 'airway', or 'fissure'
+
+    processes : int (optional)
+        Number of processes. Default is one per core.
+
+    Returns
+    -------
+    comparisons : pandas DataFrame
+        One row per pair, in order, with columns 'reference', 'test', 'TP',
+        'FP', 'FN' and 'dice'
+    """
+    groups = dict()
+    for ref_file_name, test_file_name in pairs:
+        groups.setdefault(ref_file_name, []).append(test_file_name)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_compare_to_reference,
+                           [(ref_file_name, test_file_names, particle_type) \
+                            for ref_file_name, test_file_names in \
+                            groups.items()], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    rows = dict()
+    for group_rows in results:
+        for row in group_rows:
+            rows[(row['reference'], row['test'])] = row
+
+    return pd.DataFrame([rows[tuple(pair)] for pair in pairs],
+                        columns=['reference', 'test', 'TP', 'FP', 'FN',
+                                 'dice'])
+
+def _compare_to_reference(args):
+    """Compare several test particles data sets with one reference. Defined
+    at module level so that it can be used by a process pool.
+
+    Returns
+    -------
+    rows : list of dicts
+        'reference', 'test', 'TP', 'FP', 'FN' and 'dice' of every test
+    """
+    ref_file_name, test_file_names, particle_type = args
+
+    ref_particles = read_poly_data(ref_file_name)
+    pm = None
+    rows = list()
+    for test_file_name in test_file_names:
+        test_particles = read_poly_data(test_file_name)
+        if pm is None:
+            pm = ParticleMetrics(ref_particles, test_particles, particle_type)
+        else:
+            pm.set_test_particles(test_particles)
+
+        TP, FP, FN = pm.get_particles_counts()
+        rows.append({'reference': ref_file_name, 'test': test_file_name,
+                     'TP': TP, 'FP': FP, 'FN': FN,
+                     'dice': 2.*TP/((FP + TP) + (TP + FN))})
+
+    return rows
+
+if __name__ == "__main__":
+    parser = OptionParser(description='Compare test particles data sets \
+                          with reference ones (Dice, TP, FP, FN)')
+    parser.add_option("-i", help='input CSV file with the reference and test \
+                      particles file names of every pair (columns \
+                      "reference" and "test")', dest="in_csv")
+    parser.add_option("-o", help='output CSV file with the comparison of \
+                      every pair', dest="out_csv")
+    parser.add_option("-t", help='particle type: vessel, airway or fissure',
+                      dest="particle_type")
+    parser.add_option("-p", help='number of processes (default one per \
+                      core)', dest="processes", default=None)
+
+    (op, args) = parser.parse_args()
+
+    pairs = pd.read_csv(op.in_csv)
+    processes = None
+    if op.processes is not None:
+        processes = int(op.processes)
+
+    comparisons = compare_particle_sets(
+        zip(pairs['reference'], pairs['test']), op.particle_type, processes)
+    comparisons.to_csv(op.out_csv, index=False)
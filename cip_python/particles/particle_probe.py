@@ -0,0 +1,542 @@
+import os
+import hashlib
+import numpy as np
+from scipy.ndimage import gaussian_filter
+import nrrd
+from cip_python.particles.kernels import get_kernel, catmull_rom
+from cip_python.particles.scale_space_cache import hash_file
+from cip_python.particles.nrrd_utils import get_index_to_world, \
+     world_to_index
+
+# Quantities derived from the value, gradient and Hessian at each particle,
+# with the base quantities they need. Other gage quantities (e.g. 'median')
+# have to be probed on their own.
+DERIVED_QUANTITIES = {
+    "val": ["val"],
+    "gvec": ["gvec"],
+    "gmag": ["gvec"],
+    "hess": ["hess"],
+    "heval0": ["hess"],
+    "heval1": ["hess"],
+    "heval2": ["hess"],
+    "hevec0": ["hess"],
+    "hevec1": ["hess"],
+    "hevec2": ["hess"],
+    "hmode": ["hess"],
+    "lapl": ["hess"],
+    "hf": ["hess"],
+    "2dd": ["gvec", "hess"],
+    "kappa1": ["gvec", "hess"],
+    "kappa2": ["gvec", "hess"],
+    "totalcurv": ["gvec", "hess"],
+    "st": ["gvec", "hess"],
+    "si": ["gvec", "hess"],
+    "meancurv": ["gvec", "hess"],
+    "gausscurv": ["gvec", "hess"],
+    "curvdir1": ["gvec", "hess"],
+    "curvdir2": ["gvec", "hess"],
+    "flowlinecurv": ["gvec", "hess"]}
+
+def get_base_quantities(quantities):
+    """Get the base quantities ('val', 'gvec' and/or 'hess') that have to be
+    probed to derive a set of quantities.
+
+    Parameters
+    ----------
+    quantities : list of strings
+        gage quantity names
+
+    Returns
+    -------
+    base : list of strings
+        Sorted base quantity names
+    """
+    base = set()
+    for quant in quantities:
+        if quant in DERIVED_QUANTITIES:
+            base.update(DERIVED_QUANTITIES[quant])
+
+    return sorted(base)
+
+def hessian_eigen(hess):
+    """Batched eigen-decomposition of symmetric 3x3 matrices, sorted as in
+    gage (largest eigenvalue first).
+
+    Parameters
+    ----------
+    hess : array, shape ( N, 3, 3 )
+
+    Returns
+    -------
+    evals : array, shape ( N, 3 )
+
+    evecs : array, shape ( N, 3, 3 )
+        evecs[:, :, i] is the eigenvector of evals[:, i]
+    """
+    evals, evecs = np.linalg.eigh(hess)
+
+    return evals[:, ::-1], evecs[:, :, ::-1]
+
+def tensor_mode(hess):
+    """Mode of symmetric 3x3 matrices, in [-1, 1].
+    """
+    dev = hess - np.trace(hess, axis1=1, axis2=2)[:, np.newaxis, np.newaxis]/ \
+      3.*np.eye(3)[np.newaxis, :, :]
+    norm = np.sqrt(np.sum(dev**2, axis=(1, 2)))
+    mode = np.zeros(hess.shape[0])
+    valid = norm > 0
+    mode[valid] = 3*np.sqrt(6)* \
+      np.linalg.det(dev[valid]/norm[valid, np.newaxis, np.newaxis])
+
+    return np.clip(mode, -1, 1)
+
+def derive_quantities(quantities, val=None, gvec=None, hess=None,
+                      sigma=None, normalized=None):
+    """Derive gage quantities at a set of particles from the value, gradient
+    and Hessian probed once per particle.
+
+    Parameters
+    ----------
+    quantities : list of strings
+        gage quantity names (see DERIVED_QUANTITIES)
+
+    val : array, shape ( N ) (optional)
+
+    gvec : array, shape ( N, 3 ) (optional)
+
+    hess : array, shape ( N, 9 ) or ( N, 3, 3 ) (optional)
+
+    sigma : array, shape ( N ) (optional)
+        Scale of each particle. Used for scale-normalized derivatives (first
+        derivatives are multiplied by sigma, second derivatives by sigma^2,
+        as gprobe's -ssnd does).
+
+    normalized : dict (optional)
+        Maps a quantity name to True if it has to be computed from
+        scale-normalized derivatives.
+
+    Returns
+    -------
+    answers : dict
+        Maps each quantity name to an array of shape ( N ) or ( N, C )
+    """
+    if normalized is None:
+        normalized = dict()
+    if hess is not None:
+        hess = np.asarray(hess, dtype=np.float64).reshape(-1, 3, 3)
+        hess = (hess + hess.transpose(0, 2, 1))/2.
+    if gvec is not None:
+        gvec = np.asarray(gvec, dtype=np.float64).reshape(-1, 3)
+
+    cache = dict()
+    answers = dict()
+    for quant in quantities:
+        norm = bool(normalized.get(quant, False)) and sigma is not None
+        answers[quant] = _derive(quant, val, gvec, hess, sigma, norm, cache)
+
+    return answers
+
+def _derivatives(gvec, hess, sigma, norm, cache):
+    """Gradient and Hessian, scale-normalized if requested.
+    """
+    key = ('derivs', norm)
+    if key not in cache:
+        g, h = gvec, hess
+        if norm:
+            if g is not None:
+                g = g*sigma[:, np.newaxis]
+            if h is not None:
+                h = h*(sigma**2)[:, np.newaxis, np.newaxis]
+        cache[key] = (g, h)
+
+    return cache[key]
+
+def _eigen(hess, norm, cache):
+    key = ('eigen', norm)
+    if key not in cache:
+        cache[key] = hessian_eigen(hess)
+
+    return cache[key]
+
+def _curvatures(gvec, hess, norm, cache):
+    """Principal curvatures and directions of the isosurface through each
+    particle, from the geometry tensor -PHP/|g| (as in gage).
+    """
+    key = ('curv', norm)
+    if key not in cache:
+        gmag = np.sqrt(np.sum(gvec**2, axis=1))
+        safe_gmag = np.where(gmag > 0, gmag, 1.)
+        n = -gvec/safe_gmag[:, np.newaxis]
+        proj = np.eye(3)[np.newaxis, :, :] - \
+          n[:, :, np.newaxis]*n[:, np.newaxis, :]
+        geom = -np.einsum('nij,njk,nkl->nil', proj, hess, proj)/ \
+          safe_gmag[:, np.newaxis, np.newaxis]
+        geom[gmag == 0] = 0
+
+        trace = np.trace(geom, axis1=1, axis2=2)
+        frob = np.sqrt(np.sum(geom**2, axis=(1, 2)))
+        disc = np.sqrt(np.clip(2*frob**2 - trace**2, 0, None))
+        kappa1 = (trace + disc)/2.
+        kappa2 = (trace - disc)/2.
+
+        # The eigenvector along the normal (eigenvalue 0) is not a
+        # curvature direction
+        evals, evecs = np.linalg.eigh(geom)
+        along_normal = np.argmax(np.abs(np.einsum('nij,ni->nj', evecs, n)),
+                                 axis=1)
+        tangent = np.ones((gvec.shape[0], 3), dtype=bool)
+        tangent[np.arange(gvec.shape[0]), along_normal] = False
+        tangent_evecs = evecs.transpose(0, 2, 1)[tangent].reshape(-1, 2, 3)
+        tangent_evals = evals[tangent].reshape(-1, 2)
+        first = np.argmax(tangent_evals, axis=1)
+        rows = np.arange(gvec.shape[0])
+        curvdir1 = tangent_evecs[rows, first]
+        curvdir2 = tangent_evecs[rows, 1 - first]
+
+        # Curvature of the gradient flow lines
+        flow = np.einsum('nij,njk,nk->ni', proj, hess, n)
+        flowlinecurv = np.sqrt(np.sum(flow**2, axis=1))/safe_gmag
+        flowlinecurv[gmag == 0] = 0
+
+        cache[key] = {'kappa1': kappa1, 'kappa2': kappa2,
+                      'curvdir1': curvdir1, 'curvdir2': curvdir2,
+                      'flowlinecurv': flowlinecurv}
+
+    return cache[key]
+
+def _derive(quant, val, gvec, hess, sigma, norm, cache):
+    assert quant in DERIVED_QUANTITIES, \
+      "Quantity %s cannot be derived from val, gvec and hess" % quant
+    for base, arr in [('val', val), ('gvec', gvec), ('hess', hess)]:
+        assert base not in DERIVED_QUANTITIES[quant] or arr is not None, \
+          "Quantity %s requires %s" % (quant, base)
+
+    g, h = _derivatives(gvec, hess, sigma, norm, cache)
+
+    if quant == "val":
+        return np.asarray(val, dtype=np.float64).ravel()
+    elif quant == "gvec":
+        return g
+    elif quant == "gmag":
+        return np.sqrt(np.sum(g**2, axis=1))
+    elif quant == "hess":
+        return h.reshape(-1, 9)
+    elif quant in ["heval0", "heval1", "heval2"]:
+        evals, evecs = _eigen(h, norm, cache)
+        return evals[:, int(quant[-1])]
+    elif quant in ["hevec0", "hevec1", "hevec2"]:
+        evals, evecs = _eigen(h, norm, cache)
+        return evecs[:, :, int(quant[-1])]
+    elif quant == "hmode":
+        return tensor_mode(h)
+    elif quant == "lapl":
+        return np.trace(h, axis1=1, axis2=2)
+    elif quant == "hf":
+        return np.sqrt(np.sum(h**2, axis=(1, 2)))
+    elif quant == "2dd":
+        gmag2 = np.sum(g**2, axis=1)
+        dd = np.einsum('ni,nij,nj->n', g, h, g)
+        return np.where(gmag2 > 0, dd/np.where(gmag2 > 0, gmag2, 1.), 0.)
+
+    curv = _curvatures(g, h, norm, cache)
+    kappa1 = curv['kappa1']
+    kappa2 = curv['kappa2']
+    if quant in curv:
+        return curv[quant]
+    elif quant == "totalcurv":
+        return np.sqrt(kappa1**2 + kappa2**2)
+    elif quant == "meancurv":
+        return (kappa1 + kappa2)/2.
+    elif quant == "gausscurv":
+        return kappa1*kappa2
+    elif quant == "st":
+        denom = np.abs(kappa1) + np.abs(kappa2)
+        return np.where(denom > 0, (kappa1 + kappa2)/ \
+                        np.where(denom > 0, denom, 1.), 0.)
+    elif quant == "si":
+        return -2./np.pi*np.arctan2(kappa1 + kappa2, kappa1 - kappa2)
+
+def get_stack_sigmas(max_scale, scale_samples):
+    """Scales of the blurrings of a scale stack. The samples are uniform in
+    log(1 + sigma), so that there are more of them at small scales.
+
+    This approximates, but does not reproduce, the optimal sigma sampling of
+    teem ('-sso' in puller and gprobe), which comes from tables optimized
+    for the reconstruction of Gaussian blurrings. Probes across scale
+    therefore differ slightly from gprobe's.
+
+    Parameters
+    ----------
+    max_scale : float
+
+    scale_samples : int
+
+    Returns
+    -------
+    sigmas : array, shape ( scale_samples )
+    """
+    if scale_samples == 1:
+        return np.zeros(1)
+
+    return np.expm1(np.linspace(0, np.log1p(max_scale), scale_samples))
+
+class ScaleSpaceProbe:
+    """Vectorized NumPy/SciPy probe of the value, gradient and Hessian of a
+    (deconvolved) volume across scale space, at arbitrary particle
+    positions and scales.
+
+    The volume is blurred at 'scale_samples' scales. The blurrings are saved
+    as memory-mapped '.npy' files in 'stack_dir', named after the contents of
+    the input volume and the stack scales, and reused if already there (so a
+    changed input or scale sampling never picks up stale blurrings). Every
+    blurring is written under a temporary name and renamed into place, so
+    concurrent runs sharing 'stack_dir' (e.g. a scale-space cache entry)
+    never map a partially written file. Values are reconstructed in space
+    with separable kernels and their derivatives, and interpolated across
+    scale with Catmull-Rom (Hermite) weights. The scale sampling differs
+    from teem's (see 'get_stack_sigmas'), so this probe approximates gprobe
+    across scale.
+
+    Parameters
+    ----------
+    in_file_name : string
+        Deconvolved input volume
+
+    max_scale : float
+        Maximum scale of the stack
+
+    scale_samples : int
+        Number of blurrings in the stack
+
+    stack_dir : string
+        Directory in which to store the blurrings
+
+    kernel_type : string (optional)
+        Reconstruction kernel type: 'Bspline3', 'Bspline5', 'Bspline7' or
+        'C4'. Default is 'C4'.
+
+    chunk_size : int (optional)
+        Number of particles probed at a time. Default is 20000.
+    """
+    def __init__(self, in_file_name, max_scale, scale_samples, stack_dir,
+                 kernel_type="C4", chunk_size=20000):
+        self._in_file_name = in_file_name
+        self._max_scale = max_scale
+        self._scale_samples = scale_samples
+        self._stack_dir = stack_dir
+        self._kernel = get_kernel(kernel_type)
+        self._chunk_size = chunk_size
+        self._sigmas = get_stack_sigmas(max_scale, scale_samples)
+        self._options = None
+        self._stack = None
+        self._stack_key = None
+
+    def get_stack_key(self):
+        """Key of the blurrings of the stack: the SHA-1 digest of the input
+        volume contents and the stack scales.
+
+        Returns
+        -------
+        key : string
+            Hexadecimal key
+        """
+        if self._stack_key is None:
+            sha = hashlib.sha1()
+            sha.update(hash_file(self._in_file_name))
+            sha.update(" ".join(["%r" % sigma for sigma in self._sigmas]))
+            self._stack_key = sha.hexdigest()
+
+        return self._stack_key
+
+    def get_stack_file_name(self, level):
+        return os.path.join(self._stack_dir, "P-%s-%03u-%03u.npy" % \
+                            (self.get_stack_key()[:16], level,
+                             self._scale_samples))
+
+    def build_stack(self):
+        """Blur the input volume at every stack scale (unless the blurrings
+        are already in 'stack_dir') and memory-map the blurrings.
+        """
+        data, self._options = nrrd.read(self._in_file_name)
+        data = data.astype(np.float32)
+
+        self._stack = list()
+        for level, sigma in enumerate(self._sigmas):
+            file_name = self.get_stack_file_name(level)
+            if not os.path.exists(file_name):
+                blurred = gaussian_filter(data, sigma, mode='nearest') \
+                  if sigma > 0 else data
+                tmp_file_name = "%s.%d.tmp" % (file_name, os.getpid())
+                f = open(tmp_file_name, 'wb')
+                try:
+                    np.save(f, np.asfortranarray(blurred))
+                finally:
+                    f.close()
+                os.rename(tmp_file_name, file_name)
+            self._stack.append(np.load(file_name, mmap_mode='r'))
+
+    def probe(self, points, scales=None):
+        """Probe value, gradient and Hessian.
+
+        Parameters
+        ----------
+        points : array, shape ( N, 3 )
+            World coordinates of the particles
+
+        scales : array, shape ( N ) (optional)
+            Scale of each particle. Ignored for single-scale stacks.
+
+        Returns
+        -------
+        val : array, shape ( N )
+
+        gvec : array, shape ( N, 3 )
+            World-space gradient
+
+        hess : array, shape ( N, 3, 3 )
+            World-space Hessian
+        """
+        if self._stack is None:
+            self.build_stack()
+
+        num_points = points.shape[0]
+        if scales is None:
+            scales = np.zeros(num_points)
+
+        val = np.zeros(num_points)
+        gvec = np.zeros((num_points, 3))
+        hess = np.zeros((num_points, 3, 3))
+
+        for start in xrange(0, num_points, self._chunk_size):
+            stop = min(start + self._chunk_size, num_points)
+            val[start:stop], gvec[start:stop], hess[start:stop] = \
+              self._probe_chunk(points[start:stop], scales[start:stop])
+
+        # Index-space derivatives to world-space derivatives
+        directions, origin = get_index_to_world(self._options)
+        to_index = np.linalg.inv(directions.T)
+        gvec = np.dot(gvec, to_index)
+        hess = np.einsum('ji,njk,kl->nil', to_index, hess, to_index)
+
+        return val, gvec, hess
+
+    def get_scale_weights(self, scales):
+        """Catmull-Rom weights of each stack level for each particle.
+
+        Returns
+        -------
+        weights : array, shape ( N, scale_samples )
+        """
+        num_levels = self._sigmas.shape[0]
+        if num_levels == 1:
+            return np.ones((scales.shape[0], 1))
+
+        # Position of each particle in units of stack levels
+        step = np.log1p(self._max_scale)/(num_levels - 1)
+        pos = np.clip(np.log1p(np.clip(scales, 0, None))/step, 0,
+                      num_levels - 1)
+        base = np.floor(pos).astype(int)
+
+        weights = np.zeros((scales.shape[0], num_levels))
+        rows = np.arange(scales.shape[0])
+        for offset in [-1, 0, 1, 2]:
+            level = base + offset
+            w = catmull_rom(pos - level)
+            np.add.at(weights, (rows, np.clip(level, 0, num_levels - 1)), w)
+
+        return weights
+
+    def _probe_chunk(self, points, scales):
+        indices = world_to_index(points, self._options)
+        shape = self._stack[0].shape
+        support = self._kernel.support
+
+        # Sample indices and separable weights (value, first and second
+        # derivative) along each axis
+        offsets = np.arange(-support + 1, support + 1)
+        taps = list()
+        weights = list()
+        for axis in xrange(3):
+            base = np.floor(indices[:, axis]).astype(int)
+            axis_taps = base[:, np.newaxis] + offsets[np.newaxis, :]
+            dist = indices[:, axis][:, np.newaxis] - axis_taps
+            taps.append(np.clip(axis_taps, 0, shape[axis] - 1))
+            weights.append([self._kernel.evaluate(dist, d) \
+                            for d in xrange(3)])
+
+        flat = taps[0][:, :, np.newaxis, np.newaxis] + shape[0]* \
+          (taps[1][:, np.newaxis, :, np.newaxis] + \
+           shape[1]*taps[2][:, np.newaxis, np.newaxis, :])
+
+        num_points = points.shape[0]
+        derivs = dict()
+        scale_weights = self.get_scale_weights(scales)
+        for level, volume in enumerate(self._stack):
+            active = np.nonzero(scale_weights[:, level])[0]
+            if active.shape[0] == 0:
+                continue
+            neighborhood = volume.ravel(order='F')[flat[active]]
+            sw = scale_weights[active, level]
+
+            # Contract z, then y, then x
+            for dz in xrange(3):
+                along_z = np.einsum('nijk,nk->nij', neighborhood,
+                                    weights[2][dz][active])
+                for dy in xrange(3 - dz):
+                    along_y = np.einsum('nij,nj->ni', along_z,
+                                        weights[1][dy][active])
+                    for dx in xrange(3 - dz - dy):
+                        key = (dx, dy, dz)
+                        if key not in derivs:
+                            derivs[key] = np.zeros(num_points)
+                        derivs[key][active] += sw*np.einsum(
+                            'ni,ni->n', along_y, weights[0][dx][active])
+
+        val = derivs[(0, 0, 0)]
+        gvec = np.column_stack((derivs[(1, 0, 0)], derivs[(0, 1, 0)],
+                                derivs[(0, 0, 1)]))
+        hess = np.zeros((num_points, 3, 3))
+        for ii in xrange(3):
+            for jj in xrange(3):
+                order = [0, 0, 0]
+                order[ii] += 1
+                order[jj] += 1
+                hess[:, ii, jj] = derivs[tuple(order)]
+
+        return val, gvec, hess
+
+    def probe_quantities(self, in_particles, quantities, normalized=None,
+                         single_scale=False):
+        """Probe every quantity in 'quantities' at the particles of a puller
+        output file.
+
+        Parameters
+        ----------
+        in_particles : string
+            Particles NRRD file (x, y, z, scale per particle)
+
+        quantities : list of strings
+            gage quantity names (see DERIVED_QUANTITIES)
+
+        normalized : dict (optional)
+            Maps a quantity name to True if it has to be computed from
+            scale-normalized derivatives
+
+        single_scale : bool (optional)
+            If true, the particle scales are ignored
+
+        Returns
+        -------
+        answers : dict
+            Maps each quantity name to an array of shape ( N ) or ( N, C )
+        """
+        particles = nrrd.read(in_particles)[0].T
+        if single_scale or particles.shape[1] < 4:
+            scales = None
+        else:
+            scales = particles[:, 3]
+
+        val, gvec, hess = self.probe(particles[:, 0:3], scales)
+
+        return derive_quantities(quantities, val, gvec, hess, scales,
+                                 normalized)
@@ -0,0 +1,286 @@
+import numpy as np
+from scipy import sparse
+import nrrd
+from cip_python.particles.kernels import get_kernel, prefilter, catmull_rom
+from cip_python.particles.nrrd_utils import get_space_directions, \
+     get_space_origin, get_centerings, set_space_geometry
+
+class PreprocessingEngine:
+    """In-process (NumPy/SciPy) counterpart of the 'unu' pipelines that
+    ChestParticles uses to clamp, deconvolve and down-sample its input
+    volumes. Volumes are processed in memory and only the files needed by
+    puller are written to disk.
+
+    Parameters
+    ----------
+    encoding : string (optional)
+        NRRD encoding of the written files. Default is 'raw', so that the
+        files are fast to write and can be memory-mapped by readers.
+    """
+    def __init__(self, encoding='raw'):
+        self._encoding = encoding
+
+    def read(self, in_file_name):
+        """Read a volume.
+
+        Returns
+        -------
+        data : array, shape ( X, Y, Z )
+
+        options : dict
+            NRRD header
+        """
+        return nrrd.read(in_file_name)
+
+    def read_header(self, in_file_name):
+        """Read the header of a volume, without its data.
+        """
+        f = open(in_file_name, 'rb')
+        try:
+            return nrrd.read_header(f)
+        finally:
+            f.close()
+
+    def write(self, out_file_name, data, options):
+        """Write a volume, keeping the geometry and key/value pairs of
+        'options'.
+        """
+        out = set_space_geometry(options, get_space_directions(options),
+                                 get_space_origin(options))
+        out['encoding'] = self._encoding
+        nrrd.write(out_file_name, np.asfortranarray(data), out)
+
+    def clamp(self, data, min_intensity, max_intensity):
+        """Counterpart of 'unu 3op clamp'. Returns float32 data.
+        """
+        return np.clip(data.astype(np.float32), min_intensity, max_intensity)
+
+    def deconvolve_data(self, data, kernel_type):
+        """Counterpart of 'unu resample -s x1 x1 x1 -k <kernel>ai -t float'.
+
+        Parameters
+        ----------
+        data : array
+
+        kernel_type : string
+            Reconstruction kernel type ('Bspline3', 'Bspline5', 'Bspline7' or
+            'C4'). If None, the data are only converted to float, as 'unu
+            resample -s x1 x1 x1' does when no kernel is given.
+        """
+        if kernel_type is None:
+            return data.astype(np.float32)
+
+        return prefilter(data, get_kernel(kernel_type))
+
+    def down_sample_data(self, data, options, kernel, down_rate):
+        """Counterpart of 'unu resample -s x<1/rate> x<1/rate> x<1/rate> -k
+        <kernel>' with bleed boundaries and renormalized weights.
+
+        Parameters
+        ----------
+        data : array, shape ( X, Y, Z )
+
+        options : dict
+            NRRD header of data
+
+        kernel : string
+            Either 'cubic:0,0.5' (Catmull-Rom, stretched when down-sampling)
+            or 'cheap' (nearest sample)
+
+        down_rate : float
+            Down-sampling rate. Values below 1 up-sample.
+
+        Returns
+        -------
+        data : array
+
+        options : dict
+            NRRD header with the updated geometry
+        """
+        directions = get_space_directions(options).copy()
+        origin = get_space_origin(options).copy()
+        centerings = get_centerings(options)
+
+        for axis in xrange(3):
+            in_size = data.shape[axis]
+            out_size = max(1, int(round(in_size/float(down_rate))))
+            positions = get_sample_positions(in_size, out_size,
+                                             centerings[axis])
+            weights = get_resampling_weights(positions, in_size, kernel)
+            data = apply_along_axis(weights, data, axis)
+
+            origin += positions[0]*directions[axis]
+            if out_size > 1:
+                directions[axis] *= positions[1] - positions[0]
+
+        return data, set_space_geometry(options, directions, origin)
+
+    def crop_data(self, data, options, start, stop):
+        """Counterpart of 'unu crop -min <start> -max <stop - 1>'. The space
+        origin is moved so that the cropped samples keep their world
+        coordinates.
+
+        Parameters
+        ----------
+        data : array, shape ( X, Y, Z )
+
+        options : dict
+            NRRD header of data
+
+        start : array, shape ( 3 )
+            Index of the first sample kept along each axis
+
+        stop : array, shape ( 3 )
+            Index past the last sample kept along each axis
+
+        Returns
+        -------
+        data : array
+
+        options : dict
+            NRRD header with the updated geometry
+        """
+        directions = get_space_directions(options)
+        origin = get_space_origin(options) + np.dot(start, directions)
+        data = data[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]]
+
+        return data, set_space_geometry(options, directions, origin)
+
+    def crop_to_mask(self, in_file_name, mask_file_name, out_file_name,
+                     out_mask_file_name, margin):
+        """Crop a volume and its mask to the bounding box of the mask,
+        extended by 'margin' samples on each side, from file to file.
+        """
+        mask, mask_options = self.read(mask_file_name)
+        start, stop = get_bounding_box(mask, margin)
+        out, out_options = self.crop_data(mask, mask_options, start, stop)
+        self.write(out_mask_file_name, out, out_options)
+
+        data, options = self.read(in_file_name)
+        out, out_options = self.crop_data(data, options, start, stop)
+        self.write(out_file_name, out, out_options)
+
+    def deconvolve(self, in_file_name, out_file_name, min_intensity,
+                   max_intensity, kernel_type):
+        """Clamp and deconvolve a volume, from file to file.
+        """
+        data, options = self.read(in_file_name)
+        data = self.clamp(data, min_intensity, max_intensity)
+        self.write(out_file_name, self.deconvolve_data(data, kernel_type),
+                   options)
+
+    def down_sample(self, in_file_name, out_file_name, kernel, down_rate):
+        """Down-sample a volume, from file to file. Label maps keep their
+        type when the 'cheap' kernel is used.
+        """
+        data, options = self.read(in_file_name)
+        out, out_options = self.down_sample_data(data, options, kernel,
+                                                 down_rate)
+        if kernel == 'cheap':
+            out = out.astype(data.dtype)
+        self.write(out_file_name, out, out_options)
+
+    def preprocess(self, in_file_name, out_file_name, min_intensity,
+                   max_intensity, kernel_type, down_rate=1):
+        """Down-sample (if needed), clamp and deconvolve a volume in memory
+        and write only the final deconvolved volume.
+        """
+        data, options = self.read(in_file_name)
+        if down_rate > 1:
+            data, options = self.down_sample_data(data, options,
+                                                  'cubic:0,0.5', down_rate)
+        data = self.clamp(data, min_intensity, max_intensity)
+        self.write(out_file_name, self.deconvolve_data(data, kernel_type),
+                   options)
+
+def get_bounding_box(mask, margin=0):
+    """Bounding box of the non-zero samples of a mask.
+
+    Parameters
+    ----------
+    mask : array, shape ( X, Y, Z )
+
+    margin : int (optional)
+        Number of samples added on each side. The box is clipped to the
+        volume. Default is 0.
+
+    Returns
+    -------
+    start : array, shape ( 3 )
+        Index of the first sample in the box along each axis
+
+    stop : array, shape ( 3 )
+        Index past the last sample in the box along each axis. The whole
+        volume is returned if the mask is empty.
+    """
+    shape = np.array(mask.shape)
+    start = np.zeros(3, dtype=int)
+    stop = shape.copy()
+    for axis in xrange(3):
+        other_axes = tuple([ii for ii in xrange(3) if ii != axis])
+        nonzero = np.nonzero(np.any(mask != 0, axis=other_axes))[0]
+        if nonzero.shape[0] == 0:
+            return np.zeros(3, dtype=int), shape
+        start[axis] = max(0, nonzero[0] - margin)
+        stop[axis] = min(shape[axis], nonzero[-1] + 1 + margin)
+
+    return start, stop
+
+def get_sample_positions(in_size, out_size, centering):
+    """Positions, in input sample index space, of the output samples of a
+    resampling from 'in_size' to 'out_size' samples.
+    """
+    out_index = np.arange(out_size, dtype=np.float64)
+    if centering == 'node' and out_size > 1:
+        return out_index*(in_size - 1)/float(out_size - 1)
+
+    return (out_index + 0.5)*in_size/float(out_size) - 0.5
+
+def get_resampling_weights(positions, in_size, kernel):
+    """Sparse matrix mapping input samples to output samples.
+
+    Parameters
+    ----------
+    positions : array
+        Positions of the output samples in input index space
+
+    in_size : int
+        Number of input samples
+
+    kernel : string
+        'cubic:0,0.5' or 'cheap'
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix, shape ( len(positions), in_size )
+    """
+    out_size = positions.shape[0]
+    if kernel == 'cheap':
+        cols = np.clip(np.floor(positions + 0.5), 0, in_size - 1).astype(int)
+        return sparse.csr_matrix((np.ones(out_size), (np.arange(out_size),
+                                  cols)), shape=(out_size, in_size))
+
+    assert kernel == 'cubic:0,0.5', "Unsupported resampling kernel"
+
+    # Stretch the kernel when down-sampling so that it also low-pass filters
+    stretch = max(1., in_size/float(out_size))
+    radius = int(np.ceil(2*stretch))
+    offsets = np.arange(-radius + 1, radius + 1)
+    taps = np.floor(positions)[:, np.newaxis] + offsets[np.newaxis, :]
+    values = catmull_rom((positions[:, np.newaxis] - taps)/stretch)
+    values /= values.sum(axis=1)[:, np.newaxis]
+
+    rows = np.repeat(np.arange(out_size), offsets.shape[0])
+    cols = np.clip(taps, 0, in_size - 1).astype(int).ravel()
+    return sparse.csr_matrix((values.ravel(), (rows, cols)),
+                             shape=(out_size, in_size))
+
+def apply_along_axis(weights, data, axis):
+    """Apply a (sparse) resampling matrix along one axis of a volume.
+    """
+    moved = np.rollaxis(data, axis)
+    shape = moved.shape
+    out = weights.dot(moved.reshape(shape[0], -1).astype(np.float32))
+    out = np.asarray(out, dtype=np.float32).reshape((weights.shape[0],) + \
+                                                    shape[1:])
+    return np.rollaxis(out, 0, axis + 1)
@@ -0,0 +1,163 @@
+import numpy as np
+from cip_python.particles.preprocessing_engine import PreprocessingEngine, \
+     get_sample_positions
+from cip_python.particles.nrrd_utils import get_space_directions, \
+     get_space_origin, get_centerings, set_space_geometry
+
+class ResolutionPyramid:
+    """In-memory pyramid of a binary mask for multi-resolution particles.
+
+    The mask is read once. The mask of every down-sampling rate is computed
+    with a block maximum (a down-sampled voxel is in the mask if any of the
+    voxels within its cell is), on the same grid as the volumes down-sampled by
+    'ChestParticles.down_sample'. The interior of every level (the
+    down-sampled voxels whose cell is entirely in the mask) is computed with
+    a block minimum. Differential masks between levels are computed from the
+    cached level masks.
+
+    Parameters
+    ----------
+    mask_file_name : string
+        File name of the full resolution mask. Non-zero voxels are in the
+        mask.
+    """
+    def __init__(self, mask_file_name):
+        self._engine = PreprocessingEngine()
+        mask, self._options = self._engine.read(mask_file_name)
+        self._masks = {1: mask != 0}
+        self._interiors = {1: self._masks[1]}
+
+    def get_size(self, rate):
+        """Get the size of the volumes down-sampled by 'rate'.
+        """
+        return [max(1, int(round(size/float(rate)))) \
+                for size in self._masks[1].shape]
+
+    def get_mask(self, rate):
+        """Get the mask down-sampled by 'rate' (cached).
+
+        Parameters
+        ----------
+        rate : int
+            Down-sampling rate
+
+        Returns
+        -------
+        mask : array of bool
+        """
+        if rate not in self._masks:
+            mask = self._masks[1]
+            for axis, out_size in enumerate(self.get_size(rate)):
+                mask = block_max(mask, out_size, axis)
+            self._masks[rate] = mask
+
+        return self._masks[rate]
+
+    def get_interior_mask(self, rate):
+        """Get the down-sampled voxels, at down-sampling rate 'rate', whose
+        cell is entirely within the mask (cached).
+
+        Returns
+        -------
+        mask : array of bool
+        """
+        if rate not in self._interiors:
+            mask = self._masks[1]
+            for axis, out_size in enumerate(self.get_size(rate)):
+                mask = block_min(mask, out_size, axis)
+            self._interiors[rate] = mask
+
+        return self._interiors[rate]
+
+    def get_options(self, rate):
+        """Get the NRRD header of the mask down-sampled by 'rate'.
+        """
+        directions = get_space_directions(self._options).copy()
+        origin = get_space_origin(self._options).copy()
+        centerings = get_centerings(self._options)
+        for axis, out_size in enumerate(self.get_size(rate)):
+            positions = get_sample_positions(self._masks[1].shape[axis],
+                                             out_size, centerings[axis])
+            origin += positions[0]*directions[axis]
+            if out_size > 1:
+                directions[axis] *= positions[1] - positions[0]
+
+        return set_space_geometry(self._options, directions, origin)
+
+    def get_differential_mask(self, rate, previous_rate):
+        """Get the voxels, at down-sampling rate 'rate', that are left to
+        this level by the previous (coarser) level: the mask voxels whose
+        coarse cell is not entirely within the mask. The particles of the
+        coarse level cover the cells in the interior of the mask; the
+        boundary cells, where the coarse level misses the thin structures,
+        are refined at this rate.
+
+        Returns
+        -------
+        mask : array of bool
+            A subset of the mask at this rate
+        """
+        mask = self.get_mask(rate)
+        interior = self.get_interior_mask(previous_rate)
+
+        # Coarse cell of every sample, through the full resolution grid
+        indices = list()
+        for axis in xrange(3):
+            size = self._masks[1].shape[axis]
+            fine = np.searchsorted(get_cell_indices(size, mask.shape[axis]),
+                                   np.arange(mask.shape[axis]))
+            indices.append(get_cell_indices(size, interior.shape[axis])[fine])
+
+        return mask & ~interior[np.ix_(*indices)]
+
+    def write_level_mask(self, out_file_name, rate, previous_rate=None):
+        """Write the mask of a level of the pyramid: the down-sampled mask
+        for the first (coarsest) level, the differential mask with respect
+        to 'previous_rate' for the others.
+        """
+        if previous_rate is None:
+            mask = self.get_mask(rate)
+        else:
+            mask = self.get_differential_mask(rate, previous_rate)
+
+        self._engine.write(out_file_name, mask.astype(np.uint8),
+                           self.get_options(rate))
+
+def get_cell_indices(in_size, out_size):
+    """Index of the output cell that contains every input sample, for a
+    cell-centered resampling from 'in_size' to 'out_size' samples.
+    """
+    positions = (np.arange(in_size) + 0.5)*out_size/float(in_size)
+    return np.minimum(np.floor(positions).astype(int), out_size - 1)
+
+def block_max(mask, out_size, axis):
+    """Down-sample a mask along one axis by taking the maximum over the
+    input samples within every output cell.
+
+    Parameters
+    ----------
+    mask : array
+
+    out_size : int
+        Number of output samples along the axis. Must not be larger than
+        the input size.
+
+    axis : int
+
+    Returns
+    -------
+    mask : array
+    """
+    cells = get_cell_indices(mask.shape[axis], out_size)
+    starts = np.searchsorted(cells, np.arange(out_size))
+
+    return np.maximum.reduceat(mask, starts, axis=axis)
+
+def block_min(mask, out_size, axis):
+    """Down-sample a mask along one axis by taking the minimum over the
+    input samples within every output cell. See 'block_max'.
+    """
+    cells = get_cell_indices(mask.shape[axis], out_size)
+    starts = np.searchsorted(cells, np.arange(out_size))
+
+    return np.minimum.reduceat(mask, starts, axis=axis)
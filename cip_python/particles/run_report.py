@@ -0,0 +1,140 @@
+import time
+import json
+import csv
+import resource
+from contextlib import contextmanager
+
+# Size in bytes of the blocks counted by getrusage
+BLOCK_SIZE = 512
+
+class RunReport:
+    """Per-stage resource report of a particles run.
+
+    Every stage records its wall time, the CPU time (user plus system) of
+    this process and of the child processes (puller, unu, gprobe, ...) it
+    waited for, the peak resident set size of this process so far, the
+    peak resident set size of the children that finished during the stage
+    (only when it exceeds the one of all the previous children, since the
+    operating system only reports the largest child so far; it is None
+    otherwise), and the bytes read and written to disk by this process and
+    its children. Stages may also carry extra values, such as
+    the number of particles output by a puller pass and the number of
+    iterations it ran, or the number of duplicates removed by a merge.
+
+    Stages may be nested (e.g. the probe of each quantity within the
+    probing stage), in which case the time of the inner stages is also
+    counted in the outer one.
+    """
+    # Columns of the CSV report, in order
+    FIELDS = ['stage', 'start', 'wall_time', 'cpu_time', 'children_cpu_time',
+              'max_rss', 'children_max_rss', 'bytes_read', 'bytes_written',
+              'particles', 'iterations', 'removed']
+
+    def __init__(self):
+        self._stages = list()
+        self._start = time.time()
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager that records a stage.
+
+        Parameters
+        ----------
+        name : string
+            Name of the stage
+
+        Yields
+        ------
+        record : dict
+            Record of the stage. Extra values (e.g. 'particles') can be
+            added to it.
+        """
+        record = {'stage': name}
+        self._stages.append(record)
+        start_self = resource.getrusage(resource.RUSAGE_SELF)
+        start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.time()
+        try:
+            yield record
+        finally:
+            end = time.time()
+            end_self = resource.getrusage(resource.RUSAGE_SELF)
+            end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+            record['start'] = start - self._start
+            record['wall_time'] = end - start
+            record['cpu_time'] = _get_cpu_time(end_self) - \
+              _get_cpu_time(start_self)
+            record['children_cpu_time'] = _get_cpu_time(end_children) - \
+              _get_cpu_time(start_children)
+            # ru_maxrss is in kilobytes on Linux
+            record['max_rss'] = end_self.ru_maxrss*1024
+            record['children_max_rss'] = None
+            if end_children.ru_maxrss > start_children.ru_maxrss:
+                record['children_max_rss'] = end_children.ru_maxrss*1024
+            record['bytes_read'] = BLOCK_SIZE*(
+                end_self.ru_inblock - start_self.ru_inblock +
+                end_children.ru_inblock - start_children.ru_inblock)
+            record['bytes_written'] = BLOCK_SIZE*(
+                end_self.ru_oublock - start_self.ru_oublock +
+                end_children.ru_oublock - start_children.ru_oublock)
+
+    def get_stages(self):
+        """Get the records of all the stages, in start order.
+
+        Returns
+        -------
+        stages : list of dicts
+        """
+        return self._stages
+
+    def add_stages(self, stages, prefix=""):
+        """Add the records of stages run elsewhere (e.g. in another process).
+
+        Parameters
+        ----------
+        stages : list of dicts
+            Stage records, as returned by 'get_stages'
+
+        prefix : string (optional)
+            Prefix added to the stage names
+        """
+        for record in stages:
+            record = dict(record)
+            record['stage'] = prefix + record['stage']
+            self._stages.append(record)
+
+    def write_json(self, file_name):
+        f = open(file_name, 'w')
+        try:
+            json.dump({'stages': self._stages}, f, indent=2)
+        finally:
+            f.close()
+
+    def write_csv(self, file_name):
+        f = open(file_name, 'wb')
+        try:
+            writer = csv.DictWriter(f, self.FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            for record in self._stages:
+                writer.writerow(record)
+        finally:
+            f.close()
+
+    def write(self, file_name):
+        """Write the report as CSV if the file name ends with '.csv', as
+        JSON otherwise.
+        """
+        if file_name.endswith('.csv'):
+            self.write_csv(file_name)
+        else:
+            self.write_json(file_name)
+
+@contextmanager
+def null_stage(name):
+    """Stage context manager that records nothing. See 'RunReport.stage'.
+    """
+    yield dict()
+
+def _get_cpu_time(usage):
+    return usage.ru_utime + usage.ru_stime
@@ -0,0 +1,389 @@
+import os
+import errno
+import fcntl
+import socket
+import shutil
+import hashlib
+import time
+
+LOCK_FILE_NAME = ".lock"
+LEASE_PREFIX = ".lease-"
+STAGING_PREFIX = ".staging-"
+
+def hash_file(file_name, block_size=2**20):
+    """Compute the SHA-1 digest of the contents of a file.
+
+    Parameters
+    ----------
+    file_name : string
+        Name of the file to hash
+
+    block_size : int (optional)
+        Number of bytes read at a time. Default is 1 MB.
+
+    Returns
+    -------
+    digest : string
+        Hexadecimal SHA-1 digest of the file contents
+    """
+    sha = hashlib.sha1()
+    f = open(file_name, 'rb')
+    try:
+        block = f.read(block_size)
+        while block:
+            sha.update(block)
+            block = f.read(block_size)
+    finally:
+        f.close()
+
+    return sha.hexdigest()
+
+class ScaleSpaceCache:
+    """Persistent, content-addressed cache for the scale-space pre-blurrings
+    ('V-%03u-%03u.nrrd' files) computed by puller.
+
+    Each cache entry is a sub-directory of 'cache_dir' whose name is a hash of
+    the (deconvolved) input volume contents and of the parameters that
+    determine the blurrings: kernels, number of scale samples and maximum
+    scale. Entries are evicted in least-recently-used order whenever the
+    total size of the cache exceeds 'max_size'.
+
+    The cache can be shared by concurrent runs. Only complete entries (see
+    'is_complete') are handed out, and every process using one holds a lease
+    on it ('acquire') until it releases it ('release') or exits; leased
+    entries are never evicted. Missing blurrings are computed in a staging
+    directory private to the process ('get_staging_dir') and enter the cache
+    once complete ('publish'). Leases, staging and eviction are serialized
+    with a lock file in 'cache_dir'. Leases and staging directories of dead
+    processes on the same host are ignored (and removed by 'evict').
+
+    Parameters
+    ----------
+    cache_dir : string
+        Directory in which the cache entries are stored. It is created if it
+        does not exist.
+
+    max_size : int (optional)
+        Maximum size of the cache in bytes. Default is 20 GB.
+    """
+    def __init__(self, cache_dir, max_size=20*2**30):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+
+        # Hashes of input files already seen by this instance, indexed by
+        # (file name, size, modification time) to avoid re-reading them.
+        self._file_hashes = dict()
+
+        if not os.path.exists(self._cache_dir):
+            os.makedirs(self._cache_dir)
+
+    def get_key(self, in_file_name, kernel_params, scale_samples, max_scale):
+        """Get the cache key of the blurrings of a given input volume.
+
+        Parameters
+        ----------
+        in_file_name : string
+            Volume from which the blurrings are computed
+
+        kernel_params : string
+            Description of the reconstruction and blurring kernels
+
+        scale_samples : int
+            Number of pre-blurrings
+
+        max_scale : float
+            Maximum scale of the pre-blurrings
+
+        Returns
+        -------
+        key : string
+            Hexadecimal key identifying the cache entry
+        """
+        stat = os.stat(in_file_name)
+        file_id = (os.path.abspath(in_file_name), stat.st_size, stat.st_mtime)
+        if file_id not in self._file_hashes:
+            self._file_hashes[file_id] = hash_file(in_file_name)
+
+        sha = hashlib.sha1()
+        sha.update(self._file_hashes[file_id])
+        sha.update(str(kernel_params))
+        sha.update("%d" % scale_samples)
+        sha.update("%f" % max_scale)
+
+        return sha.hexdigest()
+
+    def get_entry_dir(self, key):
+        """Get the directory holding the blurrings of a cache entry. The
+        directory is created if needed and marked as most recently used.
+
+        Parameters
+        ----------
+        key : string
+            Key of the cache entry (see 'get_key')
+
+        Returns
+        -------
+        entry_dir : string
+            Directory to pass to puller ('-sscp') and gprobe ('-ssf')
+        """
+        entry_dir = os.path.join(self._cache_dir, key)
+        if not os.path.exists(entry_dir):
+            os.makedirs(entry_dir)
+        self.touch(key)
+
+        return entry_dir
+
+    def acquire(self, key, scale_samples):
+        """Lease a complete cache entry, so that it is not evicted while in
+        use, and mark it as most recently used.
+
+        Parameters
+        ----------
+        key : string
+            Key of the cache entry (see 'get_key')
+
+        scale_samples : int
+            Number of pre-blurrings expected in the entry
+
+        Returns
+        -------
+        entry_dir : string
+            Directory of the entry, or None if the entry is missing or
+            incomplete
+        """
+        lock = self._lock()
+        try:
+            if not self.is_complete(key, scale_samples):
+                return None
+            entry_dir = os.path.join(self._cache_dir, key)
+            open(os.path.join(entry_dir, get_owner_name(LEASE_PREFIX)),
+                 'w').close()
+            self.touch(key)
+        finally:
+            lock.close()
+
+        return entry_dir
+
+    def release(self, key):
+        """Release the lease of this process on a cache entry and remove
+        the staging directory of this process for it, if any.
+        """
+        lock = self._lock()
+        try:
+            lease = os.path.join(self._cache_dir, key,
+                                 get_owner_name(LEASE_PREFIX))
+            if os.path.exists(lease):
+                os.remove(lease)
+            staging_dir = self.get_staging_dir(key, create=False)
+            if os.path.exists(staging_dir):
+                shutil.rmtree(staging_dir)
+        finally:
+            lock.close()
+
+    def get_staging_dir(self, key, create=True):
+        """Get the directory in which this process computes the blurrings
+        of an entry that is not in the cache yet.
+
+        Parameters
+        ----------
+        key : string
+            Key of the cache entry
+
+        create : bool (optional)
+            Create the directory if needed. Default is True.
+
+        Returns
+        -------
+        staging_dir : string
+        """
+        staging_dir = os.path.join(self._cache_dir,
+                                   get_owner_name(STAGING_PREFIX) + "-" + key)
+        if create == True and not os.path.exists(staging_dir):
+            os.makedirs(staging_dir)
+
+        return staging_dir
+
+    def publish(self, key, scale_samples):
+        """Move the blurrings computed in the staging directory of this
+        process into the cache, if they are complete, and lease the entry.
+        Incomplete blurrings stay in the staging directory.
+
+        Parameters
+        ----------
+        key : string
+            Key of the cache entry
+
+        scale_samples : int
+            Number of pre-blurrings expected in the entry
+
+        Returns
+        -------
+        scale_space_dir : string
+            Directory of the (leased) entry, or the staging directory if the
+            blurrings are incomplete
+        """
+        staging_dir = self.get_staging_dir(key, create=False)
+        if not self.is_complete(key, scale_samples, staging_dir):
+            return staging_dir
+
+        lock = self._lock()
+        try:
+            entry_dir = os.path.join(self._cache_dir, key)
+            if self.is_complete(key, scale_samples):
+                # Another run published the same blurrings first
+                shutil.rmtree(staging_dir)
+            else:
+                if os.path.exists(entry_dir):
+                    shutil.rmtree(entry_dir)
+                os.rename(staging_dir, entry_dir)
+            open(os.path.join(entry_dir, get_owner_name(LEASE_PREFIX)),
+                 'w').close()
+            self.touch(key)
+        finally:
+            lock.close()
+
+        return entry_dir
+
+    def is_complete(self, key, scale_samples, entry_dir=None):
+        """Check whether all the blurrings of a cache entry are present.
+
+        Parameters
+        ----------
+        key : string
+            Key of the cache entry
+
+        scale_samples : int
+            Number of pre-blurrings expected in the entry
+
+        entry_dir : string (optional)
+            Directory to check instead of the one of the entry (e.g. a
+            staging directory)
+
+        Returns
+        -------
+        complete : bool
+        """
+        if entry_dir is None:
+            entry_dir = os.path.join(self._cache_dir, key)
+        for ii in xrange(scale_samples):
+            blur_file = os.path.join(entry_dir, "V-%03u-%03u.nrrd" % \
+                                     (ii, scale_samples))
+            if not os.path.exists(blur_file):
+                return False
+
+        return True
+
+    def touch(self, key):
+        """Mark a cache entry as most recently used.
+        """
+        entry_dir = os.path.join(self._cache_dir, key)
+        if os.path.exists(entry_dir):
+            now = time.time()
+            os.utime(entry_dir, (now, now))
+
+    def get_entry_size(self, key):
+        """Get the size in bytes of a cache entry.
+        """
+        size = 0
+        entry_dir = os.path.join(self._cache_dir, key)
+        for file_name in os.listdir(entry_dir):
+            size += os.path.getsize(os.path.join(entry_dir, file_name))
+
+        return size
+
+    def get_keys(self):
+        """Get the keys of the cache entries (staging directories excluded).
+        """
+        return [key for key in os.listdir(self._cache_dir) \
+                if not key.startswith(".") and \
+                os.path.isdir(os.path.join(self._cache_dir, key))]
+
+    def get_size(self):
+        """Get the total size in bytes of the cache.
+        """
+        return sum([self.get_entry_size(key) for key in self.get_keys()])
+
+    def is_leased(self, key):
+        """Check whether a live process holds a lease on a cache entry.
+        """
+        entry_dir = os.path.join(self._cache_dir, key)
+        for file_name in os.listdir(entry_dir):
+            if file_name.startswith(LEASE_PREFIX) and \
+              is_owner_alive(file_name[len(LEASE_PREFIX):]):
+                return True
+
+        return False
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache size is below
+        'max_size'.
+
+        Parameters
+        ----------
+        keep : string (optional)
+            Key of an entry that must not be removed, in addition to the
+            leased ones
+
+        Returns
+        -------
+        removed : list of strings
+            Keys of the removed entries
+        """
+        lock = self._lock()
+        try:
+            # Staging directories of dead processes
+            for name in os.listdir(self._cache_dir):
+                if name.startswith(STAGING_PREFIX) and \
+                  not is_owner_alive(name[len(STAGING_PREFIX):].rsplit("-",
+                                                                       1)[0]):
+                    shutil.rmtree(os.path.join(self._cache_dir, name))
+
+            entries = list()
+            total_size = 0
+            for key in self.get_keys():
+                entry_dir = os.path.join(self._cache_dir, key)
+                size = self.get_entry_size(key)
+                total_size += size
+                entries.append((os.path.getmtime(entry_dir), key, size))
+
+            removed = list()
+            for mtime, key, size in sorted(entries):
+                if total_size <= self._max_size:
+                    break
+                if key == keep or self.is_leased(key):
+                    continue
+                shutil.rmtree(os.path.join(self._cache_dir, key))
+                total_size -= size
+                removed.append(key)
+        finally:
+            lock.close()
+
+        return removed
+
+    def _lock(self):
+        """Take the cache lock. It is released by closing the returned file.
+        """
+        lock = open(os.path.join(self._cache_dir, LOCK_FILE_NAME), 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        return lock
+
+def get_owner_name(prefix):
+    """Name of the lease file or staging directory of this process:
+    'prefix' followed by the host name and the process id.
+    """
+    return "%s%s-%d" % (prefix, socket.gethostname(), os.getpid())
+
+def is_owner_alive(owner):
+    """Check whether the process of a lease or staging directory ('host-pid')
+    is alive. Processes on other hosts are assumed alive.
+    """
+    host, pid = owner.rsplit("-", 1)
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+
+    return True
@@ -0,0 +1,195 @@
+import numpy as np
+from cip_python.particles.preprocessing_engine import PreprocessingEngine
+from cip_python.particles.feature_strength_map import FeatureStrengthMap
+from cip_python.particles.nrrd_utils import get_index_to_world, \
+     write_particle_array
+
+class SeedGenerator:
+    """Strength-guided initial particles, as a lighter alternative to the
+    'PerVoxel' initialization of puller.
+
+    Instead of seeding every (masked) voxel, particles are only seeded in the
+    voxels whose scale-normalized Hessian eigenvalue (the one thresholded by
+    puller for the feature type) passes the seed threshold at some probe
+    scale. Every particle is seeded at the scale with the strongest
+    response. Optionally, a sparse, low-discrepancy (Halton) subset of the
+    other voxels is seeded too, so that features missed by this cheap test
+    can still be found by puller.
+
+    Parameters
+    ----------
+    feature_type : string
+        Takes on one or four values: "ridge_line" (for vessels), "valley_line"
+        (for airways), "ridge_surface" (for fissure), "valley_surface"
+
+    seed_thresh : float
+        Seed threshold on the feature strength, as in puller
+
+    scales : list of floats
+        Probe scales (Gaussian standard deviations, in samples)
+
+    points_per_voxel : int (optional)
+        Number of particles seeded in every candidate voxel, spread within
+        the voxel. Default is 1.
+
+    background_fraction : float (optional)
+        Fraction of the voxels that fail the strength test that are seeded
+        anyway, picked with a Halton sequence. Default is 0.
+    """
+    def __init__(self, feature_type, seed_thresh, scales, points_per_voxel=1,
+                 background_fraction=0.):
+        self._feature_type = feature_type
+        self._seed_thresh = seed_thresh
+        self._scales = [s for s in scales if s > 0]
+        self._points_per_voxel = points_per_voxel
+        self._background_fraction = background_fraction
+
+    def get_candidates(self, data, options, mask=None):
+        """Get the voxels that pass the feature strength test.
+
+        Parameters
+        ----------
+        data : array, shape ( X, Y, Z )
+            Input volume
+
+        options : dict
+            NRRD header of data
+
+        mask : array, shape ( X, Y, Z ) (optional)
+            Only the voxels with non-zero mask are tested. The strength is
+            only computed in the bounding box of the mask, extended by the
+            radius of the largest Gaussian.
+
+        Returns
+        -------
+        candidates : array of bool, shape ( X, Y, Z )
+
+        scale : array, shape ( X, Y, Z )
+            Probe scale with the strongest response (0 outside the extended
+            bounding box of the mask)
+        """
+        candidates = np.zeros(data.shape, dtype=bool)
+        scale = np.zeros(data.shape, dtype=np.float32)
+        box = [slice(0, size) for size in data.shape]
+        if mask is not None:
+            if np.any(mask) == False:
+                return candidates, scale
+            # Same radius as the Gaussian kernels of the strength, so the
+            # strength of the masked voxels does not change
+            halo = int(4.0*max(self._scales) + 0.5)
+            indices = np.argwhere(mask)
+            box = [slice(max(0, low - halo), min(size, high + halo + 1)) \
+                   for low, high, size in zip(indices.min(axis=0),
+                                              indices.max(axis=0),
+                                              data.shape)]
+        box = tuple(box)
+
+        fsm = FeatureStrengthMap(self._feature_type, None, None, None)
+        fsm._probe_scales = self._scales
+        # Do not clamp the strength before the threshold
+        fsm._max_feature_strength = -np.inf
+        if self._feature_type == "valley_line" or \
+          self._feature_type == "valley_surface":
+            fsm._max_feature_strength = np.inf
+
+        strength, scale[box] = fsm.compute_feature_strength(
+            data[box], options, return_scale=True)
+        if self._feature_type == "ridge_line" or \
+          self._feature_type == "ridge_surface":
+            candidates[box] = strength < self._seed_thresh
+        else:
+            candidates[box] = strength > self._seed_thresh
+
+        if mask is not None:
+            candidates &= mask != 0
+
+        return candidates, scale
+
+    def get_seeds(self, data, options, mask=None):
+        """Get the initial particles of a volume.
+
+        Returns
+        -------
+        particles : array, shape ( N, 4 )
+            World coordinates and scale of the particles
+        """
+        candidates, scale = self.get_candidates(data, options, mask)
+
+        indices = np.argwhere(candidates).astype(np.float64)
+        scales = scale[candidates].astype(np.float64)
+
+        if self._background_fraction > 0:
+            background = candidates == False
+            if mask is not None:
+                background &= mask != 0
+            num_points = int(self._background_fraction*data.size)
+            points = get_halton_sequence(num_points)*np.array(data.shape)
+            voxels = np.floor(points).astype(int)
+            keep = background[voxels[:, 0], voxels[:, 1], voxels[:, 2]]
+            indices = np.concatenate((indices, voxels[keep]))
+            scales = np.concatenate(
+                (scales, np.full(np.sum(keep), np.median(self._scales))))
+
+        # Spread the particles of every voxel with a Halton sequence
+        offsets = np.zeros((1, 3))
+        if self._points_per_voxel > 1:
+            offsets = get_halton_sequence(self._points_per_voxel, start=1) - 0.5
+
+        indices = (indices[:, np.newaxis, :] + offsets).reshape(-1, 3)
+        scales = np.repeat(scales, offsets.shape[0])
+
+        directions, origin = get_index_to_world(options)
+        particles = np.empty((indices.shape[0], 4))
+        particles[:, 0:3] = origin + np.dot(indices, directions)
+        particles[:, 3] = scales
+
+        return particles
+
+    def execute(self, in_file_name, out_particles_file_name,
+                mask_file_name=None):
+        """Write the initial particles of a volume in the format read by
+        puller ('-pi').
+
+        Returns
+        -------
+        num_particles : int
+        """
+        engine = PreprocessingEngine()
+        data, options = engine.read(in_file_name)
+        mask = None
+        if mask_file_name is not None:
+            mask, mask_options = engine.read(mask_file_name)
+
+        particles = self.get_seeds(data, options, mask)
+        write_particle_array(out_particles_file_name,
+                             particles.astype(np.float32))
+
+        return particles.shape[0]
+
+def get_halton_sequence(num_points, bases=(2, 3, 5), start=0):
+    """Points of the Halton low-discrepancy sequence in the unit cube.
+
+    Parameters
+    ----------
+    num_points : int
+
+    bases : tuple of ints (optional)
+        Prime base of every dimension
+
+    start : int (optional)
+        Index of the first point. The point of index 0 is the origin.
+
+    Returns
+    -------
+    points : array, shape ( num_points, len(bases) )
+    """
+    points = np.zeros((num_points, len(bases)))
+    for dim, base in enumerate(bases):
+        index = np.arange(start, start + num_points)
+        fraction = 1.0
+        while np.any(index > 0):
+            fraction /= base
+            points[:, dim] += fraction*(index % base)
+            index //= base
+
+    return points
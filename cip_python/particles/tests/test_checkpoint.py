@@ -0,0 +1,49 @@
+import os.path
+import tempfile, shutil
+from cip_python.particles.checkpoint import CheckpointManifest
+
+def write_file(file_name, contents):
+    f = open(file_name, 'w')
+    f.write(contents)
+    f.close()
+
+def test_checkpoint_manifest():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        manifest_file = os.path.join(tmp_dir, 'checkpoint.json')
+        in_file = os.path.join(tmp_dir, 'ct.nrrd')
+        out_file = os.path.join(tmp_dir, 'pass1.nrrd')
+        write_file(in_file, 'input')
+        write_file(out_file, 'output')
+
+        checkpoint = CheckpointManifest(manifest_file)
+        key = checkpoint.get_key('puller -maxi 10', [in_file])
+        assert checkpoint.is_valid('pass1', key, [out_file]) == False, \
+          "Stage should not be valid before it is recorded"
+        checkpoint.record('pass1', key, [out_file])
+        assert checkpoint.is_valid('pass1', key, [out_file]) == True, \
+          "Recorded stage should be valid"
+
+        # The manifest survives a restart
+        checkpoint = CheckpointManifest(manifest_file)
+        assert key == checkpoint.get_key('puller -maxi 10', [in_file]), \
+          "Stage key is not deterministic"
+        assert checkpoint.is_valid('pass1', key, [out_file]) == True, \
+          "Recorded stage not found after reloading the manifest"
+
+        # Changes in the parameters or inputs give a different key
+        assert key != checkpoint.get_key('puller -maxi 20', [in_file]), \
+          "Stage key does not depend on the parameters"
+        write_file(in_file, 'other input')
+        assert key != checkpoint.get_key('puller -maxi 10', [in_file]), \
+          "Stage key does not depend on the input contents"
+
+        # Changed or missing outputs invalidate the stage
+        write_file(out_file, 'truncated')
+        assert checkpoint.is_valid('pass1', key, [out_file]) == False, \
+          "Stage with a changed output should not be valid"
+        os.remove(out_file)
+        assert checkpoint.is_valid('pass1', key, [out_file]) == False, \
+          "Stage with a missing output should not be valid"
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,165 @@
+import os.path
+import tempfile, shutil
+import numpy as np
+import nrrd
+from cip_python.particles.chest_particles import ChestParticles, \
+     has_converged
+from cip_python.particles.nrrd_utils import read_particle_array, \
+     write_particle_array
+
+def test_has_converged():
+    previous = np.random.RandomState(0).uniform(0, 10, (100, 3))
+
+    assert has_converged(previous, previous + 0.01, 0.01, 0.05), \
+      "Settled system not converged"
+    assert has_converged(previous, previous + 0.5, 0.01, 0.05) == False, \
+      "Moving particles converged"
+    assert has_converged(previous, previous[0:90], 0.01, 0.05) == False, \
+      "Changing population converged"
+    assert has_converged(previous[0:0], previous[0:0], 0.01, 0.05), \
+      "Empty system not converged"
+
+class SettlingParticles(ChestParticles):
+    """Particles whose puller halves the distance to their final positions
+    at every iteration.
+    """
+    def call_puller(self, scale_space_dir, init_params, output, iterations):
+        if init_params.startswith("-pi "):
+            particles = read_particle_array(init_params[4:])
+        else:
+            particles = np.zeros((20, 4))
+        target = np.arange(80, dtype=np.float64).reshape(20, 4)
+        particles = target + (particles - target)*0.5**iterations
+        write_particle_array(output, particles)
+
+def test_run_puller_chunks():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        particles = SettlingParticles("ridge_line", "ct.nrrd", "out.vtk",
+                                      tmp_dir)
+        particles._iterations = 100
+        particles._convergence_chunk = 10
+        output = os.path.join(tmp_dir, "pass1.nrrd")
+
+        iterations = particles.run_puller_chunks(tmp_dir, output)
+        assert iterations == 20, "Pass did not stop after convergence"
+        assert np.allclose(read_particle_array(output)[:, 0:3],
+                           np.arange(80).reshape(20, 4)[:, 0:3], atol=0.01), \
+          "Unexpected output particles"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_run_puller_chunks_population_control():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        chunks = list()
+        class RecordingParticles(SettlingParticles):
+            def call_puller(self, scale_space_dir, init_params, output,
+                            iterations):
+                chunks.append(iterations)
+                SettlingParticles.call_puller(self, scale_space_dir,
+                                              init_params, output, iterations)
+
+        particles = RecordingParticles("ridge_line", "ct.nrrd", "out.vtk",
+                                       tmp_dir)
+        particles._iterations = 12
+        particles._convergence_chunk = 4
+        particles._population_control_period = 5
+        output = os.path.join(tmp_dir, "pass1.nrrd")
+
+        particles.run_puller_chunks(tmp_dir, output)
+        assert chunks == [5, 5, 2], \
+          "Chunks not rounded up to the population control period"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+class UniformParticles(ChestParticles):
+    """Particles whose puller scatters the requested number of initial
+    particles uniformly in the volume (identity space directions), and
+    leaves input particles in place.
+    """
+    def call_puller(self, scale_space_dir, init_params, output, iterations):
+        if init_params.startswith("-pi "):
+            # Polishing pass: keep the input particles
+            write_particle_array(output, read_particle_array(init_params[4:]))
+            return
+        data, options = nrrd.read(self._sp_in_file_name)
+        count = int(init_params.split()[1])
+        low = np.array(options['space origin'], dtype=np.float64)
+        high = low + np.array(data.shape) - 1
+        points = np.random.RandomState(0).uniform(low, high, (count, 3))
+        write_particle_array(output, np.column_stack((points,
+                                                      np.ones(count))))
+
+def test_execute_tiled_pass():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        in_file = os.path.join(tmp_dir, "ct-deconv.nrrd")
+        nrrd.write(in_file, np.zeros((10, 10, 40)),
+                   {'space': 'left-posterior-superior',
+                    'space directions': np.eye(3).tolist(),
+                    'space origin': [0., 0., 0.]})
+
+        particles = UniformParticles("ridge_line", in_file, "out.vtk",
+                                     tmp_dir)
+        particles._sp_in_file_name = in_file
+        particles._use_mask = False
+        particles._number_init_particles = 1000
+        particles._tiles = 2
+        particles._tile_processes = 2
+        particles._tile_halo = 0
+        particles._tile_merge_radius = 0
+        particles._tile_polish_iterations = 0
+        particles._run_report_file_name = os.path.join(tmp_dir, "run.json")
+        particles.build_params()
+        output = os.path.join(tmp_dir, "pass1.nrrd")
+
+        particles.execute_pass(output)
+        assert read_particle_array(output).shape[0] == 1000, \
+          "Initial particles not split between the tiles"
+        stages = [record['stage'] for record in \
+                  particles.get_run_report_stages()]
+        assert "tile000/particles.nrrd" in stages and \
+          "tile001/particles.nrrd" in stages, \
+          "Tile stages missing from the run report"
+
+        # The polishing pass is recorded in the stage of the tiled pass
+        particles._tile_polish_iterations = 5
+        particles.execute_pass(output)
+        records = [record for record in particles.get_run_report_stages() \
+                   if record['stage'] == "pass1.nrrd"]
+        assert len(records) == 2 and records[0]['iterations'] == 0 and \
+          records[1]['iterations'] == 5, "Unexpected tiled pass stages"
+
+        # The slab directories are removed with the temporary files
+        particles._clean_tmp_dir = True
+        particles.clean_tmp_dir()
+        assert not os.path.exists(os.path.join(tmp_dir, "tile000")), \
+          "Slab directories not removed"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_merge_particles():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        coarse = np.array([[0., 0., 0., 4.], [10., 0., 0., 4.]])
+        # Duplicate, same position at another scale, new particle
+        fine = np.array([[0.2, 0., 0., 4.2], [10., 0., 0., 1.],
+                         [20., 0., 0., 1.]])
+        inputs = [os.path.join(tmp_dir, "coarse.nrrd"),
+                  os.path.join(tmp_dir, "fine.nrrd")]
+        write_particle_array(inputs[0], coarse)
+        write_particle_array(inputs[1], fine)
+
+        particles = ChestParticles("ridge_line", "ct.nrrd", "out.vtk",
+                                   tmp_dir)
+        particles._irad = 1.15
+        particles._merge_radius = 0.5
+        output = os.path.join(tmp_dir, "merged.nrrd")
+        assert particles.merge_particles(inputs, output) == 1, \
+          "Wrong number of duplicates removed"
+        assert np.allclose(read_particle_array(output),
+                           np.concatenate((coarse, fine[1:]))), \
+          "Unexpected merged particles"
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,53 @@
+import os.path
+import tempfile, shutil
+import numpy as np
+from cip_python.particles.feature_strength_map import FeatureStrengthMap
+
+def test_compute_feature_strength():
+    # Bright Gaussian tube along the last axis
+    tube_sigma = 2.
+    x, y, z = np.meshgrid(np.arange(21.), np.arange(21.), np.arange(40.),
+                          indexing='ij')
+    data = 100*np.exp(-((x - 10)**2 + (y - 10)**2)/(2*tube_sigma**2))
+    options = {'space directions': [['1', '0', '0'], ['0', '1', '0'],
+                                    ['0', '0', '1']]}
+
+    fsm = FeatureStrengthMap("ridge_line", "in.nrrd", "out.nrrd", "/tmp")
+    fsm._probe_scales = [1, 2, 3]
+    fsm._slab_size = 7
+    strength = fsm.compute_feature_strength(data, options)
+
+    # Scale-normalized second derivative across the blurred tube, minimized
+    # over the scales
+    expected = min([-100*tube_sigma**2*s**2/(tube_sigma**2 + s**2)**2 \
+                    for s in fsm._probe_scales])
+    assert np.allclose(strength[10, 10, 20], expected, rtol=1e-2), \
+      "Unexpected strength at the tube center"
+    assert np.all(strength <= 0) and np.all(strength >= -1000), \
+      "Strength not clamped"
+    assert np.abs(strength[0, 0, 20]) < 1e-2, \
+      "Unexpected strength away from the tube"
+
+    # The slabs do not change the result
+    fsm._slab_size = 40
+    assert np.allclose(fsm.compute_feature_strength(data, options), strength,
+                       atol=1e-3), "Result depends on the slab size"
+
+def test_clean_tmp_dir():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fsm = FeatureStrengthMap("ridge_line", "in.nrrd", "out.nrrd", tmp_dir)
+        fsm._clean_tmp_dir = True
+        for name in ["scale0", "other"]:
+            os.makedirs(os.path.join(tmp_dir, name))
+            open(os.path.join(tmp_dir, name, "kk.nhdr"), 'w').close()
+        open(os.path.join(tmp_dir, "ct-deconv.nrrd"), 'w').close()
+        fsm._scale_dirs = [os.path.join(tmp_dir, "scale0")]
+
+        fsm.clean_tmp_dir()
+        assert sorted(os.listdir(tmp_dir)) == ["other"], \
+          "Only the files and the scale directories should be removed"
+        assert os.path.exists(os.path.join(tmp_dir, "other", "kk.nhdr")), \
+          "Unrelated directory cleaned"
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,81 @@
+import os.path
+import tempfile, shutil
+import numpy as np
+import nrrd
+import vtk
+from cip_python.particles.lung_phantom import LungPhantom, VESSEL, AIRWAY, \
+     OBLIQUEFISSURE, RIGHTMIDDLELOBE
+from cip_python.particles.particle_metrics import ParticleMetrics
+from cip_python.utils.particle_store import read_poly_data
+
+def test_lung_phantom():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        phantom = LungPhantom((40, 40, 36), slab_size=5)
+        ct_file = os.path.join(tmp_dir, 'ct.nrrd')
+        lm_file = os.path.join(tmp_dir, 'lm.nrrd')
+        vessels_file = os.path.join(tmp_dir, 'vessels.vtk')
+        phantom.execute(ct_file, lm_file, vessels_file)
+
+        ct, options = nrrd.read(ct_file)
+        lm, lm_options = nrrd.read(lm_file)
+        assert ct.shape == (40, 40, 36) and ct.dtype == np.int16 and \
+          lm.dtype == np.uint16, "Unexpected phantom volumes"
+        assert np.allclose(np.array(options['space directions'],
+                                    dtype=float),
+                           np.diag([350/40., 350/40., 300/36.])), \
+          "Unexpected spacing"
+
+        # Rendering by slabs gives the whole volume
+        whole_ct, whole_lm = phantom.render(0, 36)
+        assert np.array_equal(ct, whole_ct) and np.array_equal(lm, whole_lm), \
+          "Slab rendering differs from whole volume rendering"
+
+        # ChestConventions encoding: ( type << 8 ) + region
+        types = lm >> 8
+        regions = lm & 255
+        assert np.all([np.any(types == t) for t in \
+                       [VESSEL, AIRWAY, OBLIQUEFISSURE]]), "Missing types"
+        assert np.any(regions == RIGHTMIDDLELOBE), "Missing lobes"
+        assert ct[types == VESSEL].mean() > ct[(types == 0) & \
+                                               (regions > 0)].mean(), \
+          "Vessels are not brighter than the parenchyma"
+
+        reader = vtk.vtkPolyDataReader()
+        reader.SetFileName(vessels_file)
+        reader.Update()
+        assert reader.GetOutput().GetNumberOfPoints() > 0 and \
+          reader.GetOutput().GetPointData().GetArray('hevec0') is not None, \
+          "Unexpected ground truth particles"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_trees():
+    phantom = LungPhantom((40, 40, 36))
+    for segments in [phantom._airways, phantom._vessels]:
+        for generation in xrange(1, int(segments[:, 7].max()) + 1):
+            radii = segments[segments[:, 7] == generation, 6]
+            parents = segments[segments[:, 7] == generation - 1, 6]
+            assert np.all(radii < parents.max()), \
+              "Radii do not decrease along the tree"
+
+def test_score_ground_truth():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        phantom = LungPhantom((48, 48, 40))
+        files = dict([(particle_type,
+                       os.path.join(tmp_dir, particle_type + '.vtk')) \
+                      for particle_type in ['vessel', 'airway', 'fissure']])
+        phantom.execute(os.path.join(tmp_dir, 'ct.nrrd'), None,
+                        files['vessel'], files['airway'], files['fissure'])
+
+        # Every ground truth is scorable, and matches itself exactly (no
+        # duplicate particles at the bifurcations)
+        for particle_type, file_name in files.items():
+            particles = read_poly_data(file_name)
+            dice = ParticleMetrics(particles, particles,
+                                   particle_type).get_particles_dice()
+            assert dice == 1, \
+              "Ground truth of %s does not match itself" % particle_type
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,116 @@
+import os.path
+import tempfile, shutil
+import multiprocessing
+import numpy as np
+import nrrd
+from cip_python.particles.multi_feature_particles import MultiFeatureParticles
+from cip_python.particles.vessel_particles import VesselParticles
+from cip_python.particles.airway_particles import AirwayParticles
+from cip_python.particles.multires_vessel_particles import \
+     MultiResVesselParticles
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+input_ct = this_dir + '/../../../Testing/Data/Input/vesselgauss.nrrd'
+input_mask = \
+  this_dir + '/../../../Testing/Data/Input/vessel_vesselSeedsMask.nrrd'
+
+def test_preprocess():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        features = list()
+        for name, feature_class in [("vessels", VesselParticles),
+                                    ("airways", AirwayParticles),
+                                    ("small_vessels", VesselParticles)]:
+            feature_tmp_dir = os.path.join(tmp_dir, name)
+            os.makedirs(feature_tmp_dir)
+            particles = feature_class(input_ct, name + ".vtk",
+                                      feature_tmp_dir, input_mask,
+                                      down_sample_rate=2)
+            particles._preprocessing_engine = "numpy"
+            particles._crop_to_mask = True
+            features.append(particles)
+        features[2]._max_scale = 2
+
+        multi = MultiFeatureParticles(features,
+                                      os.path.join(tmp_dir, "shared"))
+        multi.preprocess()
+
+        vessels, airways, small_vessels = features
+        assert vessels._sp_in_file_name == small_vessels._sp_in_file_name, \
+          "Same preprocessing not shared"
+        assert vessels._sp_in_file_name != airways._sp_in_file_name, \
+          "Different intensity ranges shared"
+        assert vessels._sp_mask_file_name == airways._sp_mask_file_name, \
+          "Down-sampled mask not shared"
+        assert len(os.listdir(os.path.join(tmp_dir, "shared"))) == 6, \
+          "Unexpected shared products"
+        for particles in features:
+            assert particles._preprocessed == True, "Feature not preprocessed"
+            assert os.path.exists(particles._sp_in_file_name), \
+              "Missing preprocessed volume"
+
+        # The crop has the largest margin of the features
+        crop, crop_options = nrrd.read(os.path.join(tmp_dir, "shared",
+                                                    "ct-crop-0.nrrd"))
+        mask, mask_options = nrrd.read(input_mask)
+        nonzero = np.argwhere(mask != 0)
+        margin = vessels.get_crop_margin()
+        start = np.maximum(nonzero.min(axis=0) - margin, 0)
+        stop = np.minimum(nonzero.max(axis=0) + margin + 1, mask.shape)
+        assert np.all(crop.shape == stop - start), "Unexpected crop size"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+class PoolParticles(VesselParticles):
+    """Particles whose 'execute' starts a process pool when tiled, as tiled
+    passes do.
+    """
+    def execute(self):
+        values = [1]
+        if self._tiles > 1:
+            pool = multiprocessing.Pool(1)
+            try:
+                values = pool.map(abs, [-1])
+            finally:
+                pool.close()
+                pool.join()
+        f = open(self._out_particles_file_name, 'w')
+        f.write(str(values[0]))
+        f.close()
+
+def test_execute_tiled_features():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        features = list()
+        for name, tiles in [("vessels", 1), ("tiled_vessels", 2)]:
+            feature_tmp_dir = os.path.join(tmp_dir, name)
+            os.makedirs(feature_tmp_dir)
+            particles = PoolParticles(input_ct,
+                                      os.path.join(tmp_dir, name + ".txt"),
+                                      feature_tmp_dir)
+            particles._preprocessing_engine = "numpy"
+            particles._tiles = tiles
+            features.append(particles)
+
+        # The tiled feature is not run in a (daemonic) pool worker
+        multi = MultiFeatureParticles(features,
+                                      os.path.join(tmp_dir, "shared"))
+        out_file_names = multi.execute()
+        for out_file_name in out_file_names:
+            assert os.path.exists(out_file_name), "Feature not run"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_reject_multires_features():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        particles = MultiResVesselParticles(input_ct, "vessels.vtk",
+                                            os.path.join(tmp_dir, "vessels"))
+        try:
+            MultiFeatureParticles([particles],
+                                  os.path.join(tmp_dir, "shared"))
+        except AssertionError:
+            return
+        assert False, "Multi-resolution feature accepted"
+    finally:
+        shutil.rmtree(tmp_dir)
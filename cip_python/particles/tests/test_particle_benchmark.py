@@ -0,0 +1,66 @@
+import os.path
+import tempfile, shutil
+import numpy as np
+from cip_python.particles.particle_benchmark import ParticleBenchmark, \
+     make_tube_phantom, make_plane_phantom, read_history, append_history, \
+     read_baseline, write_baseline, compare_to_baseline
+
+def test_phantoms():
+    data, mask, options = make_tube_phantom(20)
+    assert data.shape == (20, 20, 20) and mask.shape == data.shape, \
+      "Unexpected phantom size"
+    assert data[10, 10, 10] > 50 and data[0, 19, 10] == -900, \
+      "Unexpected tube intensities"
+    assert np.all(data[mask != 0] > data[mask == 0].max() - 1), \
+      "Mask does not cover the tube"
+
+    data, mask, options = make_plane_phantom(20)
+    assert data[10, 10, 9] > -650 and data[0, 0, 0] == -900, \
+      "Unexpected plane intensities"
+
+def test_baseline():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        records = [{'case': 'vessel', 'wall_time': 10.,
+                    'particles_per_second': 100., 'max_rss': 1000},
+                   {'case': 'airway', 'wall_time': 10., 'max_rss': 1000}]
+        history = os.path.join(tmp_dir, 'history.jsonl')
+        append_history(history, records)
+        append_history(history, records[0:1])
+        assert len(read_history(history)) == 3, "Unexpected history"
+
+        baseline_file = os.path.join(tmp_dir, 'baseline.json')
+        write_baseline(baseline_file, records)
+        baseline = read_baseline(baseline_file)
+        assert compare_to_baseline(records, baseline) == [], \
+          "Regression against itself"
+
+        slower = [{'case': 'vessel', 'wall_time': 15.,
+                   'particles_per_second': 70., 'max_rss': 1100},
+                  {'case': 'fissure', 'wall_time': 100.}]
+        regressions = compare_to_baseline(slower, baseline, 0.2)
+        assert len(regressions) == 2 and \
+          regressions[0].startswith('vessel: wall_time'), \
+          "Unexpected regressions"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_particle_benchmark():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        benchmark = ParticleBenchmark(tmp_dir, [24], ['strength-tube'], True)
+        cases = benchmark.get_cases()
+        assert [case['name'] for case in cases] == ['strength-tube-24'], \
+          "Unexpected cases"
+
+        records = benchmark.execute()
+        assert len(records) == 1 and records[0]['voxels'] == 24**3, \
+          "Unexpected records"
+        assert records[0]['wall_time'] > 0 and \
+          records[0]['voxels_per_second'] > 0 and \
+          records[0]['max_rss'] > 0, "Missing measures"
+        assert os.path.exists(os.path.join(tmp_dir, 'strength-tube-24',
+                                           'strength.nrrd')), \
+          "Missing output"
+    finally:
+        shutil.rmtree(tmp_dir)
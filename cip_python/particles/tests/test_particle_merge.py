@@ -0,0 +1,60 @@
+import numpy as np
+from cip_python.particles.particle_merge import get_tile_ranges, \
+     deduplicate_particles
+
+def test_get_tile_ranges():
+    ranges = get_tile_ranges(100, 4, 5)
+    assert len(ranges) == 4, "Unexpected number of tiles"
+    assert ranges[0][0] == 0 and ranges[-1][1] == 100, \
+      "Tiles do not cover the volume"
+    for ii in xrange(3):
+        assert ranges[ii][1] == ranges[ii + 1][0], "Tile cores overlap"
+    for core_start, core_stop, start, stop in ranges:
+        assert start == max(0, core_start - 5) and \
+          stop == min(100, core_stop + 5), "Unexpected halo"
+
+    # Tiles only span the slices with work and are balanced by weight
+    weights = np.zeros(100)
+    weights[20:40] = 1
+    weights[40:80] = 0.5
+    ranges = get_tile_ranges(100, 2, 0, weights)
+    assert ranges == [(20, 40, 20, 40), (40, 80, 40, 80)], \
+      "Unexpected weighted tiles"
+
+    assert get_tile_ranges(10, 2, 1, np.zeros(10)) == [], \
+      "Expected no tiles for an empty mask"
+
+def test_deduplicate_particles():
+    points = np.array([[0., 0., 0.], [0.3, 0., 0.], [1., 1., 1.],
+                       [1.1, 1., 1.], [5., 5., 5.]])
+
+    keep = deduplicate_particles(points, 0.5)
+    assert np.all(keep == [True, False, True, False, True]), \
+      "Unexpected duplicates"
+
+    candidates = np.array([False, True, False, False, True])
+    keep = deduplicate_particles(points, 0.5, candidates)
+    assert np.all(keep), "Only candidates should be compared"
+
+    # Duplicates across hash cells are found
+    points = np.array([[0.49, 0., 0.], [0.51, 0., 0.]])
+    assert np.all(deduplicate_particles(points, 0.5) == [True, False]), \
+      "Duplicates across cells not found"
+
+    # Particles at the same position but far apart in scale are kept
+    points = np.array([[0., 0., 0.], [0.1, 0., 0.], [0.2, 0., 0.]])
+    scales = np.array([1., 3., 1.2])
+    keep = deduplicate_particles(points, 0.5, scales=scales, scale_radius=0.5)
+    assert np.all(keep == [True, True, False]), \
+      "Unexpected scale-space duplicates"
+
+def test_deduplicate_particle_chain():
+    # A-B and B-C are duplicates, A-C are not: B is removed, A and C kept
+    points = np.array([[0., 0., 0.], [0.4, 0., 0.], [0.8, 0., 0.]])
+    assert np.all(deduplicate_particles(points, 0.5) == [True, False, True]), \
+      "Particle removed by an already removed duplicate"
+
+    # Same chain, listed in another order
+    points = points[[2, 0, 1]]
+    assert np.all(deduplicate_particles(points, 0.5) == [True, True, False]), \
+      "Unexpected duplicates in an unordered chain"
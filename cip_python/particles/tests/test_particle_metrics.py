@@ -1,10 +1,12 @@
 import os.path
 import subprocess
+import tempfile, shutil
 import numpy as np
 import vtk
 from vtk.util.numpy_support import vtk_to_numpy
 import pdb
-from cip_python.particles.particle_metrics import ParticleMetrics
+from cip_python.particles.particle_metrics import ParticleMetrics, \
+     compare_particle_sets
 
 def test_particle_metrics():
     # Get the path to the this test so that we can reference the test data
@@ -22,3 +24,77 @@ def test_particle_metrics():
     assert pm.get_particles_dice() == 1., \
       "Vessel particle Dice score lower than expected"
         
+
+def get_line_particles(points):
+    poly_data = vtk.vtkPolyData()
+    vtk_points = vtk.vtkPoints()
+    for point in points:
+        vtk_points.InsertNextPoint(point)
+    poly_data.SetPoints(vtk_points)
+
+    scale = vtk.vtkFloatArray()
+    scale.SetName('scale')
+    hevec0 = vtk.vtkFloatArray()
+    hevec0.SetName('hevec0')
+    hevec0.SetNumberOfComponents(3)
+    for point in points:
+        scale.InsertNextValue(1.)
+        hevec0.InsertNextTuple3(1., 0., 0.)
+    poly_data.GetPointData().AddArray(scale)
+    poly_data.GetPointData().AddArray(hevec0)
+
+    return poly_data
+
+def test_particle_metrics_false_positive():
+    points = [[float(x), 0., 0.] for x in xrange(10)]
+    ref_particles = get_line_particles(points)
+    points[4] = [4., 5., 0.]
+    test_particles = get_line_particles(points)
+
+    # The moved particle is a FP; the ref particle it leaves is still
+    # matched by a neighbor at the threshold distance
+    pm = ParticleMetrics(ref_particles, test_particles, 'vessel')
+    assert np.isclose(pm.get_particles_dice(), 18./19.), \
+      "Unexpected Dice score"
+
+def test_particle_metrics_thresholds():
+    points = [[x**2/10., 0., 0.] for x in xrange(10)]
+    pm = ParticleMetrics(get_line_particles(points),
+                         get_line_particles(points), 'vessel')
+
+    # The largest gap to the closest neighbor is the one of the last
+    # particle, 1.7
+    assert np.isclose(pm._dist_thresh, np.percentile(
+        [0.1, 0.1, 0.3, 0.5, 0.7, 0.9, 1.1, 1.3, 1.5, 1.7], 99.9)), \
+      "Unexpected distance threshold"
+    assert pm._angle_thresh == 0. and pm._scale_fraction_thresh == 1., \
+      "Unexpected angle or scale thresholds"
+
+def test_compare_particle_sets():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        points = [[float(x), 0., 0.] for x in xrange(10)]
+        file_names = dict()
+        for name, offset in [('ref0', 0.), ('ref1', 100.), ('test', 0.)]:
+            moved = [[x + offset, y, z] for x, y, z in points]
+            if name == 'test':
+                moved[4] = [4., 5., 0.]
+            file_names[name] = os.path.join(tmp_dir, name + '.vtk')
+            writer = vtk.vtkPolyDataWriter()
+            writer.SetFileName(file_names[name])
+            writer.SetInputData(get_line_particles(moved))
+            writer.Write()
+
+        pairs = [(file_names['ref0'], file_names['test']),
+                 (file_names['ref1'], file_names['test']),
+                 (file_names['ref0'], file_names['ref0'])]
+        comparisons = compare_particle_sets(pairs, 'vessel', processes=2)
+        assert list(comparisons['test']) == [pair[1] for pair in pairs], \
+          "Comparisons not in the order of the pairs"
+        assert list(comparisons['TP']) == [9, 0, 10] and \
+          list(comparisons['FP']) == [1, 10, 0] and \
+          list(comparisons['FN']) == [0, 10, 0], "Unexpected counts"
+        assert np.allclose(comparisons['dice'], [18./19., 0., 1.]), \
+          "Unexpected Dice scores"
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,164 @@
+import os.path
+import tempfile, shutil
+from distutils.spawn import find_executable
+import numpy as np
+import nrrd
+from nose.plugins.skip import SkipTest
+from cip_python.particles.kernels import get_kernel, prefilter
+from cip_python.particles.particle_probe import get_base_quantities, \
+     derive_quantities, ScaleSpaceProbe
+from cip_python.particles.chest_particles import ChestParticles
+from cip_python.particles.nrrd_utils import read_particle_array, \
+     write_particle_array
+
+def test_get_base_quantities():
+    assert get_base_quantities(['heval0', 'hmode', 'hevec2']) == ['hess'], \
+      "Unexpected base quantities"
+    assert get_base_quantities(['val', 'kappa1']) == ['gvec', 'hess', 'val'], \
+      "Unexpected base quantities"
+
+def test_derive_hessian_quantities():
+    # Hessian of a bright line along z
+    hess = np.array([[-2., 0, 0], [0, -1., 0], [0, 0, 0.]]).reshape(1, 9)
+    sigma = np.array([2.])
+    answers = derive_quantities(['heval0', 'heval1', 'heval2', 'hevec2',
+                                 'hmode', 'hess'], hess=hess, sigma=sigma,
+                                normalized={'heval0': True, 'heval1': True,
+                                            'heval2': True})
+
+    assert np.allclose([answers['heval0'][0], answers['heval1'][0],
+                        answers['heval2'][0]], [0., -4., -8.]), \
+      "Unexpected (normalized) Hessian eigenvalues"
+    assert np.allclose(np.abs(answers['hevec2'][0]), [1., 0, 0]), \
+      "Unexpected Hessian eigenvector"
+    assert np.allclose(answers['hess'][0], hess[0]), \
+      "Hessian changed although not normalized"
+
+    line = derive_quantities(['hmode'], hess=np.diag([-1., -1, 0]))
+    plane = derive_quantities(['hmode'], hess=np.diag([-1., 0, 0]))
+    assert np.allclose(line['hmode'], 1.) and \
+      np.allclose(plane['hmode'], -1.), "Unexpected Hessian mode"
+
+def test_derive_curvatures():
+    # f(x) = |x|^2 at distance r from the origin: isosurfaces are spheres
+    r = 4.
+    gvec = np.array([[2*r, 0, 0]])
+    hess = 2*np.eye(3).reshape(1, 9)
+    answers = derive_quantities(['kappa1', 'kappa2', 'gausscurv',
+                                 'curvdir1', 'flowlinecurv'],
+                                gvec=gvec, hess=hess)
+
+    assert np.allclose([answers['kappa1'][0], answers['kappa2'][0]],
+                       [-1/r, -1/r]), "Unexpected principal curvatures"
+    assert np.allclose(answers['gausscurv'], 1/r**2), \
+      "Unexpected Gaussian curvature"
+    assert np.allclose(answers['curvdir1'][0, 0], 0), \
+      "Curvature direction not tangent to the isosurface"
+    assert np.allclose(answers['flowlinecurv'], 0), \
+      "Radial flow lines should be straight"
+
+def test_scale_space_probe():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # Quadratic function sampled on an anisotropic grid. Its Hessian is
+        # the same at every scale.
+        spacing = np.array([1., 0.5, 2.])
+        origin = np.array([10., -5., 3.])
+        hess = np.array([[1., 0.3, 0], [0.3, -2., 0.5], [0, 0.5, 0.7]])*0.01
+        x, y, z = np.meshgrid(np.arange(40.), np.arange(40.), np.arange(30.),
+                              indexing='ij')
+        pos = np.stack([origin[0] + x*spacing[0], origin[1] + y*spacing[1],
+                        origin[2] + z*spacing[2]], axis=-1)
+        data = 0.5*np.einsum('...i,ij,...j->...', pos, hess, pos) + \
+          0.1*pos[..., 0]
+
+        in_file = os.path.join(tmp_dir, 'ct-deconv.nrrd')
+        nrrd.write(in_file,
+                   np.asfortranarray(prefilter(data, get_kernel('C4'))),
+                   {'space': 'left-posterior-superior',
+                    'space directions': np.diag(spacing).tolist(),
+                    'space origin': origin.tolist()})
+
+        probe = ScaleSpaceProbe(in_file, 4., 5, tmp_dir, 'C4')
+        points = np.array([[30., 5., 30.], [25.3, 4.1, 40.7]])
+        val, gvec, probed_hess = probe.probe(points, np.array([0., 1.5]))
+
+        assert np.allclose(val[0], 0.5*np.dot(points[0],
+                           np.dot(hess, points[0])) + 0.1*points[0, 0],
+                           atol=1e-5), "Unexpected value at scale 0"
+        assert np.allclose(gvec, np.dot(points, hess) + [0.1, 0, 0],
+                           atol=1e-3), "Unexpected gradient"
+        assert np.allclose(probed_hess, hess, atol=1e-4), \
+          "Unexpected Hessian"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_stack_not_reused_for_changed_input():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        in_file = os.path.join(tmp_dir, 'ct-deconv.nrrd')
+        header = {'space': 'left-posterior-superior',
+                  'space directions': np.eye(3).tolist(),
+                  'space origin': [0., 0., 0.]}
+        points = np.array([[5., 5., 5.]])
+
+        nrrd.write(in_file, np.ones((10, 10, 10)), header)
+        val, gvec, hess = ScaleSpaceProbe(in_file, 2., 3, tmp_dir).probe(
+            points, np.array([1.]))
+        assert np.allclose(val, 1., atol=1e-5), "Unexpected value"
+
+        # Same file name, scale sampling and directory, new contents
+        nrrd.write(in_file, 3*np.ones((10, 10, 10)), header)
+        val, gvec, hess = ScaleSpaceProbe(in_file, 2., 3, tmp_dir).probe(
+            points, np.array([1.]))
+        assert np.allclose(val, 3., atol=1e-5), \
+          "Blurrings of the previous input reused"
+        assert len([name for name in os.listdir(tmp_dir) \
+                    if name.startswith("P-")]) == 6 and \
+          not any([name.endswith(".tmp") for name in os.listdir(tmp_dir)]), \
+          "Blurrings not renamed into place"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_numpy_probe_against_gprobe():
+    if find_executable('gprobe') is None:
+        raise SkipTest("gprobe not available")
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # Bright Gaussian tube along the last axis
+        x, y, z = np.meshgrid(np.arange(31.), np.arange(31.), np.arange(31.),
+                              indexing='ij')
+        data = 100*np.exp(-((x - 15)**2 + (y - 15)**2)/(2*2.**2))
+        in_file = os.path.join(tmp_dir, 'ct-deconv.nrrd')
+        nrrd.write(in_file,
+                   np.asfortranarray(prefilter(data, get_kernel('C4'))),
+                   {'space': 'left-posterior-superior',
+                    'space directions': np.eye(3).tolist(),
+                    'space origin': [0., 0., 0.]})
+
+        # Particles on and near the axis, at and between the stack scales
+        points = np.array([[15., 15., 15.], [15.5, 14.7, 10.2],
+                           [16.2, 15., 20.], [15., 15.3, 12.]])
+        scales = np.array([1., 1.7, 2.5, 3.2])
+        in_particles = os.path.join(tmp_dir, 'particles.nrrd')
+        write_particle_array(in_particles,
+                             np.column_stack((points, scales)))
+
+        particles = ChestParticles("ridge_line", in_file, "out.vtk", tmp_dir,
+                                   max_scale=4., scale_samples=5)
+        particles.build_params()
+        for quant in ['val', 'heval0']:
+            particles.probe_points(in_file, in_particles, quant, 1)
+
+        answers = ScaleSpaceProbe(in_file, 4., 5, tmp_dir).probe_quantities(
+            in_particles, ['val', 'heval0'], {'val': True, 'heval0': True})
+        for quant in ['val', 'heval0']:
+            expected = read_particle_array(os.path.join(tmp_dir,
+                                                        quant + ".nrrd"))
+            expected = expected.reshape(answers[quant].shape)
+            tolerance = 0.05*np.max(np.abs(expected))
+            assert np.allclose(answers[quant], expected, atol=tolerance), \
+              "NumPy probe of %s too far from gprobe" % quant
+    finally:
+        shutil.rmtree(tmp_dir)
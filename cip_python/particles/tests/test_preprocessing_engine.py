@@ -0,0 +1,126 @@
+import os.path
+import subprocess
+import tempfile, shutil
+from distutils.spawn import find_executable
+import numpy as np
+from scipy.ndimage import convolve1d
+import nrrd
+from nose.plugins.skip import SkipTest
+from cip_python.particles.kernels import get_kernel
+from cip_python.particles.preprocessing_engine import PreprocessingEngine
+from cip_python.particles.nrrd_utils import get_space_directions, \
+     get_space_origin
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+input_ct = this_dir + '/../../../Testing/Data/Input/vesselgauss.nrrd'
+input_mask = \
+  this_dir + '/../../../Testing/Data/Input/vessel_vesselSeedsMask.nrrd'
+
+def test_deconvolve():
+    engine = PreprocessingEngine()
+    data, options = nrrd.read(input_ct)
+    data = engine.clamp(data, -800, 400)
+
+    for kernel_type in ['Bspline3', 'Bspline5', 'Bspline7', 'C4']:
+        deconv = engine.deconvolve_data(data, kernel_type).astype(np.float64)
+
+        # Reconstructing at the sample positions gives back the input
+        samples = get_kernel(kernel_type).get_integer_samples()
+        weights = np.concatenate((samples[:0:-1], samples))
+        recon = deconv
+        for axis in xrange(3):
+            recon = convolve1d(recon, weights, axis=axis, mode='nearest')
+
+        assert np.allclose(recon[10:-10, 10:-10, 10:-10],
+                           data[10:-10, 10:-10, 10:-10], atol=1e-2), \
+          "Deconvolution is not the inverse of the %s kernel" % kernel_type
+
+def test_down_sample():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        engine = PreprocessingEngine()
+        out_ct = os.path.join(tmp_dir, 'ct-down.nrrd')
+        out_mask = os.path.join(tmp_dir, 'mask-down.nrrd')
+        engine.down_sample(input_ct, out_ct, 'cubic:0,0.5', 2)
+        engine.down_sample(input_mask, out_mask, 'cheap', 2)
+
+        data, options = nrrd.read(input_ct)
+        ct, ct_options = nrrd.read(out_ct)
+        mask, mask_options = nrrd.read(out_mask)
+        in_mask, in_mask_options = nrrd.read(input_mask)
+
+        assert ct.shape == (26, 26, 170), "Unexpected down-sampled size"
+        assert mask.dtype == in_mask.dtype, "Mask type not preserved"
+        assert np.allclose(get_space_directions(ct_options),
+            get_space_directions(options)*np.array([[51/26.], [51/26.],
+                                                    [2.]])), \
+          "Unexpected down-sampled spacing"
+
+        # Cell-centered down-sampling moves the origin half a new sample
+        assert np.allclose(get_space_origin(ct_options)[2],
+                           get_space_origin(options)[2] + 0.5), \
+          "Unexpected down-sampled origin"
+        assert abs(ct.mean() - data.mean()) < 0.01*np.abs(data).mean(), \
+          "Down-sampling changed the mean intensity"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_crop_to_mask():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        engine = PreprocessingEngine()
+        data, options = nrrd.read(input_ct)
+        mask, mask_options = nrrd.read(input_mask)
+        nonzero = np.argwhere(mask != 0)
+
+        out_ct = os.path.join(tmp_dir, 'ct-crop.nrrd')
+        out_mask = os.path.join(tmp_dir, 'mask-crop.nrrd')
+        engine.crop_to_mask(input_ct, input_mask, out_ct, out_mask, 2)
+        crop, crop_options = nrrd.read(out_ct)
+        crop_mask, crop_mask_options = nrrd.read(out_mask)
+
+        start = np.maximum(nonzero.min(axis=0) - 2, 0)
+        stop = np.minimum(nonzero.max(axis=0) + 3, mask.shape)
+        assert np.all(crop.shape == stop - start), "Unexpected crop size"
+        assert crop.dtype == data.dtype and crop_mask.dtype == mask.dtype, \
+          "Cropping should keep the data types"
+        assert np.all(crop_mask != 0) == False and \
+          np.sum(crop_mask != 0) == nonzero.shape[0], \
+          "Mask samples lost by cropping"
+        assert np.array_equal(crop, data[start[0]:stop[0], start[1]:stop[1],
+                                         start[2]:stop[2]]), \
+          "Unexpected cropped data"
+
+        # Cropped samples keep their world coordinates
+        directions = get_space_directions(options)
+        assert np.allclose(get_space_directions(crop_options), directions), \
+          "Cropping should keep the space directions"
+        assert np.allclose(get_space_origin(crop_options),
+                           get_space_origin(options) + \
+                           np.dot(start, directions)), \
+          "Unexpected space origin"
+        assert np.allclose(get_space_origin(crop_mask_options),
+                           get_space_origin(crop_options)), \
+          "Volume and mask crops do not match"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_deconvolve_against_unu():
+    if find_executable('unu') is None:
+        raise SkipTest("unu not available")
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        out_numpy = os.path.join(tmp_dir, 'ct-deconv-numpy.nrrd')
+        out_unu = os.path.join(tmp_dir, 'ct-deconv-unu.nrrd')
+        PreprocessingEngine().deconvolve(input_ct, out_numpy, -800, 400, 'C4')
+        subprocess.call("unu 3op clamp -800 " + input_ct + " 400 | " + \
+                        "unu resample -s x1 x1 x1 -k c4hai -t float -o " + \
+                        out_unu, shell=True)
+
+        numpy_data, numpy_options = nrrd.read(out_numpy)
+        unu_data, unu_options = nrrd.read(out_unu)
+        assert np.abs(numpy_data - unu_data).max() < \
+          0.01*np.abs(unu_data).max(), "Deconvolution differs from unu"
+    finally:
+        shutil.rmtree(tmp_dir)
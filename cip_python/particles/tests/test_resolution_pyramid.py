@@ -0,0 +1,102 @@
+import os.path
+import tempfile, shutil
+import numpy as np
+import nrrd
+from cip_python.particles.preprocessing_engine import PreprocessingEngine
+from cip_python.particles.resolution_pyramid import ResolutionPyramid, \
+     block_max, block_min, get_cell_indices
+from cip_python.particles.nrrd_utils import get_space_directions, \
+     get_space_origin
+from cip_python.particles.chest_particles import ChestParticles
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+input_ct = this_dir + '/../../../Testing/Data/Input/vesselgauss.nrrd'
+input_mask = \
+  this_dir + '/../../../Testing/Data/Input/vessel_vesselSeedsMask.nrrd'
+
+def test_block_max():
+    mask = np.zeros((5, 4, 2), dtype=bool)
+    mask[4, 0, 0] = True
+    mask[1, 3, 1] = True
+
+    down = block_max(mask, 3, 0)
+    assert down.shape == (3, 4, 2), "Unexpected block max size"
+    assert down[2, 0, 0] and down[0, 3, 1] and down.sum() == 2, \
+      "Block max misses mask samples"
+
+    assert np.array_equal(get_cell_indices(5, 3), [0, 0, 1, 2, 2]), \
+      "Unexpected cell indices"
+
+    mask = np.ones((5, 4, 2), dtype=bool)
+    mask[4, 0, 0] = False
+    down = block_min(mask, 3, 0)
+    assert down.shape == (3, 4, 2) and down[2, 0, 0] == False and \
+      down.sum() == 23, "Unexpected block min"
+
+def test_resolution_pyramid():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        pyramid = ResolutionPyramid(input_mask)
+        in_mask, in_options = nrrd.read(input_mask)
+
+        mask = pyramid.get_mask(2)
+        assert mask is pyramid.get_mask(2), "Level masks are not cached"
+        assert mask.sum() > 0, "Empty down-sampled mask"
+
+        # The level masks are on the grid of the down-sampled volumes
+        out_ct = os.path.join(tmp_dir, 'ct-down.nrrd')
+        PreprocessingEngine().down_sample(input_ct, out_ct, 'cubic:0,0.5', 2)
+        ct, ct_options = nrrd.read(out_ct)
+        options = pyramid.get_options(2)
+        assert mask.shape == ct.shape, "Mask and volume sizes differ"
+        assert np.allclose(get_space_directions(options),
+                           get_space_directions(ct_options)) and \
+          np.allclose(get_space_origin(options),
+                      get_space_origin(ct_options)), \
+          "Mask and volume geometries differ"
+
+        # Every full resolution mask voxel is covered by the coarse mask
+        up = mask[np.ix_(*[get_cell_indices(in_mask.shape[axis],
+                                            mask.shape[axis]) \
+                           for axis in xrange(3)])]
+        assert np.all(up[in_mask != 0]), \
+          "Down-sampled mask misses mask voxels"
+
+        # Differential mask: the mask voxels whose coarse cell is not
+        # entirely within the mask
+        diff = pyramid.get_differential_mask(1, 2)
+        assert diff.shape == in_mask.shape, "Unexpected differential size"
+        assert np.all(diff <= (in_mask != 0)), \
+          "Differential mask outside of the mask"
+        interior = pyramid.get_interior_mask(2)
+        up_interior = interior[np.ix_(*[get_cell_indices(in_mask.shape[axis],
+                                                         mask.shape[axis]) \
+                                        for axis in xrange(3)])]
+        assert np.array_equal(diff, (in_mask != 0) & ~up_interior), \
+          "Unexpected differential mask"
+        assert diff.sum() > 0, "Empty differential mask"
+        assert np.all(up_interior <= (in_mask != 0)), \
+          "Interior of the coarse level outside of the mask"
+
+        out_mask = os.path.join(tmp_dir, 'mask-down.nrrd')
+        pyramid.write_level_mask(out_mask, 1, 2)
+        written, written_options = nrrd.read(out_mask)
+        assert np.array_equal(written != 0, diff), \
+          "Written differential mask differs"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_chest_particles_differential_mask():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        particles = ChestParticles("ridge_line", input_ct, "out.vtk", tmp_dir,
+                                   input_mask)
+        out_file = os.path.join(tmp_dir, "mask-down.nrrd")
+        particles.differential_mask(2, 4, out_file)
+
+        mask = nrrd.read(out_file)[0] != 0
+        expected = ResolutionPyramid(input_mask).get_differential_mask(2, 4)
+        assert np.array_equal(mask, expected), \
+          "Per-level and pyramid differential masks differ"
+    finally:
+        shutil.rmtree(tmp_dir)
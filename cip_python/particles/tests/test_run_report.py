@@ -0,0 +1,53 @@
+import os.path
+import tempfile, shutil
+import json, csv
+import subprocess
+from cip_python.particles.run_report import RunReport
+
+def test_run_report():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        report = RunReport()
+        with report.stage('pass1.nrrd') as record:
+            # Child process that burns some CPU
+            subprocess.call("python -c 'sum(range(2000000))'", shell=True)
+            record['particles'] = 10
+        with report.stage('probing'):
+            with report.stage('probe val'):
+                pass
+
+        stages = report.get_stages()
+        assert [s['stage'] for s in stages] == \
+          ['pass1.nrrd', 'probing', 'probe val'], "Unexpected stages"
+        assert stages[0]['particles'] == 10, "Extra value not recorded"
+        assert stages[0]['children_cpu_time'] > 0, \
+          "Child CPU time not recorded"
+        assert stages[0]['wall_time'] >= stages[0]['children_cpu_time']*0.5, \
+          "Unexpected wall time"
+        assert stages[1]['wall_time'] >= stages[2]['wall_time'], \
+          "Outer stage should include the inner one"
+        assert stages[1]['children_max_rss'] is None, \
+          "Peak memory of earlier children attributed to a stage"
+        for field in RunReport.FIELDS:
+            if field not in ['particles', 'iterations', 'removed']:
+                assert field in stages[1], "Missing field " + field
+
+        report.add_stages(stages[0:1], "level2/")
+        assert report.get_stages()[-1]['stage'] == 'level2/pass1.nrrd', \
+          "Unexpected added stage"
+
+        json_file = os.path.join(tmp_dir, 'report.json')
+        report.write(json_file)
+        f = open(json_file)
+        assert len(json.load(f)['stages']) == 4, "Unexpected JSON report"
+        f.close()
+
+        csv_file = os.path.join(tmp_dir, 'report.csv')
+        report.write(csv_file)
+        f = open(csv_file)
+        rows = list(csv.DictReader(f))
+        f.close()
+        assert len(rows) == 4 and rows[0]['particles'] == '10', \
+          "Unexpected CSV report"
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,98 @@
+import os.path
+import tempfile, shutil
+import subprocess
+import socket
+from cip_python.particles.scale_space_cache import ScaleSpaceCache
+
+def write_file(file_name, num_bytes):
+    f = open(file_name, 'wb')
+    f.write('x'*num_bytes)
+    f.close()
+
+def test_scale_space_cache():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        in_file = os.path.join(tmp_dir, 'ct-deconv.nrrd')
+        write_file(in_file, 100)
+
+        cache = ScaleSpaceCache(os.path.join(tmp_dir, 'cache'), max_size=250)
+
+        # Same contents and parameters give the same key. Any change in the
+        # parameters gives a different one
+        key = cache.get_key(in_file, 'C4 DiscreteGaussian', 5, 6.0)
+        assert key == cache.get_key(in_file, 'C4 DiscreteGaussian', 5, 6.0), \
+          "Cache key is not deterministic"
+        assert key != cache.get_key(in_file, 'C4 DiscreteGaussian', 10, 6.0), \
+          "Cache key does not depend on the number of scale samples"
+        assert key != cache.get_key(in_file, 'C4 DiscreteGaussian', 5, 4.0), \
+          "Cache key does not depend on the max scale"
+        assert key != cache.get_key(in_file, 'Bspline3 DiscreteGaussian', 5,
+                                    6.0), \
+          "Cache key does not depend on the kernel"
+
+        # An entry is complete once all the blurrings are in place
+        entry_dir = cache.get_entry_dir(key)
+        assert not cache.is_complete(key, 2), "Empty entry reported complete"
+        for ii in xrange(2):
+            write_file(os.path.join(entry_dir, "V-%03u-%03u.nrrd" % (ii, 2)),
+                       100)
+        assert cache.is_complete(key, 2), "Full entry reported incomplete"
+
+        # Least recently used entries are evicted first
+        other_file = os.path.join(tmp_dir, 'ct-deconv-other.nrrd')
+        write_file(other_file, 50)
+        other_key = cache.get_key(other_file, 'C4 DiscreteGaussian', 2, 6.0)
+        other_dir = cache.get_entry_dir(other_key)
+        write_file(os.path.join(other_dir, "V-000-002.nrrd"), 100)
+        os.utime(entry_dir, (0, 0))
+
+        removed = cache.evict(keep=other_key)
+        assert removed == [key], "Unexpected evicted entries"
+        assert cache.get_size() == 100, "Unexpected cache size"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_scale_space_cache_leases():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        in_file = os.path.join(tmp_dir, 'ct-deconv.nrrd')
+        write_file(in_file, 100)
+        cache = ScaleSpaceCache(os.path.join(tmp_dir, 'cache'), max_size=50)
+        key = cache.get_key(in_file, 'C4 DiscreteGaussian', 2, 6.0)
+
+        # Missing blurrings are computed in a staging directory, and only
+        # enter the cache once complete
+        assert cache.acquire(key, 2) is None, "Missing entry acquired"
+        staging_dir = cache.get_staging_dir(key)
+        write_file(os.path.join(staging_dir, "V-000-002.nrrd"), 100)
+        assert cache.publish(key, 2) == staging_dir, \
+          "Incomplete blurrings published"
+        assert cache.acquire(key, 2) is None, "Incomplete entry acquired"
+        write_file(os.path.join(staging_dir, "V-001-002.nrrd"), 100)
+        entry_dir = cache.publish(key, 2)
+        assert entry_dir == os.path.join(tmp_dir, 'cache', key), \
+          "Complete blurrings not published"
+        assert not os.path.exists(staging_dir), "Staging directory left"
+        assert cache.acquire(key, 2) == entry_dir, "Complete entry not acquired"
+
+        # Leased entries are not evicted, even above the maximum size
+        assert cache.evict() == [], "Leased entry evicted"
+        cache.release(key)
+        assert cache.evict() == [key], "Released entry not evicted"
+
+        # Leases and staging directories of dead processes are ignored
+        process = subprocess.Popen(['true'])
+        process.wait()
+        entry_dir = os.path.join(tmp_dir, 'cache', key)
+        os.makedirs(entry_dir)
+        write_file(os.path.join(entry_dir, "V-000-001.nrrd"), 100)
+        owner = "%s-%d" % (socket.gethostname(), process.pid)
+        write_file(os.path.join(entry_dir, ".lease-" + owner), 0)
+        stale_dir = os.path.join(tmp_dir, 'cache', ".staging-%s-%s" % \
+                                 (owner, key))
+        os.makedirs(stale_dir)
+        assert cache.evict() == [key], "Entry of a dead process not evicted"
+        assert not os.path.exists(stale_dir), \
+          "Staging directory of a dead process not removed"
+    finally:
+        shutil.rmtree(tmp_dir)
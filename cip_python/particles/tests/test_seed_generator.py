@@ -0,0 +1,56 @@
+import numpy as np
+from cip_python.particles.seed_generator import SeedGenerator, \
+     get_halton_sequence
+
+def test_halton_sequence():
+    points = get_halton_sequence(8)
+    assert np.allclose(points[:, 0], [0, 0.5, 0.25, 0.75, 0.125, 0.625,
+                                      0.375, 0.875]), \
+      "Unexpected base 2 sequence"
+    assert np.allclose(points[0:4, 1], [0, 1/3., 2/3., 1/9.]), \
+      "Unexpected base 3 sequence"
+    assert np.allclose(get_halton_sequence(3, start=5), points[5:8]), \
+      "Unexpected start index"
+
+def test_seed_generator():
+    # Bright Gaussian tube along the last axis
+    tube_sigma = 2.
+    x, y, z = np.meshgrid(np.arange(21.), np.arange(21.), np.arange(40.),
+                          indexing='ij')
+    data = 100*np.exp(-((x - 10)**2 + (y - 10)**2)/(2*tube_sigma**2))
+    options = {'space directions': [['1', '0', '0'], ['0', '1', '0'],
+                                    ['0', '0', '1']],
+               'space origin': ['-10', '0', '0']}
+    mask = np.ones(data.shape, dtype=np.uint8)
+    mask[:, :, 30:] = 0
+
+    generator = SeedGenerator("ridge_line", -20, [0, 1, 2, 3])
+    candidates, scale = generator.get_candidates(data, options, mask)
+    assert candidates[10, 10, 20] and scale[10, 10, 20] == 2, \
+      "Tube center not seeded at the tube scale"
+    assert np.all(candidates[:, :, 30:] == False), "Seeds outside the mask"
+    assert np.all(candidates[0:5] == False), "Seeds away from the tube"
+
+    # Cropping to the mask does not change the candidates within the mask
+    small_mask = np.zeros(data.shape, dtype=np.uint8)
+    small_mask[8:13, 8:13, 18:22] = 1
+    cropped, cropped_scale = generator.get_candidates(data, options,
+                                                      small_mask)
+    assert np.array_equal(cropped, candidates & (small_mask != 0)), \
+      "Cropping changed the candidates"
+    assert np.array_equal(cropped_scale[small_mask != 0],
+                          scale[small_mask != 0]), \
+      "Cropping changed the scales"
+
+    particles = generator.get_seeds(data, options, mask)
+    assert particles.shape == (np.sum(candidates), 4), \
+      "Unexpected number of seeds"
+    assert np.all(np.abs(particles[:, 0]) <= 2) and \
+      np.all(particles[:, 2] < 30), "Seeds not in world coordinates"
+
+    # Several particles per voxel, plus some background particles
+    generator = SeedGenerator("ridge_line", -20, [1, 2, 3], 2, 0.01)
+    more = generator.get_seeds(data, options, mask)
+    assert more.shape[0] > 2*particles.shape[0], "Missing background seeds"
+    assert more.shape[0] <= 2*(particles.shape[0] + 0.01*data.size), \
+      "Too many background seeds"
@@ -188,6 +188,8 @@ class VesselParticles(ChestParticles):
         print "Saving to vtk..."
         self.save_vtk(out_particles % 3)
 
+        self.write_run_report()
+
         #Clean tmp Directory
         self.clean_tmp_dir()
 
@@ -9,6 +9,7 @@ import vtk
 from vtk.util.numpy_support import vtk_to_numpy
 from vtk.util.numpy_support import numpy_to_vtk
 from vtk.util.numpy_support import numpy_to_vtkIdTypeArray
+from vtk.util.numpy_support import ID_TYPE_CODE
 
 import matplotlib
 import matplotlib.pyplot as plt
@@ -68,9 +69,13 @@ class ClusterParticles:
     ax.grid(True)
     fig.savefig('test.png')
 
-    #Save data for each cluster as a vtkPolyData
+    #Save data for each cluster as a vtkPolyData. Group the particle ids by
+    #label with a single sort instead of one scan per cluster
+    order = np.argsort(labels,kind='mergesort')
+    sorted_labels = labels[order]
     for k in unique_labels:
-      ids = np.argwhere(labels == k).flatten()
+      ids = order[np.searchsorted(sorted_labels,k,side='left'):\
+                  np.searchsorted(sorted_labels,k,side='right')]
       print labels.shape[0]
       print ids.shape[0]
       print self._in_vtk.GetNumberOfPoints()
@@ -85,20 +90,10 @@ class ClusterParticles:
     points=vtk_to_numpy(self._in_vtk.GetPoints().GetData())
 
     s_points=vtk.vtkPoints()
-    cell_arr=vtk.vtkCellArray()
-    
-    #s_points.SetData(numpy_to_vtk(points[ids,:]))
-    #s_points.SetNumberOfPoints(s_points.GetData().GetNumberOfTuples())
-    s_p = points[ids,:]
-    s_points.SetNumberOfPoints(s_p.shape[0])
-    cell_arr.SetNumberOfCells(s_p.shape[0])
-    for kk in xrange(s_p.shape[0]):
-      s_points.SetPoint(kk,s_p[kk,0],s_p[kk,1],s_p[kk,2])
-      cell_arr.InsertNextCell(1)
-      cell_arr.InsertCellPoint(kk)
-    
+    s_points.SetData(numpy_to_vtk(points[ids,:],1))
+
     data.SetPoints(s_points)
-    data.SetVerts(cell_arr)
+    data.SetVerts(get_vertex_cells(ids.shape[0]))
     
     #Transfer point data and field data
     for pd,out_pd in zip([self._in_vtk.GetPointData(),self._in_vtk.GetFieldData()],[data.GetPointData(),data.GetFieldData()]):
@@ -215,18 +210,7 @@ class LobeParticleLabeling():
     append=vtk.vtkAppendPolyData()
     for k,tag,cr,ct in zip([0,1],self.cluster_tags,chest_region,chest_type):
       self._out_vtk[tag]=output_collection.GetItemAsObject(k)
-      chest_region_arr = vtk.vtkUnsignedCharArray()
-      chest_region_arr.SetName('ChestRegion')
-      chest_type_arr = vtk.vtkUnsignedCharArray()
-      chest_type_arr.SetName('ChestType')
-      n_p = self._out_vtk[tag].GetNumberOfPoints()
-      chest_region_arr.SetNumberOfTuples(n_p)
-      chest_type_arr.SetNumberOfTuples(n_p)
-      for ii in xrange(self._out_vtk[tag].GetNumberOfPoints()):
-        chest_region_arr.SetValue(ii,cr)
-        chest_type_arr.SetValue(ii,ct)
-      self._out_vtk[tag].GetPointData().AddArray(chest_region_arr)
-      self._out_vtk[tag].GetPointData().AddArray(chest_type_arr)
+      add_chest_region_type_arrays(self._out_vtk[tag],cr,ct)
       
       append.AddInput(self._out_vtk[tag])
 
@@ -294,18 +278,7 @@ class LeftRightParticleLabeling():
     append=vtk.vtkAppendPolyData()
     for k,tag,cr,ct in zip([0,1],self.cluster_tags,chest_region,chest_type):
       self._out_vtk[tag]=output_collection.GetItemAsObject(k)
-      chest_region_arr = vtk.vtkUnsignedCharArray()
-      chest_region_arr.SetName('ChestRegion')
-      chest_type_arr = vtk.vtkUnsignedCharArray()
-      chest_type_arr.SetName('ChestType')
-      n_p = self._out_vtk[tag].GetNumberOfPoints()
-      chest_region_arr.SetNumberOfTuples(n_p)
-      chest_type_arr.SetNumberOfTuples(n_p)
-      for ii in xrange(self._out_vtk[tag].GetNumberOfPoints()):
-        chest_region_arr.SetValue(ii,cr)
-        chest_type_arr.SetValue(ii,ct)
-      self._out_vtk[tag].GetPointData().AddArray(chest_region_arr)
-      self._out_vtk[tag].GetPointData().AddArray(chest_type_arr)
+      add_chest_region_type_arrays(self._out_vtk[tag],cr,ct)
       
       append.AddInput(self._out_vtk[tag])
     
@@ -327,6 +300,27 @@ class LeftRightParticleLabeling():
 
 
 
+def get_vertex_cells(n_p):
+  """Build the cell array with one vertex cell per point, for points 0 to
+  n_p-1, from a single connectivity array ([1, 0, 1, 1, ..., 1, n_p-1]).
+  """
+  connectivity = np.ones([n_p,2],dtype=ID_TYPE_CODE)
+  connectivity[:,1] = np.arange(n_p)
+
+  cell_arr=vtk.vtkCellArray()
+  cell_arr.SetCells(n_p,numpy_to_vtkIdTypeArray(connectivity.ravel(),1))
+  return cell_arr
+
+def add_chest_region_type_arrays(in_vtk,chest_region,chest_type):
+  """Add 'ChestRegion' and 'ChestType' point data arrays (unsigned char) with
+  the same region and type for all the particles.
+  """
+  n_p = in_vtk.GetNumberOfPoints()
+  for name,value in zip(['ChestRegion','ChestType'],[chest_region,chest_type]):
+    arr = numpy_to_vtk(np.full(n_p,value,dtype=np.uint8),1)
+    arr.SetName(name)
+    in_vtk.GetPointData().AddArray(arr)
+
 
 if __name__ == "__main__":
   desc = """Cluster particles points"""
@@ -0,0 +1,619 @@
+import os
+import json
+import shutil
+from optparse import OptionParser
+import numpy as np
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
+
+SCHEMA_FILE_NAME = "schema.json"
+POINTS_FILE_NAME = "points.npy"
+
+# Types of the legacy VTK format (binary data is big endian)
+LEGACY_VTK_TYPES = {'unsigned_char': 'u1', 'char': 'i1',
+                    'unsigned_short': 'u2', 'short': 'i2',
+                    'unsigned_int': 'u4', 'int': 'i4',
+                    'unsigned_long': 'u8', 'long': 'i8',
+                    'vtktypeuint64': 'u8', 'vtktypeint64': 'i8',
+                    'vtkIdType': 'i4', 'float': 'f4', 'double': 'f8'}
+
+class ParticleStore:
+    """Reader of a columnar particle store.
+
+    A particle store is a directory with the particle positions and every
+    point data array in its own '.npy' file, plus a JSON schema
+    ('schema.json') with the number of particles and the name, file, type
+    and number of components of every array. Arrays are memory-mapped, so
+    only the requested columns (and only the touched parts of them) are
+    read from disk.
+
+    Parameters
+    ----------
+    path : string
+        Directory of the store
+    """
+    def __init__(self, path):
+        self._path = path
+        f = open(os.path.join(path, SCHEMA_FILE_NAME), 'r')
+        try:
+            self._schema = json.load(f)
+        finally:
+            f.close()
+
+    def get_schema(self):
+        """Get the schema of the store.
+
+        Returns
+        -------
+        schema : dict
+            'num_particles', 'points' (file name) and 'arrays': a list of
+            dicts with the 'name', 'file', 'dtype' and 'components' of every
+            array
+        """
+        return self._schema
+
+    def get_number_of_particles(self):
+        return self._schema['num_particles']
+
+    def get_array_names(self):
+        return [array['name'] for array in self._schema['arrays']]
+
+    def has_array(self, name):
+        return name in self.get_array_names()
+
+    def get_points(self, mmap=True):
+        """Get the particle positions.
+
+        Parameters
+        ----------
+        mmap : bool (optional)
+            Memory-map the file (default) instead of reading it
+
+        Returns
+        -------
+        points : array, shape ( N, 3 )
+        """
+        return self._load(self._schema['points'], mmap)
+
+    def get_array(self, name, mmap=True):
+        """Get a point data array.
+
+        Parameters
+        ----------
+        name : string
+
+        mmap : bool (optional)
+            Memory-map the file (default) instead of reading it
+
+        Returns
+        -------
+        array : array, shape ( N ) or ( N, C )
+        """
+        for array in self._schema['arrays']:
+            if array['name'] == name:
+                return self._load(array['file'], mmap)
+
+        raise KeyError("No array named " + name)
+
+    def get_arrays(self, names=None, mmap=True):
+        """Get several point data arrays.
+
+        Parameters
+        ----------
+        names : list of strings (optional)
+            Names of the arrays. Default is all the arrays.
+
+        Returns
+        -------
+        arrays : dict
+            Arrays by name
+        """
+        if names is None:
+            names = self.get_array_names()
+
+        return dict([(name, self.get_array(name, mmap)) for name in names])
+
+    def iter_chunks(self, names=None, chunk_size=100000, bounds=None,
+                    regions=None, region_array_name='ChestRegion'):
+        """Iterate over the particles in chunks of bounded size. Only the
+        particles of a chunk, and the requested arrays, are in memory at a
+        time.
+
+        Parameters
+        ----------
+        names : list of strings (optional)
+            Names of the arrays. Default is all the arrays.
+
+        chunk_size : int (optional)
+            Number of particles read at a time. Filtered chunks can have
+            fewer particles; empty chunks are skipped.
+
+        bounds : tuple of floats (optional)
+            ( xmin, xmax, ymin, ymax, zmin, zmax ), as in vtk. Only the
+            particles within the bounds (inclusive) are yielded.
+
+        regions : list of ints (optional)
+            Only the particles whose 'region_array_name' value is in the
+            list are yielded
+
+        region_array_name : string (optional)
+            Name of the array filtered by 'regions'. Default is
+            'ChestRegion'.
+
+        Returns
+        -------
+        chunks : generator of tuples
+            ( points, arrays ) of every chunk, as in 'get_points' and
+            'get_arrays' (but in memory)
+        """
+        if names is None:
+            names = self.get_array_names()
+
+        points = self.get_points()
+        arrays = self.get_arrays(names)
+        region_array = None
+        if regions is not None:
+            region_array = self.get_array(region_array_name)
+
+        for start in xrange(0, self.get_number_of_particles(), chunk_size):
+            stop = start + chunk_size
+            chunk_points = np.array(points[start:stop])
+            keep = np.ones(chunk_points.shape[0], dtype=bool)
+            if bounds is not None:
+                for axis in xrange(3):
+                    keep &= chunk_points[:, axis] >= bounds[2*axis]
+                    keep &= chunk_points[:, axis] <= bounds[2*axis + 1]
+            if region_array is not None:
+                keep &= np.in1d(region_array[start:stop], regions)
+            if np.any(keep) == False:
+                continue
+
+            chunk_arrays = dict()
+            if np.all(keep):
+                for name in names:
+                    chunk_arrays[name] = np.array(arrays[name][start:stop])
+            else:
+                chunk_points = chunk_points[keep]
+                for name in names:
+                    chunk_arrays[name] = arrays[name][start:stop][keep]
+
+            yield chunk_points, chunk_arrays
+
+    def get_poly_data(self, names=None):
+        """Get the particles (and some or all of their arrays) as poly data.
+        """
+        return numpy_to_poly_data(self.get_points(False),
+                                  self.get_arrays(names, False))
+
+    def _load(self, file_name, mmap):
+        mmap_mode = None
+        if mmap == True:
+            mmap_mode = 'r'
+
+        return np.load(os.path.join(self._path, file_name),
+                       mmap_mode=mmap_mode)
+
+def write_particle_store(path, points, arrays):
+    """Write a particle store. See 'ParticleStore'.
+
+    Parameters
+    ----------
+    path : string
+        Directory of the store. It is created if needed.
+
+    points : array, shape ( N, 3 )
+        Particle positions
+
+    arrays : dict
+        Point data arrays of shape ( N ) or ( N, C ), by name. A list of
+        ( name, array ) pairs keeps the order of the arrays.
+    """
+    if os.path.exists(path) == False:
+        os.makedirs(path)
+
+    if isinstance(arrays, dict):
+        arrays = sorted(arrays.items())
+
+    points = np.asarray(points)
+    np.save(os.path.join(path, POINTS_FILE_NAME),
+            np.ascontiguousarray(points))
+
+    schema = {'num_particles': points.shape[0], 'points': POINTS_FILE_NAME,
+              'arrays': list()}
+    for index, (name, array) in enumerate(arrays):
+        array = np.ascontiguousarray(array)
+        assert array.shape[0] == points.shape[0], \
+          "Array %s does not have one value per particle" % name
+        file_name = _get_array_file_name(index)
+        np.save(os.path.join(path, file_name), array)
+        schema['arrays'].append(_get_array_schema(name, file_name, array))
+
+    _write_schema(path, schema)
+
+def write_particle_store_chunks(path, chunks):
+    """Write a particle store from chunks of particles, holding only one
+    chunk in memory at a time. See 'ParticleStore'.
+
+    Every column is appended to a raw file, which is turned into a '.npy'
+    file (by prepending its header) once the number of particles is known.
+
+    Parameters
+    ----------
+    path : string
+        Directory of the store. It is created if needed.
+
+    chunks : iterable of tuples
+        ( points, arrays ) of every chunk, as in 'write_particle_store'
+        (e.g. 'ParticleStore.iter_chunks' or 'iter_vtk_chunks'). Every
+        chunk must have the same arrays, with the same types. A store with
+        no particles (and no arrays) is written if there are no chunks.
+    """
+    if os.path.exists(path) == False:
+        os.makedirs(path)
+
+    columns = None
+    num_particles = 0
+    try:
+        for points, arrays in chunks:
+            if isinstance(arrays, dict):
+                arrays = sorted(arrays.items())
+            chunk = [(None, POINTS_FILE_NAME, np.asarray(points))]
+            for index, (name, array) in enumerate(arrays):
+                chunk.append((name, _get_array_file_name(index),
+                              np.asarray(array)))
+            if columns is None:
+                columns = [{'name': name, 'file': file_name,
+                            'dtype': array.dtype,
+                            'shape': array.shape[1:],
+                            'raw': open(os.path.join(path, file_name + \
+                                                     ".raw"), 'wb')} \
+                           for name, file_name, array in chunk]
+
+            assert [column['name'] for column in columns] == \
+              [name for name, file_name, array in chunk], \
+              "Chunks do not have the same arrays"
+            for column, (name, file_name, array) in zip(columns, chunk):
+                assert array.shape[0] == chunk[0][2].shape[0], \
+                  "Array %s does not have one value per particle" % name
+                column['raw'].write(np.ascontiguousarray(
+                    array, dtype=column['dtype']).tostring())
+            num_particles += chunk[0][2].shape[0]
+    finally:
+        if columns is not None:
+            for column in columns:
+                column['raw'].close()
+
+    if columns is None:
+        write_particle_store(path, np.zeros((0, 3)), list())
+        return
+
+    schema = {'num_particles': num_particles, 'points': POINTS_FILE_NAME,
+              'arrays': list()}
+    for column in columns:
+        raw_file_name = os.path.join(path, column['file'] + ".raw")
+        array_file = open(os.path.join(path, column['file']), 'wb')
+        try:
+            np.lib.format.write_array_header_1_0(
+                array_file, {'descr': np.lib.format.dtype_to_descr(
+                    column['dtype']), 'fortran_order': False,
+                             'shape': (num_particles,) + column['shape']})
+            raw_file = open(raw_file_name, 'rb')
+            try:
+                shutil.copyfileobj(raw_file, array_file)
+            finally:
+                raw_file.close()
+        finally:
+            array_file.close()
+        os.remove(raw_file_name)
+
+        if column['name'] is not None:
+            schema['arrays'].append(_get_array_schema(
+                column['name'], column['file'],
+                np.empty((0,) + column['shape'], dtype=column['dtype'])))
+
+    _write_schema(path, schema)
+
+def _get_array_file_name(index):
+    # Array names may not be valid file names
+    return "array%03d.npy" % index
+
+def _get_array_schema(name, file_name, array):
+    components = 1
+    if array.ndim > 1:
+        components = array.shape[1]
+
+    return {'name': name, 'file': file_name, 'dtype': array.dtype.str,
+            'components': components}
+
+def _write_schema(path, schema):
+    f = open(os.path.join(path, SCHEMA_FILE_NAME), 'w')
+    try:
+        json.dump(schema, f, indent=2)
+    finally:
+        f.close()
+
+def poly_data_to_numpy(poly_data, names=None):
+    """Get the points and point data arrays of a poly data.
+
+    Parameters
+    ----------
+    poly_data : vtkPolyData
+
+    names : list of strings (optional)
+        Names of the arrays. Default is all the arrays.
+
+    Returns
+    -------
+    points : array, shape ( N, 3 )
+
+    arrays : list of tuples
+        ( name, array ) pairs, in the order of the point data
+    """
+    points = vtk_to_numpy(poly_data.GetPoints().GetData())
+    point_data = poly_data.GetPointData()
+    arrays = list()
+    for ii in xrange(point_data.GetNumberOfArrays()):
+        name = point_data.GetArrayName(ii)
+        if names is None or name in names:
+            arrays.append((name, vtk_to_numpy(point_data.GetArray(ii))))
+
+    return points, arrays
+
+def numpy_to_poly_data(points, arrays):
+    """Build a poly data from points and point data arrays (by name, or as
+    a list of ( name, array ) pairs). The arrays are deep copied.
+    """
+    if isinstance(arrays, dict):
+        arrays = sorted(arrays.items())
+
+    poly_data = vtk.vtkPolyData()
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_to_vtk(np.ascontiguousarray(points), deep=1))
+    poly_data.SetPoints(vtk_points)
+    for name, array in arrays:
+        vtk_array = numpy_to_vtk(np.ascontiguousarray(array), deep=1)
+        vtk_array.SetName(name)
+        poly_data.GetPointData().AddArray(vtk_array)
+
+    return poly_data
+
+def read_poly_data(file_name):
+    if file_name.endswith(".vtp"):
+        reader = vtk.vtkXMLPolyDataReader()
+    else:
+        reader = vtk.vtkPolyDataReader()
+    reader.SetFileName(file_name)
+    reader.Update()
+
+    return reader.GetOutput()
+
+def write_poly_data(file_name, poly_data):
+    if file_name.endswith(".vtp"):
+        writer = vtk.vtkXMLPolyDataWriter()
+    else:
+        writer = vtk.vtkPolyDataWriter()
+        writer.SetFileTypeToBinary()
+    writer.SetFileName(file_name)
+    writer.SetInputData(poly_data)
+    writer.Write()
+
+def iter_vtk_chunks(file_name, names=None, chunk_size=100000):
+    """Iterate over the particles of a VTK file in chunks of bounded size,
+    without reading the whole file.
+
+    Legacy files ('.vtk') are scanned once for the position of every data
+    block. The blocks of binary files are then memory-mapped, and those of
+    ASCII files are read 'chunk_size' values at a time. XML files ('.vtp')
+    are read one piece at a time, so they are only streamed if they were
+    written in several pieces.
+
+    Parameters
+    ----------
+    file_name : string
+        VTK particles file ('.vtk' or '.vtp')
+
+    names : list of strings (optional)
+        Names of the point data arrays. Default is all the arrays.
+
+    chunk_size : int (optional)
+        Maximum number of particles of a chunk
+
+    Returns
+    -------
+    chunks : generator of tuples
+        ( points, arrays ) of every chunk, as in 'poly_data_to_numpy'
+    """
+    if file_name.endswith(".vtp"):
+        reader = vtk.vtkXMLPolyDataReader()
+        reader.SetFileName(file_name)
+        reader.UpdateInformation()
+        num_pieces = reader.GetNumberOfPieces()
+        for piece in xrange(num_pieces):
+            reader.UpdatePiece(piece, num_pieces, 0)
+            points, arrays = poly_data_to_numpy(reader.GetOutput(), names)
+            for start in xrange(0, points.shape[0], chunk_size):
+                stop = start + chunk_size
+                yield np.array(points[start:stop]), \
+                  [(name, np.array(array[start:stop])) \
+                   for name, array in arrays]
+        return
+
+    binary, num_particles, blocks = get_legacy_vtk_blocks(file_name)
+    blocks = [block for block in blocks \
+              if block[0] is None or names is None or block[0] in names]
+
+    if binary == True:
+        columns = [np.memmap(file_name, dtype='>' + dtype, mode='r',
+                             offset=offset,
+                             shape=(num_particles, components)) \
+                   for name, offset, dtype, components in blocks]
+        for start in xrange(0, num_particles, chunk_size):
+            chunk = [_get_legacy_vtk_column(column[start:start + chunk_size],
+                                            dtype, components) \
+                     for column, (name, offset, dtype, components) in \
+                     zip(columns, blocks)]
+            yield chunk[0], [(block[0], column) for block, column in \
+                             zip(blocks[1:], chunk[1:])]
+        return
+
+    files = list()
+    try:
+        for name, offset, dtype, components in blocks:
+            f = open(file_name, 'rb')
+            f.seek(offset)
+            files.append(f)
+        for start in xrange(0, num_particles, chunk_size):
+            count = min(chunk_size, num_particles - start)
+            chunk = [_get_legacy_vtk_column(
+                np.fromfile(f, sep=' ', count=count*components).\
+                  reshape(count, components), dtype, components) \
+                     for f, (name, offset, dtype, components) in \
+                     zip(files, blocks)]
+            yield chunk[0], [(block[0], column) for block, column in \
+                             zip(blocks[1:], chunk[1:])]
+    finally:
+        for f in files:
+            f.close()
+
+def get_legacy_vtk_blocks(file_name):
+    """Find the particle positions and the point data arrays of a legacy VTK
+    poly data file, without reading them.
+
+    Returns
+    -------
+    binary : bool
+        Whether the data is binary (big endian) or ASCII
+
+    num_particles : int
+
+    blocks : list of tuples
+        ( name, offset, dtype, components ) of the positions (with name
+        None) and of every point data array, in file order. 'offset' is the
+        position of the data in the file and 'dtype' the numpy type code
+        (without byte order).
+    """
+    f = open(file_name, 'rb')
+    try:
+        f.readline()
+        f.readline()
+        binary = f.readline().strip().upper() == 'BINARY'
+        if f.readline().split() != ['DATASET', 'POLYDATA']:
+            raise ValueError(file_name + " is not a poly data file")
+
+        num_particles = None
+        point_data = False
+        blocks = list()
+
+        def skip_block(num_values, dtype):
+            offset = f.tell()
+            if binary == True:
+                f.seek(num_values*np.dtype(dtype).itemsize, 1)
+            else:
+                for start in xrange(0, num_values, 1000000):
+                    np.fromfile(f, sep=' ',
+                                count=min(1000000, num_values - start))
+            return offset
+
+        def add_block(name, type_name, components, num_tuples):
+            if type_name not in LEGACY_VTK_TYPES:
+                raise ValueError("Unsupported type %s in %s" % \
+                                 (type_name, file_name))
+            dtype = LEGACY_VTK_TYPES[type_name]
+            offset = skip_block(num_tuples*components, dtype)
+            if name is None or point_data == True:
+                blocks.append((name, offset, dtype, components))
+
+        while True:
+            line = f.readline()
+            if line == '':
+                break
+            words = line.split()
+            if len(words) == 0:
+                continue
+
+            keyword = words[0].upper()
+            if keyword == 'POINTS':
+                num_particles = int(words[1])
+                add_block(None, words[2], 3, num_particles)
+            elif keyword in ['VERTICES', 'LINES', 'POLYGONS',
+                             'TRIANGLE_STRIPS']:
+                skip_block(int(words[2]), 'i4')
+            elif keyword == 'POINT_DATA':
+                point_data = True
+            elif keyword == 'CELL_DATA':
+                point_data = False
+            elif keyword == 'SCALARS':
+                components = 1
+                if len(words) > 3:
+                    components = int(words[3])
+                # Followed by the name of the lookup table
+                f.readline()
+                add_block(words[1], words[2], components, num_particles)
+            elif keyword in ['VECTORS', 'NORMALS']:
+                add_block(words[1], words[2], 3, num_particles)
+            elif keyword == 'TENSORS':
+                add_block(words[1], words[2], 9, num_particles)
+            elif keyword == 'FIELD':
+                for ii in xrange(int(words[2])):
+                    words = f.readline().split()
+                    while len(words) == 0:
+                        words = f.readline().split()
+                    add_block(words[0], words[3], int(words[1]),
+                              int(words[2]))
+            elif keyword == 'METADATA':
+                # Information of the previous array, up to a blank line
+                while f.readline().strip() != '':
+                    pass
+            else:
+                raise ValueError("Unsupported section %s in %s" % \
+                                 (keyword, file_name))
+    finally:
+        f.close()
+
+    if num_particles is None:
+        raise ValueError(file_name + " has no points")
+
+    return binary, num_particles, blocks
+
+def _get_legacy_vtk_column(values, dtype, components):
+    column = np.array(values, dtype=dtype)
+    if components == 1:
+        column = column.reshape(-1)
+
+    return column
+
+def vtk_to_particle_store(in_file_name, path, names=None, chunk_size=100000):
+    """Convert a VTK ('.vtk' or '.vtp') particles file to a particle store,
+    in chunks of at most 'chunk_size' particles (see 'iter_vtk_chunks').
+    """
+    write_particle_store_chunks(path, iter_vtk_chunks(in_file_name, names,
+                                                      chunk_size))
+
+def particle_store_to_vtk(path, out_file_name, names=None):
+    """Convert a particle store to a VTK ('.vtk' or '.vtp') particles file.
+    """
+    write_poly_data(out_file_name, ParticleStore(path).get_poly_data(names))
+
+if __name__ == "__main__":
+    parser = OptionParser(description='Convert particles between VTK files \
+                          and columnar particle stores (directories)')
+    parser.add_option("-i", help='input particles: VTK file (.vtk or .vtp) \
+                      or particle store', dest="input")
+    parser.add_option("-o", help='output particles: particle store or VTK \
+                      file (.vtk or .vtp)', dest="output")
+    parser.add_option("-a", help='comma-separated names of the arrays to \
+                      convert (default all)', dest="arrays", default=None)
+    parser.add_option("-c", help='number of particles converted at a time \
+                      from VTK files (default 100000)', dest="chunk_size",
+                      type="int", default=100000)
+
+    (op, args) = parser.parse_args()
+
+    names = None
+    if op.arrays is not None:
+        names = op.arrays.split(',')
+
+    if os.path.isdir(op.input):
+        particle_store_to_vtk(op.input, op.output, names)
+    else:
+        vtk_to_particle_store(op.input, op.output, names, op.chunk_size)
@@ -1,4 +1,8 @@
 import subprocess
+import numpy as np
+import nrrd
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk
 
 class ReadNRRDsWriteVTK:
     """
@@ -19,3 +23,111 @@ class ReadNRRDsWriteVTK:
     def execute( self ):
         tmpCommand = "ReadNRRDsWriteVTK " + self._argumentList
         subprocess.call( tmpCommand, shell=True )
+
+class NRRDsVTKWriter:
+    """In-process counterpart of the ReadNRRDsWriteVTK program, with the same
+    interface as 'ReadNRRDsWriteVTK'. The NRRD files are read with pynrrd and
+    the arrays are handed to VTK without copies whenever their layout allows
+    it.
+
+    As in ReadNRRDsWriteVTK, files that are 1xN, 3xN and 9xN give scalar,
+    vector and matrix arrays. A 4xN file gives the point coordinates and a
+    'scale' array (its array name is just a placeholder). A 7xN file (mask xx
+    xy xz yy yz zz) gives a 9 component matrix array.
+
+    Parameters
+    ----------
+    out_file_name : string
+        Name of output VTK file. Files with a '.vtp' extension are written in
+        the XML format, others in the legacy VTK format.
+
+    binary : bool (optional)
+        Write binary (True, default) or ASCII files
+
+    compression : bool (optional)
+        Compress the arrays with zlib. Only used for binary '.vtp' files.
+        Default is True.
+    """
+    def __init__(self, out_file_name, binary=True, compression=True):
+        self._out_file_name = out_file_name
+        self._binary = binary
+        self._compression = compression
+        self._file_names = list()
+        self._array_names = list()
+
+        # NumPy arrays shared with VTK. They must outlive the poly data.
+        self._arrays = list()
+
+    def add_file_name_array_name_pair(self, file_name, array_name):
+        self._file_names.append(file_name)
+        self._array_names.append(array_name)
+
+    def get_poly_data(self):
+        """Read all the NRRD files and collect them into a poly data.
+
+        Returns
+        -------
+        poly_data : vtkPolyData
+        """
+        poly_data = vtk.vtkPolyData()
+        points = vtk.vtkPoints()
+
+        for file_name, array_name in zip(self._file_names, self._array_names):
+            data, options = nrrd.read(file_name)
+            if data.ndim == 1:
+                data = data[np.newaxis, :]
+
+            # NRRD data are read with shape ( C, N ) in Fortran order, so the
+            # transpose is a C contiguous ( N, C ) array
+            data = np.ascontiguousarray(data.T, dtype=np.float32)
+            num_components = data.shape[1]
+
+            if num_components == 4:
+                points.SetData(self._to_vtk(data[:, 0:3]))
+                poly_data.GetPointData().AddArray(self._to_vtk(data[:, 3],
+                                                               "scale"))
+            elif num_components in [1, 3, 9]:
+                poly_data.GetPointData().AddArray(self._to_vtk(data,
+                                                               array_name))
+            elif num_components == 7:
+                matrix = data[:, [1, 2, 3, 2, 4, 5, 3, 5, 6]]
+                poly_data.GetPointData().AddArray(self._to_vtk(matrix,
+                                                               array_name))
+
+        poly_data.SetPoints(points)
+
+        return poly_data
+
+    def execute(self):
+        poly_data = self.get_poly_data()
+
+        if self._out_file_name.endswith(".vtp"):
+            writer = vtk.vtkXMLPolyDataWriter()
+            if self._binary == True:
+                writer.SetDataModeToAppended()
+                writer.EncodeAppendedDataOff()
+                if self._compression == True:
+                    writer.SetCompressorTypeToZLib()
+                else:
+                    writer.SetCompressorTypeToNone()
+            else:
+                writer.SetDataModeToAscii()
+        else:
+            writer = vtk.vtkPolyDataWriter()
+            if self._binary == True:
+                writer.SetFileTypeToBinary()
+            else:
+                writer.SetFileTypeToASCII()
+
+        writer.SetFileName(self._out_file_name)
+        writer.SetInputData(poly_data)
+        writer.Write()
+
+    def _to_vtk(self, array, name=None):
+        array = np.ascontiguousarray(array)
+        self._arrays.append(array)
+        vtk_array = numpy_to_vtk(array, deep=0)
+        if name is not None:
+            vtk_array.SetName(name)
+
+        return vtk_array
@@ -0,0 +1,40 @@
+import numpy as np
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
+from cip_python.utils.cluster_particles import get_vertex_cells, \
+     add_chest_region_type_arrays
+
+def get_toy_poly_data(num_points):
+    points = vtk.vtkPoints()
+    points.SetData(numpy_to_vtk(np.arange(3.*num_points).reshape(-1, 3),
+                                deep=1))
+    poly_data = vtk.vtkPolyData()
+    poly_data.SetPoints(points)
+
+    return poly_data
+
+def test_get_vertex_cells():
+    poly_data = get_toy_poly_data(5)
+    poly_data.SetVerts(get_vertex_cells(5))
+
+    assert poly_data.GetNumberOfVerts() == 5, "Unexpected number of vertices"
+    assert np.array_equal(vtk_to_numpy(poly_data.GetVerts().GetData()),
+                          [1, 0, 1, 1, 1, 2, 1, 3, 1, 4]), \
+      "Unexpected cell connectivity"
+    for ii in xrange(5):
+        cell = poly_data.GetCell(ii)
+        assert cell.GetCellType() == vtk.VTK_VERTEX and \
+          cell.GetPointId(0) == ii, "Vertex not on its point"
+
+def test_add_chest_region_type_arrays():
+    poly_data = get_toy_poly_data(4)
+    add_chest_region_type_arrays(poly_data, 2, 35)
+
+    point_data = poly_data.GetPointData()
+    for name, value in [('ChestRegion', 2), ('ChestType', 35)]:
+        array = point_data.GetArray(name)
+        assert array is not None, "Missing array " + name
+        assert array.GetDataType() == vtk.VTK_UNSIGNED_CHAR, \
+          "Array " + name + " is not unsigned char"
+        assert np.array_equal(vtk_to_numpy(array), [value]*4), \
+          "Unexpected values in " + name
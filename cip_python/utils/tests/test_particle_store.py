@@ -0,0 +1,154 @@
+import os.path
+import tempfile, shutil
+import numpy as np
+import vtk
+from cip_python.utils.particle_store import ParticleStore, \
+     write_particle_store, numpy_to_poly_data, write_poly_data, \
+     vtk_to_particle_store, particle_store_to_vtk, read_poly_data, \
+     poly_data_to_numpy, iter_vtk_chunks, write_particle_store_chunks
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+vtk_file_name = this_dir + '/../../../Testing/Data/Input/vessel_particles.vtk'
+
+def test_particle_store():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        num_particles = 100
+        points = np.random.rand(num_particles, 3).astype(np.float32)
+        arrays = [('val', np.random.rand(num_particles).astype(np.float32)),
+                  ('hevec0', np.random.rand(num_particles, 3)),
+                  ('ChestRegion', np.arange(num_particles).astype(np.uint16))]
+
+        store_dir = os.path.join(tmp_dir, "store")
+        write_particle_store(store_dir, points, arrays)
+        store = ParticleStore(store_dir)
+        assert store.get_number_of_particles() == num_particles, \
+          "Wrong number of particles"
+        assert store.get_array_names() == ['val', 'hevec0', 'ChestRegion'], \
+          "Array order not kept"
+        assert isinstance(store.get_array('val'), np.memmap), \
+          "Array not memory-mapped"
+        assert np.array_equal(store.get_points(), points), "Wrong points"
+        for name, array in arrays:
+            assert np.array_equal(store.get_array(name), array), \
+              "Wrong array " + name
+            assert store.get_array(name, mmap=False).dtype == array.dtype, \
+              "Wrong type of array " + name
+
+        # Round trip through VTK
+        vtk_file_name = os.path.join(tmp_dir, "particles.vtk")
+        write_poly_data(vtk_file_name, numpy_to_poly_data(points, arrays))
+        vtk_to_particle_store(vtk_file_name, os.path.join(tmp_dir, "vtk"),
+                              names=['hevec0', 'ChestRegion'])
+        store = ParticleStore(os.path.join(tmp_dir, "vtk"))
+        assert store.get_array_names() == ['hevec0', 'ChestRegion'], \
+          "Wrong selection of arrays"
+        assert np.allclose(store.get_array('hevec0'), arrays[1][1]), \
+          "Wrong array converted from VTK"
+
+        out_file_name = os.path.join(tmp_dir, "out.vtp")
+        particle_store_to_vtk(store_dir, out_file_name)
+        out_points, out_arrays = \
+          poly_data_to_numpy(read_poly_data(out_file_name))
+        assert np.array_equal(out_points, points), "Wrong points in VTK"
+        assert sorted([name for name, array in out_arrays]) == \
+          ['ChestRegion', 'hevec0', 'val'], "Wrong arrays in VTK"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_iter_chunks():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        num_particles = 1000
+        points = np.random.rand(num_particles, 3)*100
+        regions = np.random.randint(0, 4, num_particles).astype(np.float32)
+        scale = np.random.rand(num_particles)
+        write_particle_store(tmp_dir, points,
+                             {'ChestRegion': regions, 'scale': scale})
+        store = ParticleStore(tmp_dir)
+
+        chunks = list(store.iter_chunks(names=['scale'], chunk_size=300))
+        assert len(chunks) == 4, "Wrong number of chunks"
+        assert max([c[0].shape[0] for c in chunks]) == 300, \
+          "Chunks larger than the chunk size"
+        assert chunks[0][1].keys() == ['scale'], "Wrong arrays in the chunks"
+        assert np.array_equal(np.concatenate([c[1]['scale'] for c in chunks]),
+                              scale), "Wrong chunked array"
+
+        bounds = (10, 50, 0, 100, 20, 80)
+        keep = (points[:, 0] >= 10) & (points[:, 0] <= 50) & \
+          (points[:, 2] >= 20) & (points[:, 2] <= 80) & \
+          ((regions == 1) | (regions == 3))
+        chunks = list(store.iter_chunks(chunk_size=128, bounds=bounds,
+                                        regions=[1, 3]))
+        assert np.array_equal(np.concatenate([c[0] for c in chunks]),
+                              points[keep]), "Wrong filtered points"
+        assert np.array_equal(np.concatenate([c[1]['scale'] for c in chunks]),
+                              scale[keep]), "Wrong filtered array"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_vtk_chunks():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # ASCII legacy file
+        poly_data = read_poly_data(vtk_file_name)
+        points, arrays = poly_data_to_numpy(poly_data)
+        vtk_to_particle_store(vtk_file_name, os.path.join(tmp_dir, "ascii"),
+                              chunk_size=100)
+        store = ParticleStore(os.path.join(tmp_dir, "ascii"))
+        assert store.get_number_of_particles() == points.shape[0], \
+          "Wrong number of particles from ASCII VTK"
+        assert np.array_equal(store.get_points(), points), \
+          "Wrong points from ASCII VTK"
+        for name, array in arrays:
+            assert np.array_equal(store.get_array(name), array), \
+              "Wrong array %s from ASCII VTK" % name
+
+        # Binary legacy file, with vertices
+        verts = vtk.vtkCellArray()
+        for ii in xrange(points.shape[0]):
+            verts.InsertNextCell(1)
+            verts.InsertCellPoint(ii)
+        poly_data.SetVerts(verts)
+        binary_file_name = os.path.join(tmp_dir, "binary.vtk")
+        write_poly_data(binary_file_name, poly_data)
+        chunks = list(iter_vtk_chunks(binary_file_name, names=['hess'],
+                                      chunk_size=100))
+        assert [c[0].shape[0] for c in chunks] == [100]*5 + [16], \
+          "Wrong chunks from binary VTK"
+        assert np.array_equal(np.concatenate([c[1][0][1] for c in chunks]),
+                              dict(arrays)['hess']), \
+          "Wrong array from binary VTK"
+
+        # XML file in pieces
+        pieces = vtk.vtkExtractPolyDataPiece()
+        pieces.SetInputData(poly_data)
+        writer = vtk.vtkXMLPolyDataWriter()
+        writer.SetFileName(os.path.join(tmp_dir, "pieces.vtp"))
+        writer.SetInputConnection(pieces.GetOutputPort())
+        writer.SetNumberOfPieces(3)
+        writer.Write()
+        chunks = list(iter_vtk_chunks(os.path.join(tmp_dir, "pieces.vtp"),
+                                      chunk_size=100))
+        assert max([c[0].shape[0] for c in chunks]) <= 100, \
+          "Chunks larger than the chunk size"
+        assert sum([c[0].shape[0] for c in chunks]) == points.shape[0], \
+          "Wrong number of particles from XML VTK"
+
+        # Filtered copy of a store
+        bounds = (0, 100, 0, 100, 0, 30)
+        keep = points[:, 2] <= 30
+        write_particle_store_chunks(os.path.join(tmp_dir, "filtered"),
+            store.iter_chunks(names=['scale', 'hevec0'], chunk_size=100,
+                              bounds=bounds))
+        filtered = ParticleStore(os.path.join(tmp_dir, "filtered"))
+        assert filtered.get_array_names() == ['hevec0', 'scale'], \
+          "Wrong arrays in the filtered store"
+        assert np.array_equal(filtered.get_points(), points[keep]), \
+          "Wrong points in the filtered store"
+        assert np.array_equal(filtered.get_array('hevec0'),
+                              dict(arrays)['hevec0'][keep]), \
+          "Wrong array in the filtered store"
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,68 @@
+import os.path
+import tempfile, shutil
+import numpy as np
+import nrrd
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+from cip_python.utils.read_nrrds_write_vtk import NRRDsVTKWriter
+
+def write_array(file_name, array):
+    nrrd.write(file_name, np.asfortranarray(array.T))
+
+def read_poly_data(file_name):
+    if file_name.endswith(".vtp"):
+        reader = vtk.vtkXMLPolyDataReader()
+    else:
+        reader = vtk.vtkPolyDataReader()
+    reader.SetFileName(file_name)
+    reader.Update()
+
+    return reader.GetOutput()
+
+def test_nrrds_vtk_writer():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        num_particles = 50
+        particles = np.random.rand(num_particles, 4).astype(np.float32)
+        val = np.random.rand(num_particles, 1).astype(np.float32)
+        hevec0 = np.random.rand(num_particles, 3).astype(np.float32)
+        hess = np.random.rand(num_particles, 9).astype(np.float32)
+        tensor = np.random.rand(num_particles, 7).astype(np.float32)
+
+        arrays = [('particles.nrrd', 'NA', particles),
+                  ('val.nrrd', 'val', val),
+                  ('hevec0.nrrd', 'hevec0', hevec0),
+                  ('hess.nrrd', 'hess', hess),
+                  ('tensor.nrrd', 'tensor', tensor)]
+        for file_name, array_name, array in arrays:
+            write_array(os.path.join(tmp_dir, file_name), array)
+
+        for out_name in ['particles.vtk', 'particles.vtp']:
+            out_file_name = os.path.join(tmp_dir, out_name)
+            writer = NRRDsVTKWriter(out_file_name)
+            for file_name, array_name, array in arrays:
+                writer.add_file_name_array_name_pair(
+                    os.path.join(tmp_dir, file_name), array_name)
+            writer.execute()
+
+            poly_data = read_poly_data(out_file_name)
+            point_data = poly_data.GetPointData()
+            assert poly_data.GetNumberOfPoints() == num_particles, \
+              "Unexpected number of points"
+            assert np.allclose(vtk_to_numpy(poly_data.GetPoints().GetData()),
+                               particles[:, 0:3]), "Unexpected points"
+            assert np.allclose(vtk_to_numpy(point_data.GetArray('scale')),
+                               particles[:, 3]), "Unexpected scale"
+            assert point_data.GetArray('NA') is None, \
+              "Placeholder array name should not be used"
+            assert np.allclose(vtk_to_numpy(point_data.GetArray('val')),
+                               val[:, 0]), "Unexpected scalar array"
+            assert np.allclose(vtk_to_numpy(point_data.GetArray('hevec0')),
+                               hevec0), "Unexpected vector array"
+            assert np.allclose(vtk_to_numpy(point_data.GetArray('hess')),
+                               hess), "Unexpected matrix array"
+            assert np.allclose(vtk_to_numpy(point_data.GetArray('tensor')),
+                               tensor[:, [1, 2, 3, 2, 4, 5, 3, 5, 6]]), \
+              "Unexpected tensor array"
+    finally:
+        shutil.rmtree(tmp_dir)